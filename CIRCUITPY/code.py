@@ -1,8 +1,11 @@
+import array
+import binascii
 import time
 import usb_hid
 import usb_cdc
 from adafruit_hid.keyboard import Keyboard
 from adafruit_hid.keycode import Keycode
+from keytable import KEYS
 
 # Add a delay to give the USB host time to get ready.
 # This helps prevent a race condition on startup.
@@ -11,69 +14,31 @@ time.sleep(1)
 
 # A comprehensive mapping from the string names used by the 'keyboard' library
 # to the Keycode objects that CircuitPython's HID library understands.
-KEY_MAP = {
-    # Letters (Lowercase)
-    'a': Keycode.A, 'b': Keycode.B, 'c': Keycode.C, 'd': Keycode.D, 'e': Keycode.E,
-    'f': Keycode.F, 'g': Keycode.G, 'h': Keycode.H, 'i': Keycode.I, 'j': Keycode.J,
-    'k': Keycode.K, 'l': Keycode.L, 'm': Keycode.M, 'n': Keycode.N, 'o': Keycode.O,
-    'p': Keycode.P, 'q': Keycode.Q, 'r': Keycode.R, 's': Keycode.S, 't': Keycode.T,
-    'u': Keycode.U, 'v': Keycode.V, 'w': Keycode.W, 'x': Keycode.X, 'y': Keycode.Y,
-    'z': Keycode.Z,
-
-    # Numbers (Top Row)
-    '1': Keycode.ONE, '2': Keycode.TWO, '3': Keycode.THREE, '4': Keycode.FOUR,
-    '5': Keycode.FIVE, '6': Keycode.SIX, '7': Keycode.SEVEN, '8': Keycode.EIGHT,
-    '9': Keycode.NINE, '0': Keycode.ZERO,
-
-    # Function Keys
-    'f1': Keycode.F1, 'f2': Keycode.F2, 'f3': Keycode.F3, 'f4': Keycode.F4,
-    'f5': Keycode.F5, 'f6': Keycode.F6, 'f7': Keycode.F7, 'f8': Keycode.F8,
-    'f9': Keycode.F9, 'f10': Keycode.F10, 'f11': Keycode.F11, 'f12': Keycode.F12,
-
-    # Punctuation and Symbols
-    'enter': Keycode.ENTER,
-    'esc': Keycode.ESCAPE,
-    'backspace': Keycode.BACKSPACE,
-    'tab': Keycode.TAB,
-    'space': Keycode.SPACE,
-    '-': Keycode.MINUS,
-    '=': Keycode.EQUALS,
-    '[': Keycode.LEFT_BRACKET,
-    ']': Keycode.RIGHT_BRACKET,
-    '\\': Keycode.BACKSLASH,
-    ';': Keycode.SEMICOLON,
-    "'": Keycode.QUOTE,
-    '`': Keycode.GRAVE_ACCENT,
-    ',': Keycode.COMMA,
-    '.': Keycode.PERIOD,
-    '/': Keycode.FORWARD_SLASH,
-
-    # Modifier Keys
-    'caps lock': Keycode.CAPS_LOCK,
-    'shift': Keycode.LEFT_SHIFT,
-    'ctrl': Keycode.LEFT_CONTROL,
-    'alt': Keycode.LEFT_ALT,
-    'cmd': Keycode.LEFT_GUI,
-    'windows': Keycode.LEFT_GUI,
-    'right shift': Keycode.RIGHT_SHIFT,
-    'right ctrl': Keycode.RIGHT_CONTROL,
-    'right alt': Keycode.RIGHT_ALT,
-
-    # Navigation and Control Keys
-    'print screen': Keycode.PRINT_SCREEN,
-    'scroll lock': Keycode.SCROLL_LOCK,
-    'pause': Keycode.PAUSE,
-    'insert': Keycode.INSERT,
-    'home': Keycode.HOME,
-    'page up': Keycode.PAGE_UP,
-    'delete': Keycode.DELETE,
-    'end': Keycode.END,
-    'page down': Keycode.PAGE_DOWN,
-    'right': Keycode.RIGHT_ARROW,
-    'left': Keycode.LEFT_ARROW,
-    'down': Keycode.DOWN_ARROW,
-    'up': Keycode.UP_ARROW,
-}
+# The names and their wire ids live in keytable.py, shared with the host.
+KEY_MAP = {}
+# Keycodes indexed by key id, for binary frames
+KEY_BY_ID = []
+for _name, _attr in KEYS:
+    KEY_MAP[_name] = getattr(Keycode, _attr)
+    KEY_BY_ID.append(KEY_MAP[_name])
+
+# Binary frame layout (version 1), see picobot.py encode_frame():
+#   SYNC | OP | SEQ_LO | SEQ_HI | LEN | PAYLOAD[LEN] | CHK
+# CHK is the low byte of the sum of OP..PAYLOAD. Text commands never start with
+# the SYNC byte, so both formats can share the DATA port.
+FRAME_SYNC = 0xB1
+FRAME_HEADER = 5
+# Command name for each opcode (index = opcode)
+FRAME_OPS = (None, "down", "up", "tl_down", "tl_up", "tl_clear", "tl_start", "tl_abort", "batch",
+             "release_all", "state")
+# Batch payload: one byte per key change, the key id with this bit set for a press
+BATCH_PRESS = 0x80
+# Key id of each keycode (the first name wins), for the "state" bitmap reply
+ID_BY_KEYCODE = {}
+for _id, _code in enumerate(KEY_BY_ID):
+    if _code not in ID_BY_KEYCODE:
+        ID_BY_KEYCODE[_code] = _id
+STATE_BYTES = (len(KEY_BY_ID) + 7) // 8
 
 print("Pico HID Command Executor")
 
@@ -86,11 +51,172 @@ except Exception as e:
 
 # Track DATA serial connection state to re-emit readiness on new connections
 data_was_connected = usb_cdc.data.connected
-# Buffer for assembling newline-terminated commands from DATA port
-rx_buffer = b""
+# Preallocated receive buffer for binary frames and newline-terminated commands.
+# Bytes are read in at rx_tail and parsed in place from rx_head; a trailing
+# partial command is moved back to the front only when the end is reached.
+RX_SIZE = 2048
+rx_buf = bytearray(RX_SIZE)
+rx_view = memoryview(rx_buf)
+rx_head = 0
+rx_tail = 0
+MAX_LINE = 64  # Longest text command, e.g. "tl_down|backspace|65535|4294967295"
+# Adaptive idle sleep: spin while commands are flowing, then back off
+# exponentially up to IDLE_SLEEP_MAX to keep power use down when idle.
+BUSY_WINDOW = 0.02  # Seconds after the last received byte to keep spinning
+IDLE_SLEEP_MIN = 0.0005
+IDLE_SLEEP_MAX = 0.01
+idle_sleep = IDLE_SLEEP_MIN
+last_rx = 0.0
+# Device-side timeline: events uploaded with tl_down/tl_up and fired against
+# the Pico's own clock after tl_start. Offsets are microseconds from start.
+TL_MAX = 2048
+TL_LEAD_NS = 20000000  # Head start so the first event is never late
+tl_times = array.array("L", [0] * TL_MAX)
+tl_keys = bytearray(TL_MAX)
+tl_press = bytearray(TL_MAX)
+tl_len = 0
+tl_next = 0
+tl_running = False
+tl_start_ns = 0
+tl_last_progress = 0.0
+# Capabilities advertised in reply to "caps|..." (see picobot.py)
+CAPS_LINE = ("CAPS seq tl tlmax=%d bin1 batch rel\n" % TL_MAX).encode()
 # Periodic PICO_READY re-emit control
 last_ready_sent = 0.0
 commands_seen = False
+# Sequence checking: the next sequence number expected from the host (None
+# until the first handshake; each host session starts at 0), and whether a
+# command was lost since. Highest sequence number to acknowledge in the current burst.
+expected_seq = None
+seq_lost = False
+ack_seq = None
+
+
+def run_command(cmd, key_to_act, key_label, offset_us):
+    """Applies one decoded command, whether it arrived as text or as a frame."""
+    global tl_len, tl_next, tl_running, tl_start_ns, tl_last_progress
+    if cmd == "tl_down" or cmd == "tl_up":
+        if not key_to_act:
+            print(f"Warning: Key '{key_label}' not found in KEY_MAP.")
+        elif tl_len >= TL_MAX:
+            print("Warning: Timeline full; event dropped.")
+        else:
+            tl_times[tl_len] = offset_us
+            tl_keys[tl_len] = key_to_act
+            tl_press[tl_len] = 1 if cmd == "tl_down" else 0
+            tl_len += 1
+    elif cmd == "tl_clear":
+        tl_running = False
+        tl_len = 0
+        tl_next = 0
+    elif cmd == "tl_start":
+        tl_next = 0
+        tl_start_ns = time.monotonic_ns() + TL_LEAD_NS
+        tl_last_progress = time.monotonic()
+        tl_running = tl_len > 0
+        if not tl_running:
+            try:
+                usb_cdc.data.write(b"TL_DONE 0\n")
+            except Exception:
+                pass
+    elif cmd == "tl_abort":
+        if tl_running:
+            tl_running = False
+            keyboard.release_all()
+            try:
+                usb_cdc.data.write(("TL_ABORTED %d\n" % tl_next).encode())
+            except Exception:
+                pass
+    elif cmd == "release_all":
+        # Also stops device-side playback, so nothing gets pressed again
+        tl_running = False
+        keyboard.release_all()
+    elif cmd == "state":
+        try:
+            usb_cdc.data.write(b"STATE " + binascii.hexlify(pressed_state()) + b"\n")
+        except Exception:
+            pass
+    elif key_to_act:
+        if cmd == "down":
+            keyboard.press(key_to_act)
+        elif cmd == "up":
+            keyboard.release(key_to_act)
+    else:
+        print(f"Warning: Key '{key_label}' not found in KEY_MAP.")
+
+
+def lose_sync():
+    """Reports a lost or corrupt command and stops acting on the stream.
+
+    Cumulative ACKs would otherwise cover the gap, so everything received so
+    far is acknowledged, then "NAK <expected seq>" tells the host which command
+    went missing. Every key is released and further commands are dropped until
+    the host re-synchronises with release_all.
+    """
+    global seq_lost, ack_seq, tl_running
+    if expected_seq is None or seq_lost:
+        return
+    seq_lost = True
+    tl_running = False
+    keyboard.release_all()
+    try:
+        if ack_seq is not None:
+            usb_cdc.data.write(("ACK %d\n" % ack_seq).encode())
+            ack_seq = None
+        usb_cdc.data.write(("NAK %d\n" % expected_seq).encode())
+    except Exception:
+        pass
+    print(f"Warning: Command {expected_seq} lost; waiting for release_all.")
+
+
+def in_sequence(cmd, seq):
+    """Checks a sequenced command against the next expected sequence number.
+
+    Returns:
+        bool: True if the command should be applied and acknowledged.
+    """
+    global expected_seq, seq_lost
+    if cmd == "release_all":
+        # Always runs, and is where the host and device agree on numbering again
+        seq_lost = False
+    elif seq_lost:
+        return False
+    elif expected_seq is not None and seq != expected_seq:
+        lose_sync()
+        return False
+    expected_seq = (seq + 1) & 0xFFFF
+    return True
+
+
+def pressed_state():
+    """Returns the pressed keys as a bitmap: bit i % 8 of byte i // 8 is key id i."""
+    bitmap = bytearray(STATE_BYTES)
+    modifiers = keyboard.report_modifier[0]
+    codes = [0xE0 + bit for bit in range(8) if modifiers & (1 << bit)]
+    codes.extend(code for code in keyboard.report_keys if code)
+    for code in codes:
+        key_id = ID_BY_KEYCODE.get(code)
+        if key_id is not None:
+            bitmap[key_id >> 3] |= 1 << (key_id & 7)
+    return bitmap
+
+
+def apply_batch(changes):
+    """Applies several key changes and sends them to the host as one HID report.
+
+    A chord sent as a batch lands atomically instead of as one report per key.
+    """
+    for change in changes:
+        key_id = change & 0x7F
+        if key_id >= len(KEY_BY_ID):
+            print(f"Warning: Key id {key_id} not found in KEY_BY_ID.")
+            continue
+        if change & BATCH_PRESS:
+            keyboard._add_keycode_to_report(KEY_BY_ID[key_id])
+        else:
+            keyboard._remove_keycode_from_report(KEY_BY_ID[key_id])
+    keyboard._keyboard_device.send_report(keyboard.report)
+
 
 # --- Main Loop ---
 while True:
@@ -117,30 +243,116 @@ while True:
             except Exception:
                 pass
 
-    # Check if there's any data waiting in the DATA USB serial buffer.
-    if usb_cdc.data.in_waiting > 0:
-        # Read available bytes and append to buffer
+    # Fire any due timeline events against the Pico's own clock
+    if tl_running:
+        now_ns = time.monotonic_ns()
+        while tl_next < tl_len and now_ns >= tl_start_ns + tl_times[tl_next] * 1000:
+            if tl_press[tl_next]:
+                keyboard.press(tl_keys[tl_next])
+            else:
+                keyboard.release(tl_keys[tl_next])
+            tl_next += 1
+        try:
+            if tl_next >= tl_len:
+                tl_running = False
+                usb_cdc.data.write(("TL_DONE %d\n" % tl_next).encode())
+            elif (time.monotonic() - tl_last_progress) >= 0.25:
+                usb_cdc.data.write(("TL_PROG %d\n" % tl_next).encode())
+                tl_last_progress = time.monotonic()
+        except Exception:
+            pass
+
+    # Read whatever is waiting on the DATA port straight into the receive buffer.
+    waiting = usb_cdc.data.in_waiting
+    if waiting > 0:
+        if rx_tail + waiting > RX_SIZE and rx_head > 0:
+            # Move the unparsed remainder to the front to make room
+            rx_buf[:rx_tail - rx_head] = rx_buf[rx_head:rx_tail]
+            rx_tail -= rx_head
+            rx_head = 0
+        if rx_tail >= RX_SIZE:
+            print("Warning: Receive buffer full of unparseable data; discarding.")
+            rx_head = 0
+            rx_tail = 0
         try:
-            chunk = usb_cdc.data.read(usb_cdc.data.in_waiting)
+            rx_tail += usb_cdc.data.readinto(rx_view[rx_tail:min(RX_SIZE, rx_tail + waiting)]) or 0
         except Exception:
-            chunk = None
-        if chunk:
-            rx_buffer += chunk
+            pass
+        last_rx = time.monotonic()
 
-        # Process any complete lines
-        while b"\n" in rx_buffer:
-            line, rx_buffer = rx_buffer.split(b"\n", 1)
-            command_line = line.decode("utf-8").strip()
+        # Process any complete frames and lines. Sequenced commands are acknowledged
+        # cumulatively: one "ACK <seq>" covers every command in this burst, and a
+        # gap in the sequence numbers is reported by lose_sync().
+        ack_seq = None
+        while rx_head < rx_tail:
+            if rx_buf[rx_head] == FRAME_SYNC:
+                # Binary frame: wait until it has fully arrived
+                if rx_tail - rx_head < FRAME_HEADER:
+                    break
+                end = rx_head + FRAME_HEADER + rx_buf[rx_head + 4]
+                if rx_tail <= end:
+                    break
+                start = rx_head
+                rx_head = end + 1
+                if (sum(rx_view[start + 1:end]) & 0xFF) != rx_buf[end]:
+                    print("Warning: Dropped frame with bad checksum.")
+                    lose_sync()
+                    continue
+                op = rx_buf[start + 1]
+                if op >= len(FRAME_OPS) or op == 0:
+                    print(f"Warning: Unknown frame opcode {op}.")
+                    lose_sync()
+                    continue
+                seq = rx_buf[start + 2] | (rx_buf[start + 3] << 8)
+                commands_seen = True
+                if not in_sequence(FRAME_OPS[op], seq):
+                    continue
+                if FRAME_OPS[op] == "batch":
+                    apply_batch(rx_view[start + FRAME_HEADER:end])
+                    ack_seq = seq
+                    continue
+                key_to_act = None
+                key_id = -1
+                if end > start + FRAME_HEADER:
+                    key_id = rx_buf[start + 5]
+                    if key_id < len(KEY_BY_ID):
+                        key_to_act = KEY_BY_ID[key_id]
+                offset_us = 0
+                if end >= start + FRAME_HEADER + 5:
+                    offset_us = (rx_buf[start + 6] | (rx_buf[start + 7] << 8)
+                                 | (rx_buf[start + 8] << 16) | (rx_buf[start + 9] << 24))
+                run_command(FRAME_OPS[op], key_to_act, key_id, offset_us)
+                ack_seq = seq
+                continue
+
+            # Text line: look for its end within a bounded window, so a burst
+            # of lines is scanned once instead of re-copied per line.
+            window = bytes(rx_view[rx_head:min(rx_tail, rx_head + MAX_LINE)])
+            newline = window.find(b"\n")
+            if newline < 0:
+                if len(window) >= MAX_LINE:
+                    print("Warning: Discarding over-long command line.")
+                    rx_head += MAX_LINE
+                    continue
+                break
+            command_line = window[:newline].decode("utf-8").strip()
+            rx_head += newline + 1
 
             if command_line:
                 # print(f"Processing: '{command_line}'") # Optional: for debugging
                 try:
-                    command, key_str = command_line.split('|', 1)
-                    cmd = command.strip().lower()
+                    # Format: "<cmd>|<key>" or "<cmd>|<key>|<seq>[|<offset_us>]"
+                    parts = command_line.split('|')
+                    cmd = parts[0].strip().lower()
+                    key_str = parts[1]
                     key_name = key_str.strip().lower()
+                    seq = int(parts[2]) if len(parts) > 2 and parts[2] else None
 
                     # Explicit handshake: respond to HELLO from host on DATA port
                     if cmd == "hello":
+                        # A new host session numbers its commands from 0
+                        expected_seq = 0
+                        seq_lost = False
                         try:
                             usb_cdc.data.write(b"PICO_READY\n")
                             commands_seen = True
@@ -148,18 +360,29 @@ while True:
                             pass
                         continue
 
-                    key_to_act = KEY_MAP.get(key_name)
+                    # Capability query so the host can fall back for older firmware
+                    if cmd == "caps":
+                        try:
+                            usb_cdc.data.write(CAPS_LINE)
+                            commands_seen = True
+                        except Exception:
+                            pass
+                        continue
 
-                    if key_to_act:
-                        if cmd == "down":
-                            keyboard.press(key_to_act)
-                        elif cmd == "up":
-                            keyboard.release(key_to_act)
+                    commands_seen = True
+                    if seq is not None and not in_sequence(cmd, seq):
+                        continue
+                    if cmd == "batch":
+                        # Same payload as the binary frame, hex-encoded
+                        apply_batch(binascii.unhexlify(key_name))
                     else:
-                        print(f"Warning: Key '{key_str}' not found in KEY_MAP.")
+                        offset_us = int(parts[3]) if len(parts) > 3 else 0
+                        run_command(cmd, KEY_MAP.get(key_name), key_str, offset_us)
 
-                    commands_seen = True
-                    # After processing, send an acknowledgement back to the host over DATA port.
+                    if seq is not None:
+                        ack_seq = seq
+                        continue
+                    # Unsequenced (legacy) command: acknowledge it on its own.
                     try:
                         usb_cdc.data.write(b"ACK\n")
                     except Exception:
@@ -167,4 +390,28 @@ while True:
 
                 except (ValueError, IndexError) as e:
                     print(f"Could not parse command: '{command_line}'. Error: {e}")
-    time.sleep(0.01)
+                    lose_sync()
+
+        if rx_head == rx_tail:
+            rx_head = 0
+            rx_tail = 0
+
+        # After processing, send one cumulative acknowledgement back to the host over DATA port.
+        if ack_seq is not None:
+            try:
+                usb_cdc.data.write(("ACK %d\n" % ack_seq).encode())
+            except Exception:
+                pass
+
+    if tl_running:
+        # Sleep only when the next timeline event is comfortably far away;
+        # the last millisecond is spent polling for sub-millisecond accuracy.
+        wait_ns = tl_start_ns + tl_times[tl_next] * 1000 - time.monotonic_ns()
+        if wait_ns > 2000000:
+            time.sleep(min(0.01, (wait_ns - 1000000) / 1e9))
+    elif time.monotonic() - last_rx < BUSY_WINDOW:
+        # Commands are flowing: poll again immediately for the next one
+        idle_sleep = IDLE_SLEEP_MIN
+    else:
+        time.sleep(idle_sleep)
+        idle_sleep = min(IDLE_SLEEP_MAX, idle_sleep * 2)
@@ -0,0 +1,107 @@
+# Shared key table for the binary command protocol.
+#
+# Imported by code.py on the Pico and loaded by picobot.py on the host, so both
+# sides agree on key ids. A key's id is its index in KEYS and is part of the
+# wire format: only ever append new entries, never reorder or remove them.
+#
+# Each entry maps the key name used by the 'keyboard' library to the name of the
+# matching attribute on adafruit_hid.keycode.Keycode.
+KEYS = (
+    # Letters (Lowercase)
+    ('a', 'A'),
+    ('b', 'B'),
+    ('c', 'C'),
+    ('d', 'D'),
+    ('e', 'E'),
+    ('f', 'F'),
+    ('g', 'G'),
+    ('h', 'H'),
+    ('i', 'I'),
+    ('j', 'J'),
+    ('k', 'K'),
+    ('l', 'L'),
+    ('m', 'M'),
+    ('n', 'N'),
+    ('o', 'O'),
+    ('p', 'P'),
+    ('q', 'Q'),
+    ('r', 'R'),
+    ('s', 'S'),
+    ('t', 'T'),
+    ('u', 'U'),
+    ('v', 'V'),
+    ('w', 'W'),
+    ('x', 'X'),
+    ('y', 'Y'),
+    ('z', 'Z'),
+
+    # Numbers (Top Row)
+    ('1', 'ONE'),
+    ('2', 'TWO'),
+    ('3', 'THREE'),
+    ('4', 'FOUR'),
+    ('5', 'FIVE'),
+    ('6', 'SIX'),
+    ('7', 'SEVEN'),
+    ('8', 'EIGHT'),
+    ('9', 'NINE'),
+    ('0', 'ZERO'),
+
+    # Function Keys
+    ('f1', 'F1'),
+    ('f2', 'F2'),
+    ('f3', 'F3'),
+    ('f4', 'F4'),
+    ('f5', 'F5'),
+    ('f6', 'F6'),
+    ('f7', 'F7'),
+    ('f8', 'F8'),
+    ('f9', 'F9'),
+    ('f10', 'F10'),
+    ('f11', 'F11'),
+    ('f12', 'F12'),
+
+    # Punctuation and Symbols
+    ('enter', 'ENTER'),
+    ('esc', 'ESCAPE'),
+    ('backspace', 'BACKSPACE'),
+    ('tab', 'TAB'),
+    ('space', 'SPACE'),
+    ('-', 'MINUS'),
+    ('=', 'EQUALS'),
+    ('[', 'LEFT_BRACKET'),
+    (']', 'RIGHT_BRACKET'),
+    ('\\', 'BACKSLASH'),
+    (';', 'SEMICOLON'),
+    ("'", 'QUOTE'),
+    ('`', 'GRAVE_ACCENT'),
+    (',', 'COMMA'),
+    ('.', 'PERIOD'),
+    ('/', 'FORWARD_SLASH'),
+
+    # Modifier Keys
+    ('caps lock', 'CAPS_LOCK'),
+    ('shift', 'LEFT_SHIFT'),
+    ('ctrl', 'LEFT_CONTROL'),
+    ('alt', 'LEFT_ALT'),
+    ('cmd', 'LEFT_GUI'),
+    ('windows', 'LEFT_GUI'),
+    ('right shift', 'RIGHT_SHIFT'),
+    ('right ctrl', 'RIGHT_CONTROL'),
+    ('right alt', 'RIGHT_ALT'),
+
+    # Navigation and Control Keys
+    ('print screen', 'PRINT_SCREEN'),
+    ('scroll lock', 'SCROLL_LOCK'),
+    ('pause', 'PAUSE'),
+    ('insert', 'INSERT'),
+    ('home', 'HOME'),
+    ('page up', 'PAGE_UP'),
+    ('delete', 'DELETE'),
+    ('end', 'END'),
+    ('page down', 'PAGE_DOWN'),
+    ('right', 'RIGHT_ARROW'),
+    ('left', 'LEFT_ARROW'),
+    ('down', 'DOWN_ARROW'),
+    ('up', 'UP_ARROW'),
+)
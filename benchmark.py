@@ -0,0 +1,260 @@
+"""Benchmarks the host-side serial playback path.
+
+Drives MacroController's streamed playback with synthetic macros at fixed event
+rates plus chord-heavy patterns, against the pty simulator (pico_sim.py) or a
+real Pico, and prints the results as JSON:
+
+    python benchmark.py --rates 1,10,100,1000 --out bench.json
+    python benchmark.py --baseline bench.json   # exit 1 on regression
+
+For each scenario it reports sustained events/s, ACK round-trip p50/p95/p99
+and scheduling lateness.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+
+from picobot import (
+    DEFAULT_ACK_WINDOW,
+    HeadlessApp,
+    MacroController,
+    PicoSession,
+    compile_macro,
+    percentile,
+)
+
+# Keys cycled through by the synthetic macros
+BENCH_KEYS = ("a", "s", "d", "f", "j", "k", "l", "space")
+CHORD_SIZE = 4
+CHORD_HOLD = 0.03
+
+
+class _AlwaysFocused:
+    """Focus watchdog stand-in: benchmarks have no target window."""
+
+    focus_ok = True
+    check_cost = 0.0
+
+
+def rate_events(rate, seconds, min_events=10):
+    """Builds alternating down/up events at a fixed rate.
+
+    Args:
+        rate (float): Events per second.
+        seconds (float): Approximate scenario length.
+        min_events (int): Lower bound on the event count for slow rates.
+
+    Returns:
+        list: Events in parse_macro_file format.
+    """
+    count = max(min_events, int(rate * seconds))
+    count += count % 2  # Every down gets its up
+    events = []
+    for i in range(count):
+        key = BENCH_KEYS[(i // 2) % len(BENCH_KEYS)]
+        events.append({"time": i / rate, "type": "up" if i % 2 else "down", "key": key})
+    return events
+
+
+def chord_events(chords_per_second, seconds, size=CHORD_SIZE, hold=CHORD_HOLD):
+    """Builds chords: ``size`` keys pressed together, held, then released together.
+
+    Args:
+        chords_per_second (float): Chord rate.
+        seconds (float): Approximate scenario length.
+        size (int): Keys per chord.
+        hold (float): Seconds each chord is held, at most half the chord period.
+
+    Returns:
+        list: Events in parse_macro_file format.
+    """
+    hold = min(hold, 0.5 / chords_per_second)  # Released before the next chord
+    events = []
+    for c in range(max(1, int(chords_per_second * seconds))):
+        t = c / chords_per_second
+        keys = [BENCH_KEYS[(c + j) % len(BENCH_KEYS)] for j in range(size)]
+        events.extend({"time": t, "type": "down", "key": k} for k in keys)
+        events.extend({"time": t + hold, "type": "up", "key": k} for k in keys)
+    return events
+
+
+def scenarios(rates, seconds):
+    """Returns (name, target events/s, events) for every benchmark scenario."""
+    result = []
+    for rate in rates:
+        result.append((f"rate_{rate:g}", rate, rate_events(rate, seconds)))
+    for chords in (10, 50):
+        events = chord_events(chords, seconds)
+        result.append((f"chord{CHORD_SIZE}_{chords}", chords * 2 * CHORD_SIZE, events))
+    return result
+
+
+def run_scenario(controller, session, name, target, events, key_log=None):
+    """Plays one synthetic macro and measures it.
+
+    Args:
+        controller (MacroController): Controller whose playback path is measured.
+        session (PicoSession): Connected session to play on.
+        name (str): Scenario name.
+        target (float): Nominal events per second.
+        events (list): The synthetic events.
+        key_log (pico_sim.KeyLog, optional): Simulator log to verify delivery.
+
+    Returns:
+        dict: The scenario's measurements.
+    """
+    macro = compile_macro(name, events)
+    pipeline = session.pipeline
+    pipeline.track_round_trips()
+    applied_before = len(key_log.events) if key_log else 0
+    controller.app.is_playing = True
+    start = time.perf_counter()
+    timing = controller._play_streamed(pipeline, macro, _AlwaysFocused())
+    elapsed = time.perf_counter() - start
+    rtt = pipeline.round_trips
+    result = {
+        "name": name,
+        "target_events_per_s": target,
+        "events": len(macro),
+        "elapsed_s": round(elapsed, 4),
+        "events_per_s": round(timing["events"] / elapsed, 1) if elapsed else 0.0,
+        "ack_rtt_ms": {
+            "p50": round(percentile(rtt, 50) * 1000, 3),
+            "p95": round(percentile(rtt, 95) * 1000, 3),
+            "p99": round(percentile(rtt, 99) * 1000, 3),
+            "max": round(max(rtt, default=0.0) * 1000, 3),
+        },
+        "lateness_ms": {
+            k: round(timing[f"lateness_{k}_ms"], 3)
+            for k in ("mean", "max", "p50", "p95", "p99")
+        },
+        "drift_ms": round(timing["drift_ms"], 3),
+        "error": pipeline.error,
+    }
+    if key_log is not None:
+        result["applied_events"] = len(key_log.events) - applied_before
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Lists scenarios that regressed against a baseline report.
+
+    Args:
+        results (dict): The current report.
+        baseline (dict): A previous report.
+        tolerance (float): Allowed fractional slowdown, e.g. 0.2 for 20%.
+
+    Returns:
+        list: Human-readable regression descriptions; empty if none.
+    """
+    previous = {r["name"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results["results"]:
+        old = previous.get(r["name"])
+        if not old:
+            continue
+        if r["events_per_s"] < old["events_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"{r['name']}: {r['events_per_s']} events/s (was {old['events_per_s']})"
+            )
+        # Sub-millisecond round trips are dominated by noise
+        limit = max(old["ack_rtt_ms"]["p99"] * (1 + tolerance), 1.0)
+        if r["ack_rtt_ms"]["p99"] > limit:
+            regressions.append(
+                f"{r['name']}: ACK p99 {r['ack_rtt_ms']['p99']} ms "
+                f"(was {old['ack_rtt_ms']['p99']})"
+            )
+    return regressions
+
+
+def main(argv=None):
+    """Runs the benchmark suite and prints a JSON report.
+
+    Args:
+        argv (list, optional): Arguments; defaults to ``sys.argv[1:]``.
+
+    Returns:
+        int: 0 on success, 1 on failure or regression.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the serial playback path.")
+    parser.add_argument("--port", help="Real Pico DATA port; default is the simulator.")
+    parser.add_argument("--rates", default="1,10,100,1000", help="Events/s to test.")
+    parser.add_argument("--seconds", type=float, default=2.0, help="Per scenario.")
+    parser.add_argument("--ack-window", type=int, default=DEFAULT_ACK_WINDOW)
+    parser.add_argument("--text-protocol", action="store_true")
+    parser.add_argument(
+        "--service-ms", type=float, default=0.2, help="Simulator time per command."
+    )
+    parser.add_argument("--out", help="Also write the JSON report to this file.")
+    parser.add_argument("--baseline", help="Previous report to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    simulator = None
+    key_log = None
+    port = args.port
+    if not port:
+        import pico_sim
+
+        protocol = pico_sim.PicoProtocol(service_time=args.service_ms / 1000.0)
+        key_log = protocol.key_log
+        simulator = pico_sim.PicoSimulator(protocol)
+        port = simulator.start()
+
+    app = HeadlessApp({"ack_window": args.ack_window})
+    controller = MacroController(app)
+    session = PicoSession(
+        port, ack_window=args.ack_window, binary=not args.text_protocol
+    )
+    try:
+        if not session.connect():
+            print("Could not connect to the Pico.", file=sys.stderr)
+            return 1
+        rates = [float(r) for r in args.rates.split(",") if r.strip()]
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "port": port,
+                "simulated": simulator is not None,
+                "service_ms": args.service_ms if simulator else None,
+                "ack_window": args.ack_window,
+                "caps": sorted(session.caps),
+                "binary": session.pipeline.binary,
+            },
+            "results": [],
+        }
+        for name, target, events in scenarios(rates, args.seconds):
+            result = run_scenario(controller, session, name, target, events, key_log)
+            report["results"].append(result)
+            if result["error"]:
+                break
+    finally:
+        app.is_playing = False
+        session.close()
+        if simulator:
+            simulator.stop()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+
+    failed = any(r["error"] for r in report["results"])
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,212 @@
-import keyboard
+import argparse
+import os
+import queue
+import threading
 import time
 
+import keyboard
+
+from picobot import AutorepeatFilter, collapse_autorepeat, format_macro_line
+
 # --- Configuration ---
 LOG_FILE = f"macro_recording_{int(time.time())}.txt"
+STOP_KEY = "esc"
+# Events waiting for the writer thread; bounds memory however long the session
+QUEUE_SIZE = 10000
+# Most events written per batch, and seconds between fsyncs of the file
+WRITE_BATCH = 256
+FSYNC_INTERVAL = 1.0
+
+
+class StreamingRecorder:
+    """Records keyboard events straight to disk as they happen.
+
+    The keyboard hook only timestamps each event and puts it on a bounded
+    queue; a writer thread appends them to the file in batches and fsyncs it
+    periodically. Memory use stays constant for multi-hour sessions, and a
+    crash loses at most the last second of events. Timestamps are seconds
+    since the recording started, taken from ``time.perf_counter()``.
+    Autorepeat downs of held keys are dropped unless ``keep_repeats`` is set,
+    and keys the keyboard library cannot name are skipped.
+    """
+
+    def __init__(self, path, stop_key=STOP_KEY, keep_repeats=False):
+        """Initializes the recorder without starting it.
+
+        Args:
+            path (str): The macro file to write.
+            stop_key (str): Key that ends the recording; it is never recorded.
+            keep_repeats (bool): Record autorepeat downs as well.
+        """
+        self.path = path
+        self.stop_key = stop_key
+        self.repeat_filter = None if keep_repeats else AutorepeatFilter()
+        self.events = queue.Queue(maxsize=QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.unnamed = 0
+        self._start = 0.0
+        self._writer = None
+        self._hook = None
+
+    def start(self):
+        """Starts the writer thread and hooks the keyboard."""
+        self._start = time.perf_counter()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        self._hook = keyboard.hook(self._on_event)
+
+    def wait(self):
+        """Blocks until the stop key is pressed, then finishes the file."""
+        try:
+            while not self.stopped.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            self.stopped.set()
+        self.stop()
+
+    def stop(self):
+        """Unhooks the keyboard and waits for every queued event to be written."""
+        self.stopped.set()
+        if self._hook is not None:
+            keyboard.unhook(self._hook)
+            self._hook = None
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def _on_event(self, event):
+        """Keyboard hook: timestamps an event and queues it, without blocking."""
+        t = time.perf_counter() - self._start
+        if self.stopped.is_set():
+            return
+        if event.name == self.stop_key:
+            if event.event_type == "down":
+                self.stopped.set()
+            return
+        if not event.name:
+            # Unknown scan code; the Pico could not play it anyway
+            self.unnamed += 1
+            return
+        if self.repeat_filter and not self.repeat_filter.accept(
+            event.event_type, event.name
+        ):
+            return
+        try:
+            self.events.put_nowait((t, event.event_type, event.name))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        """Writer thread: appends queued events in batches until stopped."""
+        with open(self.path, "w") as f:
+            last_sync = time.monotonic()
+            while True:
+                try:
+                    batch = [self.events.get(timeout=0.2)]
+                except queue.Empty:
+                    if self.stopped.is_set():
+                        break
+                    continue
+                while len(batch) < WRITE_BATCH:
+                    try:
+                        batch.append(self.events.get_nowait())
+                    except queue.Empty:
+                        break
+                # Each line will be: seconds_since_start event_type key_name
+                # e.g., 12.345678 down e, or 12.345678 down page down
+                f.write("".join(format_macro_line(*event) for event in batch))
+                f.flush()
+                self.written += len(batch)
+                if time.monotonic() - last_sync >= FSYNC_INTERVAL:
+                    os.fsync(f.fileno())
+                    last_sync = time.monotonic()
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def record_buffered(path, stop_key=STOP_KEY, keep_repeats=False):
+    """Records the whole session in memory and writes it when it ends.
+
+    Args:
+        path (str): The macro file to write.
+        stop_key (str): Key that ends the recording.
+        keep_repeats (bool): Record autorepeat downs as well.
+
+    Returns:
+        tuple: (events written, autorepeat events removed, unnamed keys skipped).
+    """
+    # Record all keyboard events until the stop key is pressed.
+    # The list of events will include the stop key press itself.
+    events = keyboard.record(until=stop_key)
+
+    # The 'record' function stops on the key down event for the stop key,
+    # so the last item in the list is always the press we want to remove.
+    if events:
+        events.pop()
+
+    unnamed = sum(1 for e in events if not e.name)
+    events = [
+        {"time": e.time, "type": e.event_type, "key": e.name} for e in events if e.name
+    ]
+    removed = 0
+    if not keep_repeats:
+        events, removed = collapse_autorepeat(events)
+
+    # Write the filtered events to the log file
+    with open(path, "w") as f:
+        for event in events:
+            # Each line will be: timestamp event_type key_name
+            # e.g., 16612345.678000 down e
+            f.write(format_macro_line(event["time"], event["type"], event["key"]))
+    return len(events), removed, unnamed
+
+
+def main(argv=None):
+    """Records a macro until the stop key is pressed.
+
+    Args:
+        argv (list, optional): Arguments; defaults to the command line.
+    """
+    parser = argparse.ArgumentParser(description="Record a keyboard macro.")
+    parser.add_argument("--output", default=LOG_FILE, help="Macro file to write.")
+    parser.add_argument("--stop-key", default=STOP_KEY, help="Key that stops it.")
+    parser.add_argument(
+        "--buffered",
+        action="store_true",
+        help="Keep the session in memory and write it at the end (old behaviour).",
+    )
+    parser.add_argument(
+        "--keep-repeats",
+        action="store_true",
+        help="Also record the repeated downs of held keys.",
+    )
+    args = parser.parse_args(argv)
+
+    print(f"High-fidelity keylogger started. Recording to '{args.output}'.")
+    print(f"Press '{args.stop_key}' to stop the logger.")
+
+    if args.buffered:
+        count, removed, unnamed = record_buffered(
+            args.output, args.stop_key, args.keep_repeats
+        )
+    else:
+        recorder = StreamingRecorder(args.output, args.stop_key, args.keep_repeats)
+        recorder.start()
+        recorder.wait()
+        count = recorder.written
+        removed = recorder.repeat_filter.removed if recorder.repeat_filter else 0
+        unnamed = recorder.unnamed
+        if recorder.dropped:
+            print(f"Warning: {recorder.dropped} events were dropped (writer fell behind).")
+
+    if removed:
+        print(f"Removed {removed} autorepeat events of held keys.")
+    if unnamed:
+        print(f"Skipped {unnamed} events of keys without a name.")
+    print(f"Logger stopped. {count} events saved to '{args.output}'.")
+
 
-print(f"High-fidelity keylogger started. Recording to '{LOG_FILE}'.")
-print("Press and hold 'Esc' for a moment to stop the logger.")
-
-# --- Main Program ---
-# Record all keyboard events until the 'Esc' key is pressed.
-# The list of events will include the 'esc' press itself.
-events = keyboard.record(until='esc')
-
-# --- NEW: Filter out the final 'esc' event ---
-# The 'record' function stops on the key down event for 'esc',
-# so the last item in the list is always the 'esc' press we want to remove.
-if events:
-    # This removes the last event from the list, which is the 'esc' press.
-    events.pop()
-
-# Write the filtered events to the log file
-with open(LOG_FILE, "w") as f:
-    for event in events:
-        # Each line will be: timestamp event_type key_name
-        # e.g., 16612345.678 down e
-        f.write(f"{event.time} {event.event_type} {event.name}\n")
-
-print(f"Logger stopped. Macro saved to '{LOG_FILE}'.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
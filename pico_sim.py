@@ -0,0 +1,545 @@
+"""Host-side stand-in for a Pico running CIRCUITPY/code.py.
+
+Speaks the same DATA-port protocol as the firmware (PICO_READY, hello, caps,
+sequenced text commands with cumulative ACKs and NAKs, binary frames and the
+device timeline) over a pseudo-terminal, so picobot.py can be exercised and measured
+without hardware. Every applied key event is logged with a timestamp.
+
+Usage (Linux/macOS):
+    python pico_sim.py --service-ms 0.5 --loss 0.01 --log keys.tsv --console
+
+then point picobot at the printed /dev/pts/N path.
+"""
+
+import argparse
+import logging
+import os
+import random
+import select
+import sys
+import threading
+import time
+
+from picobot import BATCH_PRESS, FRAME_OPS, FRAME_SYNC, load_key_ids
+
+# Mirrors CIRCUITPY/code.py
+FRAME_HEADER = 5
+TL_MAX = 2048
+TL_LEAD = 0.02
+CAPS_LINE = b"CAPS seq tl tlmax=%d bin1 batch rel\n" % TL_MAX
+READY_INTERVAL = 1.0
+CONSOLE_BANNER = (
+    b"Adafruit CircuitPython 9.0.0 on 2024-03-19; Raspberry Pi Pico with rp2040\r\n"
+    b">>> "
+)
+
+# How the simulated port behaves:
+#   data    - the current firmware's DATA port
+#   legacy  - firmware before sequence numbers: plain "ACK" per command, no
+#             caps or binary frames
+#   console - the CircuitPython REPL port, which never says PICO_READY
+PERSONALITIES = ("data", "legacy", "console")
+
+
+class KeyLog:
+    """Records applied key events as (seconds since start, action, key) rows.
+
+    Rows are kept in memory and, if a path is given, appended to a tab-separated
+    file as they happen.
+    """
+
+    def __init__(self, path=None, clock=time.perf_counter):
+        """Initializes the log.
+
+        Args:
+            path (str, optional): File to write rows to.
+            clock (callable): Time source; the first row is relative to creation.
+        """
+        self.clock = clock
+        self.start = clock()
+        self.events = []
+        self._file = open(path, "w", buffering=1) if path else None
+        if self._file:
+            self._file.write("t_s\taction\tkey\n")
+
+    def record(self, action, key):
+        """Appends one applied key event."""
+        t = self.clock() - self.start
+        self.events.append((t, action, key))
+        if self._file:
+            self._file.write(f"{t:.6f}\t{action}\t{key}\n")
+
+    def close(self):
+        """Closes the log file, if any."""
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class PicoProtocol:
+    """Transport-independent model of the code.py command loop.
+
+    ``receive`` takes bytes written by the host and returns the bytes the device
+    would answer with; ``poll`` fires due timeline events. Faults are applied per
+    decoded command: ``loss`` drops it as if it never arrived (no key event, no
+    ACK of its own), ``reorder`` applies it after the command that follows it.
+    As on the firmware, the resulting gap in sequence numbers is answered with
+    ``NAK <expected seq>`` and later commands are dropped until ``release_all``.
+    """
+
+    def __init__(
+        self,
+        personality="data",
+        service_time=0.0,
+        loss=0.0,
+        reorder=0.0,
+        key_log=None,
+        seed=None,
+        clock=time.perf_counter,
+        sleep=time.sleep,
+    ):
+        """Initializes the simulated device.
+
+        Args:
+            personality (str): One of PERSONALITIES.
+            service_time (float): Seconds spent applying each command.
+            loss (float): Probability that a command is silently dropped.
+            reorder (float): Probability that a command swaps with the next one.
+            key_log (KeyLog, optional): Where applied key events are recorded.
+            seed (int, optional): Seed for the fault generator.
+            clock (callable): Time source in seconds.
+            sleep (callable): Called with ``service_time`` per command.
+        """
+        if personality not in PERSONALITIES:
+            raise ValueError(f"Unknown personality '{personality}'")
+        self.personality = personality
+        self.service_time = service_time
+        self.loss = loss
+        self.reorder = reorder
+        self.key_log = key_log or KeyLog(clock=clock)
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.sleep = sleep
+        self.key_ids = load_key_ids()
+        self.key_names = {key_id: name for name, key_id in self.key_ids.items()}
+        self.frame_names = {op: name for name, op in FRAME_OPS.items()}
+        self.pressed = set()
+        self.commands_seen = False
+        self.expected_seq = None
+        self.seq_lost = False
+        self.last_ready_sent = None
+        self.stats = {
+            "commands": 0,
+            "lost": 0,
+            "reordered": 0,
+            "bad_frames": 0,
+            "naks": 0,
+            "reports": 0,  # HID reports sent to the host
+        }
+        self._rx = b""
+        self._ack_seq = None
+        self._held = None
+        # Device timeline: (offset_s, action, key) rows, fired after tl_start
+        self._timeline = []
+        self._tl_next = 0
+        self._tl_start = None
+        self._tl_last_progress = 0.0
+
+    def greeting(self):
+        """Returns what the device prints when the host opens the port."""
+        if self.personality == "console":
+            return CONSOLE_BANNER
+        self.last_ready_sent = self.clock()
+        return b"PICO_READY\n"
+
+    def receive(self, data):
+        """Processes bytes from the host.
+
+        Args:
+            data (bytes): Raw bytes written by the host.
+
+        Returns:
+            bytes: The device's reply, possibly empty.
+        """
+        if self.personality == "console":
+            # The REPL echoes and prompts; it never runs commands.
+            return data.replace(b"\n", b"\r\n") + b">>> " if b"\n" in data else data
+        self._rx += data
+        out = []
+        commands = self._decode(out)
+        self._ack_seq = None
+        for cmd, key, seq, offset_us in self._shuffle(commands):
+            if cmd is None:
+                self._lose_sync(out)  # Corrupt frame or line
+                continue
+            self.stats["commands"] += 1
+            self.commands_seen = True
+            if self.personality == "legacy" or seq is None:
+                self._run(cmd, key, offset_us, out)
+                out.append(b"ACK\n")
+            elif self._in_sequence(cmd, seq, out):
+                self._run(cmd, key, offset_us, out)
+                self._ack_seq = seq
+        if self._ack_seq is not None:
+            out.append(b"ACK %d\n" % self._ack_seq)
+        return b"".join(out)
+
+    def _run(self, cmd, key, offset_us, out):
+        if self.service_time:
+            self.sleep(self.service_time)
+        self._apply(cmd, key, offset_us, out)
+
+    def _in_sequence(self, cmd, seq, out):
+        """Checks a sequenced command against the next expected number, as code.py."""
+        if cmd == "release_all":
+            self.seq_lost = False
+        elif self.seq_lost:
+            return False
+        elif self.expected_seq is not None and seq != self.expected_seq:
+            self._lose_sync(out)
+            return False
+        self.expected_seq = (seq + 1) & 0xFFFF
+        return True
+
+    def _lose_sync(self, out):
+        """Acknowledges what arrived, sends NAK and releases every key, as code.py."""
+        if self.expected_seq is None or self.seq_lost:
+            return
+        self.seq_lost = True
+        self.stats["naks"] += 1
+        self._tl_start = None
+        self.release_all()
+        if self._ack_seq is not None:
+            out.append(b"ACK %d\n" % self._ack_seq)
+            self._ack_seq = None
+        out.append(b"NAK %d\n" % self.expected_seq)
+
+    def poll(self):
+        """Fires due timeline events and periodic PICO_READY lines.
+
+        Returns:
+            tuple: (bytes to send to the host, seconds until poll is next needed
+            or None if nothing is scheduled).
+        """
+        out = []
+        now = self.clock()
+        wait = None
+        if self.personality != "console" and not self.commands_seen:
+            if (
+                self.last_ready_sent is None
+                or now - self.last_ready_sent >= READY_INTERVAL
+            ):
+                out.append(b"PICO_READY\n")
+                self.last_ready_sent = now
+            wait = self.last_ready_sent + READY_INTERVAL - now
+        if self._tl_start is not None:
+            timeline = self._timeline
+            while (
+                self._tl_next < len(timeline)
+                and now >= self._tl_start + timeline[self._tl_next][0]
+            ):
+                _, action, key = timeline[self._tl_next]
+                self._press(action, key)
+                self.stats["reports"] += 1
+                self._tl_next += 1
+            if self._tl_next >= len(timeline):
+                self._tl_start = None
+                out.append(b"TL_DONE %d\n" % self._tl_next)
+            else:
+                if now - self._tl_last_progress >= 0.25:
+                    out.append(b"TL_PROG %d\n" % self._tl_next)
+                    self._tl_last_progress = now
+                due = self._tl_start + timeline[self._tl_next][0] - now
+                wait = due if wait is None else min(wait, due)
+        return b"".join(out), wait
+
+    def _decode(self, out):
+        """Splits buffered input into (cmd, key, seq, offset_us) commands.
+
+        Handshake and capability queries are answered directly into ``out``.
+        """
+        commands = []
+        rx = self._rx
+        while rx:
+            if rx[0] == FRAME_SYNC and self.personality == "data":
+                if len(rx) < FRAME_HEADER:
+                    break
+                end = FRAME_HEADER + rx[4]
+                if len(rx) <= end:
+                    break
+                frame, rx = rx[: end + 1], rx[end + 1 :]
+                cmd = self.frame_names.get(frame[1])
+                if (sum(frame[1:end]) & 0xFF) != frame[end] or cmd is None:
+                    self.stats["bad_frames"] += 1
+                    commands.append((None, None, None, 0))
+                    continue
+                if cmd == "batch":
+                    key = frame[FRAME_HEADER:end]
+                elif end > FRAME_HEADER:
+                    key = self.key_names.get(frame[5], frame[5])
+                else:
+                    key = ""
+                offset_us = 0
+                if end >= FRAME_HEADER + 5:
+                    offset_us = int.from_bytes(frame[6:10], "little")
+                commands.append((cmd, key, frame[2] | (frame[3] << 8), offset_us))
+                continue
+            newline = rx.find(b"\n")
+            if newline < 0:
+                break
+            line, rx = rx[:newline], rx[newline + 1 :]
+            parts = line.decode("utf-8", errors="ignore").strip().split("|")
+            if len(parts) < 2:
+                continue
+            cmd = parts[0].strip().lower()
+            if cmd == "hello":
+                self.commands_seen = True
+                self.expected_seq = 0  # A new host session numbers from 0
+                self.seq_lost = False
+                out.append(b"PICO_READY\n")
+                continue
+            if cmd == "caps":
+                self.commands_seen = True
+                out.append(CAPS_LINE if self.personality == "data" else b"ACK\n")
+                continue
+            try:
+                seq = int(parts[2]) if len(parts) > 2 and parts[2] else None
+                offset_us = int(parts[3]) if len(parts) > 3 else 0
+            except ValueError:
+                logging.warning(f"Could not parse command: '{line!r}'")
+                commands.append((None, None, None, 0))
+                continue
+            key = parts[1].strip().lower()
+            if cmd == "batch":
+                try:
+                    key = bytes.fromhex(key)
+                except ValueError:
+                    logging.warning(f"Could not parse command: '{line!r}'")
+                    commands.append((None, None, None, 0))
+                    continue
+            commands.append((cmd, key, seq, offset_us))
+        self._rx = rx
+        return commands
+
+    def _shuffle(self, commands):
+        """Applies the configured loss and reordering to decoded commands."""
+        for command in commands:
+            if command[0] is None:
+                yield command
+                continue
+            if self.loss and self.random.random() < self.loss:
+                self.stats["lost"] += 1
+                continue
+            if self._held is not None:
+                held, self._held = self._held, None
+                yield command
+                yield held
+                continue
+            if self.reorder and self.random.random() < self.reorder:
+                self.stats["reordered"] += 1
+                self._held = command
+                continue
+            yield command
+        if self._held is not None:
+            # Nothing followed it in this burst; apply it rather than stall.
+            held, self._held = self._held, None
+            yield held
+
+    def _apply(self, cmd, key, offset_us, out):
+        """Applies one command, as code.py run_command does."""
+        if cmd in ("tl_down", "tl_up"):
+            if len(self._timeline) < TL_MAX:
+                self._timeline.append((offset_us / 1e6, cmd[3:], key))
+        elif cmd == "tl_clear":
+            self._timeline = []
+            self._tl_start = None
+        elif cmd == "tl_start":
+            self._tl_next = 0
+            self._tl_start = self.clock() + TL_LEAD
+            self._tl_last_progress = self.clock()
+            if not self._timeline:
+                self._tl_start = None
+                out.append(b"TL_DONE 0\n")
+        elif cmd == "tl_abort":
+            if self._tl_start is not None:
+                self._tl_start = None
+                self.release_all()
+                out.append(b"TL_ABORTED %d\n" % self._tl_next)
+        elif cmd in ("down", "up"):
+            self._press(cmd, key)
+            self.stats["reports"] += 1
+        elif cmd == "batch":
+            for change in key:
+                key_id = change & ~BATCH_PRESS
+                action = "down" if change & BATCH_PRESS else "up"
+                self._press(action, self.key_names.get(key_id, key_id))
+            self.stats["reports"] += 1
+        elif cmd == "release_all":
+            self._tl_start = None
+            self.release_all()
+        elif cmd == "state":
+            out.append(b"STATE %s\n" % self.state_bitmap().hex().encode())
+        else:
+            logging.warning(f"Unknown command '{cmd}'")
+
+    def _press(self, action, key):
+        """Updates the simulated HID state and logs the event."""
+        if action == "down":
+            self.pressed.add(key)
+        else:
+            self.pressed.discard(key)
+        self.key_log.record(action, key)
+
+    def state_bitmap(self):
+        """Returns the pressed keys as code.py's STATE bitmap (bit i = key id i)."""
+        bitmap = bytearray((len(self.key_ids) + 7) // 8)
+        for key in self.pressed:
+            key_id = key if isinstance(key, int) else self.key_ids.get(key)
+            if key_id is not None and key_id < len(bitmap) * 8:
+                bitmap[key_id >> 3] |= 1 << (key_id & 7)
+        return bytes(bitmap)
+
+    def release_all(self):
+        """Releases every pressed key, logging each release."""
+        for key in sorted(self.pressed, key=str):
+            self._press("up", key)
+        self.stats["reports"] += 1
+
+
+class PicoSimulator:
+    """Serves a PicoProtocol on a pseudo-terminal from a background thread."""
+
+    def __init__(self, protocol):
+        """Initializes the simulator.
+
+        Args:
+            protocol (PicoProtocol): The simulated device.
+        """
+        self.protocol = protocol
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Opens the pty and starts serving it.
+
+        Returns:
+            str: Path of the pty to open as the serial port.
+        """
+        import pty
+        import tty
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        """Stops serving and closes the pty."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _run(self):
+        """Pumps bytes between the pty and the protocol until stopped."""
+        self._write(self.protocol.greeting())
+        while not self._stop.is_set():
+            out, wait = self.protocol.poll()
+            self._write(out)
+            timeout = 0.05 if wait is None else max(0.0, min(wait, 0.05))
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            self._write(self.protocol.receive(data))
+
+    def _write(self, data):
+        """Writes device output to the host side of the pty."""
+        while data:
+            try:
+                data = data[os.write(self._master, data) :]
+            except OSError:
+                return
+
+
+def main(argv=None):
+    """Runs the simulator until interrupted.
+
+    Args:
+        argv (list, optional): Arguments; defaults to ``sys.argv[1:]``.
+
+    Returns:
+        int: Process exit code.
+    """
+    parser = argparse.ArgumentParser(description="Simulated Pico DATA port on a pty.")
+    parser.add_argument("--personality", choices=PERSONALITIES, default="data")
+    parser.add_argument(
+        "--service-ms", type=float, default=0.0, help="Time spent per command."
+    )
+    parser.add_argument(
+        "--loss", type=float, default=0.0, help="Probability a command is dropped."
+    )
+    parser.add_argument(
+        "--reorder",
+        type=float,
+        default=0.0,
+        help="Probability a command is applied after the next one.",
+    )
+    parser.add_argument("--seed", type=int, help="Seed for loss and reordering.")
+    parser.add_argument("--log", help="Tab-separated file for applied key events.")
+    parser.add_argument(
+        "--console",
+        action="store_true",
+        help="Also expose a REPL console port, as a real Pico does.",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    key_log = KeyLog(args.log)
+    simulators = []
+    if args.console:
+        simulators.append(PicoSimulator(PicoProtocol("console")))
+    simulators.append(
+        PicoSimulator(
+            PicoProtocol(
+                args.personality,
+                service_time=args.service_ms / 1000.0,
+                loss=args.loss,
+                reorder=args.reorder,
+                key_log=key_log,
+                seed=args.seed,
+            )
+        )
+    )
+    for simulator in simulators:
+        port = simulator.start()
+        print(f"{simulator.protocol.personality} port: {port}", flush=True)
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+        key_log.close()
+        data = simulators[-1].protocol
+        print(f"{len(key_log.events)} key events; {data.stats}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
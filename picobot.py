@@ -1,66 +1,2653 @@
+import time
+
+_MODULE_LOAD_START = time.perf_counter()
+
+import collections
+import concurrent.futures
+import csv
+import ctypes
+import hashlib
+import importlib
+import importlib.util
 import json
 import logging
+import math
 import os
+import pickle
+import queue
 import random
+import struct
+import sys
 import threading
-import time
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+from array import array
+
+if __name__ == "__main__":
+    # pico_sim and benchmark import this file as "picobot"; let them share the
+    # running copy instead of loading a second one
+    sys.modules.setdefault("picobot", sys.modules[__name__])
+
+
+class _LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    GUI, network and window-management modules are comparatively slow to
+    import, and the headless runner never touches some of them, so they are
+    only loaded when first used.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+asyncio = _LazyModule("asyncio")
+tk = _LazyModule("tkinter")
+filedialog = _LazyModule("tkinter.filedialog")
+messagebox = _LazyModule("tkinter.messagebox")
+ttk = _LazyModule("tkinter.ttk")
+gw = _LazyModule("pygetwindow")
+requests = _LazyModule("requests")
+serial = _LazyModule("serial")
+sqlite3 = _LazyModule("sqlite3")
+list_ports = _LazyModule("serial.tools.list_ports")
+
+# --- Configuration File ---
+CONFIG_FILE = "config.json"
+# Last known-good Pico DATA port, keyed by USB identity
+PORT_CACHE_FILE = "port_cache.json"
+# Budget for the headless runner to go from loading this module to ready to
+# open the Pico port, checked on every `python -m picobot run`. Port discovery
+# is timed and logged separately.
+COLD_START_TARGET_MS = 250
+
+# --- Telegram Notifications ---
+TELEGRAM_API_URL = "https://api.telegram.org"
+# Messages waiting for the sender thread; more are dropped with a warning
+TELEGRAM_QUEUE_SIZE = 32
+# (connect, read) timeouts in seconds for each API request
+TELEGRAM_TIMEOUT = (3.05, 10.0)
+# Attempts per message, with exponential backoff from TELEGRAM_BACKOFF seconds
+TELEGRAM_MAX_ATTEMPTS = 4
+TELEGRAM_BACKOFF = 1.0
+# Telegram allows about one message per second to the same chat
+TELEGRAM_MIN_INTERVAL = 1.0
+# Playback events that can be notified, selected with "notify_events"
+NOTIFY_EVENTS = ("ack_timeout", "focus_lost", "stopped")
+
+# --- Compiled Macro Cache ---
+MACRO_CACHE_DIR = "macro_cache"
+# Bump when CompiledMacro's layout or the parser changes so stale cache
+# files are ignored
+MACRO_CACHE_VERSION = 5
+# Events this close to the first key change of a chord are sent with it as
+# one batch (seconds; 0 merges only identical timestamps)
+DEFAULT_CHORD_TOLERANCE = 0.005
+# Playlist macros loaded ahead of the one playing
+DEFAULT_PREFETCH_DEPTH = 2
+
+# --- Macro Catalog ---
+CATALOG_FILE = "macro_catalog.sqlite3"
+# Bump when the catalog schema changes; the table is then rebuilt
+CATALOG_VERSION = 2
+
+# --- Pico Command Protocol ---
+# Sequence numbers wrap at 16 bits; ACKs from the Pico are cumulative.
+SEQ_MODULO = 1 << 16
+# Default number of unacknowledged commands allowed in flight.
+DEFAULT_ACK_WINDOW = 16
+# Seconds before a deadline at which the scheduler stops sleeping and spins.
+# Higher values trade CPU time for precision; 0 disables spinning.
+DEFAULT_SPIN_THRESHOLD = 0.002
+# While commands await an ACK, the scheduler wakes this often to read them.
+ACK_POLL_INTERVAL = 0.001
+# Event.wait can wake this much late on Windows (one 15.6 ms timer tick), so
+# the scheduler only uses it until this long before the spin phase and covers
+# the rest with high-resolution time.sleep slices (Python 3.11+ on Windows).
+COARSE_WAIT_SLACK = 0.016
+# Seconds between focus checks by the background watchdog
+DEFAULT_FOCUS_INTERVAL = 0.05
+# Seconds between "Status: Playing" updates while a run is active
+STATUS_UPDATE_INTERVAL = 1.0
+# Seconds without a TL_PROG/TL_DONE report before device-side playback is presumed lost.
+TIMELINE_HEARTBEAT_TIMEOUT = 2.0
+# Timeline offsets travel as unsigned 32-bit microseconds (about 71.6 minutes);
+# longer macros are streamed from the host instead.
+TIMELINE_MAX_OFFSET = 0xFFFFFFFF / 1_000_000
+
+# --- Binary Framing (must match CIRCUITPY/code.py) ---
+# SYNC | OP | SEQ_LO | SEQ_HI | LEN | PAYLOAD[LEN] | CHK
+FRAME_SYNC = 0xB1  # 0xB0 | protocol version 1
+FRAME_OPS = {
+    "down": 1,
+    "up": 2,
+    "tl_down": 3,
+    "tl_up": 4,
+    "tl_clear": 5,
+    "tl_start": 6,
+    "tl_abort": 7,
+    "batch": 8,
+    "release_all": 9,
+    "state": 10,
+}
+# Batch payload: one byte per key change, the key id with this bit set for a press
+BATCH_PRESS = 0x80
+# Longest text line the Pico reads, newline included (MAX_LINE in code.py)
+TEXT_MAX_LINE = 64
+# Key table shared with the Pico; a key's id is its index in KEYS
+KEY_TABLE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "CIRCUITPY", "keytable.py"
+)
+_key_ids = None
+_compiler_signature = None
+
+
+def load_key_ids():
+    """Loads the key-name to key-id mapping shared with the Pico firmware.
+
+    Returns:
+        dict: Mapping of key names (as recorded by the keyboard library) to ids.
+    """
+    global _key_ids
+    if _key_ids is None:
+        spec = importlib.util.spec_from_file_location("keytable", KEY_TABLE_FILE)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _key_ids = {name: key_id for key_id, (name, _) in enumerate(module.KEYS)}
+    return _key_ids
+
+
+def compiler_signature():
+    """Identifies the compiler and key table a compiled macro depends on.
+
+    Stored with cached macros and catalog validity, so either is redone when
+    MACRO_CACHE_VERSION is bumped or a key is added to the key table.
+
+    Returns:
+        str: The signature.
+    """
+    global _compiler_signature
+    if _compiler_signature is None:
+        table = repr(sorted(load_key_ids().items())).encode("utf-8")
+        _compiler_signature = (
+            f"{MACRO_CACHE_VERSION}:{hashlib.sha1(table).hexdigest()[:16]}"
+        )
+    return _compiler_signature
+
+
+def encode_frame(op, seq, payload=b""):
+    """Builds one binary command frame.
+
+    Args:
+        op (int): The opcode, a value from FRAME_OPS.
+        seq (int): The sequence number; only the low 16 bits are sent.
+        payload (bytes): Opcode-specific payload, at most 255 bytes.
+
+    Returns:
+        bytes: The encoded frame including sync byte and checksum.
+    """
+    body = bytes((op, seq & 0xFF, (seq >> 8) & 0xFF, len(payload))) + payload
+    return bytes((FRAME_SYNC,)) + body + bytes((sum(body) & 0xFF,))
+
+
+def percentile(values, q):
+    """Returns the ``q``-th percentile (0-100) of ``values`` by nearest rank.
+
+    Args:
+        values (sequence): The samples; need not be sorted.
+        q (float): The percentile to return.
+
+    Returns:
+        float: The percentile, or 0.0 for no samples.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(round(q / 100.0 * (len(ordered) - 1)))
+    return ordered[min(len(ordered) - 1, max(0, rank))]
+
+
+# A command encoded up to, but not including, its sequence number. For frames,
+# ``op`` is set, ``head`` is the payload and ``checksum`` covers everything but
+# the sequence bytes. For text, ``op`` is None and the sequence number goes
+# between ``head`` and ``tail``.
+PreparedCommand = collections.namedtuple(
+    "PreparedCommand", ["op", "head", "tail", "checksum"]
+)
+
+
+def prepare_command(event_type, key, fields=(), key_ids=None):
+    """Pre-encodes a command so sending it only has to add a sequence number.
+
+    Binary frames carry the key id and any integer fields as little-endian u32
+    values. Commands that have no frame form, such as a key missing from the
+    shared key table, fall back to a text line, which the Pico accepts on the
+    same port.
+
+    Args:
+        event_type (str): The command, e.g. "down", "up" or "tl_down".
+        key (str): The key name, or "-" for commands without a key.
+        fields (tuple): Extra integer fields, e.g. a timeline offset in microseconds.
+        key_ids (dict, optional): Key table from load_key_ids(); None for text.
+
+    Returns:
+        PreparedCommand: The pre-encoded command.
+    """
+    if key_ids is not None and event_type in FRAME_OPS:
+        key_id = None if key == "-" else key_ids.get(key.lower())
+        if key == "-" or key_id is not None:
+            payload = b"" if key_id is None else bytes((key_id,))
+            payload += b"".join(struct.pack("<I", int(f)) for f in fields)
+            op = FRAME_OPS[event_type]
+            return PreparedCommand(
+                op, payload, b"", (op + len(payload) + sum(payload)) & 0xFF
+            )
+    tail = "".join(f"|{f}" for f in fields) + "\n"
+    return PreparedCommand(
+        None, f"{event_type}|{key}|".encode("utf-8"), tail.encode("utf-8"), 0
+    )
+
+
+def prepare_batch(changes, key_ids, binary):
+    """Pre-encodes several key changes the Pico applies as one HID report.
+
+    The payload is one byte per change (key id, plus BATCH_PRESS for a press).
+    Text lines carry the same bytes in hex as ``batch|<hex>|<seq>``, so they
+    hold fewer changes than a frame: the line must fit in TEXT_MAX_LINE.
+
+    Args:
+        changes (list): (is_down, key name) pairs.
+        key_ids (dict): Key table from load_key_ids().
+        binary (bool): Encode as a binary frame instead of a text line.
+
+    Returns:
+        PreparedCommand or None: The command, or None if a key has no id, a
+            key changes twice (the second change would be lost in one report)
+            or there are too many changes for one command.
+    """
+    payload = bytearray()
+    seen = set()
+    for is_down, key in changes:
+        key_id = key_ids.get(key.lower())
+        if key_id is None or key_id >= BATCH_PRESS or key_id in seen:
+            return None
+        seen.add(key_id)
+        payload.append(key_id | BATCH_PRESS if is_down else key_id)
+    # Text: "batch|" + two hex digits per change + "|65535" + newline
+    limit = 255 if binary else (TEXT_MAX_LINE - len("batch||65535\n")) // 2
+    if not payload or len(payload) > limit:
+        return None
+    payload = bytes(payload)
+    if binary:
+        op = FRAME_OPS["batch"]
+        return PreparedCommand(
+            op, payload, b"", (op + len(payload) + sum(payload)) & 0xFF
+        )
+    return PreparedCommand(None, f"batch|{payload.hex()}|".encode("ascii"), b"\n", 0)
+
+
+def decode_key_state(bitmap_hex):
+    """Decodes the Pico's ``STATE`` reply into the names of the pressed keys.
+
+    Args:
+        bitmap_hex (str): Hex bitmap; bit ``i % 8`` of byte ``i // 8`` is key id ``i``.
+
+    Returns:
+        set: Names of the keys reported pressed.
+    """
+    names = {key_id: name for name, key_id in load_key_ids().items()}
+    bitmap = bytes.fromhex(bitmap_hex)
+    return {
+        names.get(key_id, str(key_id))
+        for key_id in range(len(bitmap) * 8)
+        if bitmap[key_id >> 3] & (1 << (key_id & 7))
+    }
+
+
+class TelegramHandler:
+    """Handles sending messages via Telegram API.
+
+    ``send_message`` never blocks: messages go onto a bounded queue served by
+    one sender thread, started on first use. The sender reuses a single
+    ``requests.Session`` (keep-alive, so one TLS handshake for many messages),
+    applies explicit timeouts, retries network errors, 5xx and 429 replies
+    with exponential backoff (honouring Telegram's ``retry_after``), and spaces
+    messages at least ``min_interval`` apart.
+    """
+
+    def __init__(
+        self,
+        bot_token,
+        chat_id,
+        api_url=TELEGRAM_API_URL,
+        queue_size=TELEGRAM_QUEUE_SIZE,
+        timeout=TELEGRAM_TIMEOUT,
+        max_attempts=TELEGRAM_MAX_ATTEMPTS,
+        backoff=TELEGRAM_BACKOFF,
+        min_interval=TELEGRAM_MIN_INTERVAL,
+    ):
+        """Initializes the Telegram handler with bot token and chat ID.
+
+        Args:
+            bot_token (str): The Telegram bot token for authentication.
+            chat_id (str): The chat ID where messages will be sent.
+            api_url (str): Base URL of the Bot API, e.g. a local stand-in.
+            queue_size (int): Messages that may wait to be sent.
+            timeout (tuple): (connect, read) timeout of each request in seconds.
+            max_attempts (int): Attempts per message before it is dropped.
+            backoff (float): Seconds before the first retry; doubled each time.
+            min_interval (float): Minimum seconds between two messages.
+        """
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.min_interval = min_interval
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._session = None
+        self._last_sent = 0.0
+
+    @property
+    def configured(self):
+        """bool: Whether a bot token and chat ID are set."""
+        return bool(self.bot_token and self.chat_id)
+
+    def send_message(self, text):
+        """Queues a message for the configured Telegram chat without blocking.
+
+        Args:
+            text (str): The message text to send.
+
+        Returns:
+            bool: True if the message was queued.
+        """
+        if not self.configured or self._closed.is_set():
+            return False
+        try:
+            # Credentials are captured now, in case the settings change later
+            self._queue.put_nowait((self.bot_token, self.chat_id, text))
+        except queue.Full:
+            self.dropped += 1
+            logging.warning("Telegram queue is full; message dropped.")
+            return False
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="picobot-telegram", daemon=True
+                )
+                self._thread.start()
+        return True
+
+    def flush(self, timeout=None):
+        """Waits until every queued message has been sent or given up on.
+
+        Args:
+            timeout (float, optional): Maximum seconds to wait.
+
+        Returns:
+            bool: True if the queue was drained in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=5.0):
+        """Sends what is queued (for up to ``timeout`` seconds) and stops the sender.
+
+        Returns:
+            bool: True if every queued message was handled.
+        """
+        drained = self.flush(timeout)
+        self._closed.set()
+        if self._session is not None:
+            self._session.close()
+        return drained
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                bot_token, chat_id, text = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                if self._deliver(bot_token, chat_id, text):
+                    self.sent += 1
+                    logging.info("Telegram message sent successfully.")
+                else:
+                    self.failed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Error sending Telegram message: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, bot_token, chat_id, text):
+        """Sends one message, retrying transient failures.
+
+        Returns:
+            bool: True once the API accepted the message.
+        """
+        if self._session is None:
+            self._session = requests.Session()
+        url = f"{self.api_url}/bot{bot_token}/sendMessage"
+        params = {"chat_id": chat_id, "text": text}
+        delay = self.backoff
+        for attempt in range(1, self.max_attempts + 1):
+            wait = self.min_interval - (time.monotonic() - self._last_sent)
+            if wait > 0 and self._closed.wait(wait):
+                return False
+            self._last_sent = time.monotonic()
+            try:
+                response = self._session.post(url, params=params, timeout=self.timeout)
+            except Exception as e:
+                logging.warning(f"Error sending Telegram message: {e}")
+            else:
+                if response.status_code == 200:
+                    return True
+                if response.status_code != 429 and response.status_code < 500:
+                    logging.error(f"Failed to send message: {response.text}")
+                    return False
+                logging.warning(f"Telegram API busy ({response.status_code}).")
+                try:
+                    retry_after = response.json()["parameters"]["retry_after"]
+                    delay = max(delay, float(retry_after))
+                except Exception:
+                    pass
+            if attempt < self.max_attempts and self._closed.wait(delay):
+                return False
+            delay *= 2
+        logging.error(
+            f"Giving up on Telegram message after {self.max_attempts} attempts."
+        )
+        return False
+
+
+class CommandPipeline:
+    """Streams sequence-numbered commands to the Pico with a bounded in-flight window.
+
+    Instead of waiting for an ACK after every command, up to ``window`` commands
+    may be outstanding at once. The Pico answers with cumulative ``ACK <seq>``
+    lines, so a single ACK can retire a whole burst, and with ``NAK <seq>`` when
+    a command never arrived intact; that is a de-sync, and the Pico ignores
+    further commands until ``release_all``. Legacy firmware without sequence
+    support is driven with a window of one and plain ``ACK`` lines.
+    """
+
+    def __init__(
+        self,
+        ser,
+        window=DEFAULT_ACK_WINDOW,
+        ack_timeout=1.5,
+        sequenced=True,
+        binary=False,
+        batch=False,
+    ):
+        """Initializes the pipeline on an already handshaken serial connection.
+
+        Args:
+            ser (serial.Serial): The serial connection to the Pico device.
+            window (int): Maximum number of unacknowledged commands in flight.
+            ack_timeout (float): Seconds without ACK progress before declaring de-sync.
+            sequenced (bool): False for legacy firmware that only answers plain ACKs.
+            binary (bool): Send compact binary frames instead of text lines.
+            batch (bool): The Pico accepts ``batch`` commands (atomic chords).
+        """
+        self.ser = ser
+        self.sequenced = sequenced
+        self.binary = binary and sequenced
+        self.batch = batch and sequenced
+        self.key_ids = load_key_ids() if self.binary or self.batch else {}
+        self.window = max(1, int(window)) if sequenced else 1
+        self.ack_timeout = ack_timeout
+        self.sent = 0  # Total commands written
+        self.acked = 0  # Total commands acknowledged
+        self.error = None
+        self.messages = collections.deque(maxlen=64)  # Non-ACK lines from the Pico
+        self.round_trips = None  # Seconds from write to ACK, once tracking is on
+        self.on_ack = None  # Called as on_ack(total_acked, perf_counter_time)
+        self._send_times = collections.deque()
+        self._rx = bytearray()
+        try:
+            self.ser.timeout = 0.05
+        except Exception:
+            pass
+
+    @property
+    def in_flight(self):
+        """int: Number of commands written but not yet acknowledged."""
+        return self.sent - self.acked
+
+    def track_round_trips(self):
+        """Starts recording each command's write-to-ACK time in ``round_trips``.
+
+        A cumulative ACK completes every command it covers at the same moment.
+        """
+        self.round_trips = array("d")
+        self._send_times.clear()
+
+    def send(self, event_type, key, *fields):
+        """Queues one command, blocking only while the window is full.
+
+        Args:
+            event_type (str): The command, e.g. "down", "up" or "tl_down".
+            key (str): The key name as recorded by the keyboard library.
+            *fields: Extra fields appended after the sequence number.
+
+        Returns:
+            bool: True if the command was written, False on ACK timeout/de-sync.
+        """
+        return self.send_prepared(self.prepare(event_type, key, *fields))
+
+    def send_prepared(self, command):
+        """Queues a command pre-encoded by ``prepare``, e.g. from a compiled macro.
+
+        Args:
+            command (PreparedCommand): The pre-encoded command.
+
+        Returns:
+            bool: True if the command was written, False on ACK timeout/de-sync.
+        """
+        if not self._wait_for_window(self.window - 1):
+            return False
+        self.ser.write(self.encode(command))
+        self.sent += 1
+        if self.round_trips is not None:
+            self._send_times.append(time.perf_counter())
+        self.poll()
+        return True
+
+    def prepare(self, event_type, key, *fields):
+        """Pre-encodes a command in this pipeline's wire format.
+
+        Args:
+            event_type (str): The command, e.g. "down", "up" or "tl_down".
+            key (str): The key name, or "-" for commands without a key.
+            *fields: Extra integer fields, e.g. a timeline offset in microseconds.
+
+        Returns:
+            PreparedCommand: The pre-encoded command.
+        """
+        return prepare_command(
+            event_type, key, fields, self.key_ids if self.binary else None
+        )
+
+    def prepare_batch(self, changes):
+        """Pre-encodes simultaneous key changes as one ``batch`` command.
+
+        Args:
+            changes (list): (is_down, key name) pairs.
+
+        Returns:
+            PreparedCommand or None: The command, or None if the changes cannot
+                be batched or the Pico does not support batches.
+        """
+        if not self.batch:
+            return None
+        return prepare_batch(changes, self.key_ids, self.binary)
+
+    def encode(self, command):
+        """Completes a prepared command with the next sequence number.
+
+        Args:
+            command (PreparedCommand): The pre-encoded command.
+
+        Returns:
+            bytes: The bytes to write to the port.
+        """
+        seq = self.sent % SEQ_MODULO
+        if command.op is not None:
+            lo, hi = seq & 0xFF, seq >> 8
+            return (
+                bytes((FRAME_SYNC, command.op, lo, hi, len(command.head)))
+                + command.head
+                + bytes(((command.checksum + lo + hi) & 0xFF,))
+            )
+        if self.sequenced:
+            return command.head + str(seq).encode("ascii") + command.tail
+        # Legacy firmware: "<cmd>|<key>\n" without sequence number or fields
+        return command.head[:-1] + b"\n"
+
+    def drain(self, timeout=None):
+        """Waits until every command in flight has been acknowledged.
+
+        Args:
+            timeout (float, optional): Seconds without progress before giving up.
+                Defaults to the pipeline's ACK timeout.
+
+        Returns:
+            bool: True if all commands were acknowledged, False otherwise.
+        """
+        return self._wait_for_window(0, timeout)
+
+    def reset(self):
+        """Forgets outstanding commands and clears any error, e.g. before cleanup."""
+        try:
+            self.ser.reset_input_buffer()
+        except Exception:
+            pass
+        self._rx.clear()
+        self._send_times.clear()
+        self.acked = self.sent
+        self.error = None
+
+    def poll(self):
+        """Consumes any ACKs already waiting on the port without blocking.
+
+        Returns:
+            bool: True while commands are still awaiting an ACK.
+        """
+        try:
+            waiting = self.ser.in_waiting
+            if waiting:
+                self._feed(self.ser.read(waiting))
+        except Exception as e:
+            self.error = f"Serial read failed: {e}"
+        return self.in_flight > 0 and not self.error
+
+    def wait_for_message(self, timeout, stop_event=None):
+        """Blocks until the Pico sends a line other than an ACK.
+
+        The read blocks in the serial driver instead of polling; ``cancel_wait``
+        from another thread ends it early.
+
+        Args:
+            timeout (float): The maximum time to wait in seconds.
+            stop_event (threading.Event, optional): Also stop waiting once set.
+
+        Returns:
+            bool: True if a message is waiting in ``messages``.
+        """
+        deadline = time.perf_counter() + timeout
+        previous = self.ser.timeout
+        try:
+            while not self.messages and not self.error:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or (stop_event is not None and stop_event.is_set()):
+                    break
+                self.ser.timeout = remaining
+                self._feed(self.ser.read(max(1, self.ser.in_waiting)))
+        except Exception as e:
+            self.error = f"Serial read failed: {e}"
+        finally:
+            self.ser.timeout = previous
+        return bool(self.messages)
+
+    def cancel_wait(self):
+        """Ends a ``wait_for_message`` blocked on another thread."""
+        cancel_read = getattr(self.ser, "cancel_read", None)
+        if cancel_read is not None:
+            try:
+                cancel_read()
+            except Exception:
+                pass
+
+    def _wait_for_window(self, limit, timeout=None):
+        """Blocks until at most ``limit`` commands are in flight.
+
+        The timeout restarts whenever an ACK makes progress, so a long burst is
+        not penalised as long as the Pico keeps answering.
+        """
+        if timeout is None:
+            timeout = self.ack_timeout
+        deadline = time.perf_counter() + timeout
+        while self.in_flight > limit and not self.error:
+            before = self.acked
+            try:
+                chunk = self.ser.read(max(1, self.ser.in_waiting))
+            except Exception as e:
+                self.error = f"Serial read failed: {e}"
+                break
+            self._feed(chunk)
+            if self.acked != before:
+                deadline = time.perf_counter() + timeout
+            elif time.perf_counter() >= deadline:
+                self.error = f"Timed out waiting for ACK ({self.in_flight} command(s) in flight)."
+        return not self.error
+
+    def _feed(self, chunk):
+        """Splits received bytes into lines and applies any ACKs among them."""
+        if not chunk:
+            return
+        self._rx += chunk
+        while True:
+            newline = self._rx.find(b"\n")
+            if newline < 0:
+                break
+            line = self._rx[:newline].decode("utf-8", errors="ignore").strip()
+            del self._rx[: newline + 1]
+            if not line or line == "PICO_READY":
+                continue
+            if line == "ACK":
+                self._apply_ack(1)
+            elif line.startswith("ACK "):
+                try:
+                    seq = int(line[4:])
+                except ValueError:
+                    self.error = f"Malformed ACK from Pico: '{line}'"
+                    continue
+                # Distance from the last acknowledged sequence number, modulo wrap
+                self._apply_ack((seq - self.acked + 1) % SEQ_MODULO)
+            elif line.startswith("NAK "):
+                self.error = f"Pico lost command {line[4:]}; key state is out of sync."
+            else:
+                self.messages.append(line)
+
+    def _apply_ack(self, count):
+        """Retires ``count`` commands, flagging ACKs for commands never sent."""
+        if count > self.in_flight:
+            self.error = (
+                f"ACK for {count} command(s) but only {self.in_flight} in flight."
+            )
+            return
+        self.acked += count
+        if self.round_trips is not None or self.on_ack is not None:
+            now = time.perf_counter()
+            if self.round_trips is not None:
+                for _ in range(min(count, len(self._send_times))):
+                    self.round_trips.append(now - self._send_times.popleft())
+            if self.on_ack is not None:
+                self.on_ack(self.acked, now)
+
+
+class PicoSession:
+    """Owns one handshaken serial connection to the Pico for a whole playback run.
+
+    Opening the port, toggling DTR and waiting for PICO_READY can take seconds,
+    so the session does it once and keeps the port (and its command pipeline)
+    open across macros. ``ensure_connected`` is cheap while the connection is
+    healthy and only reconnects after a failure.
+    """
+
+    def __init__(
+        self,
+        port,
+        find_data_port=None,
+        ack_window=DEFAULT_ACK_WINDOW,
+        binary=True,
+        handshake_timeout=12.0,
+    ):
+        """Initializes the session without opening the port.
+
+        Args:
+            port (str): The COM port of the Pico DATA interface.
+            find_data_port (callable, optional): Called as
+                ``find_data_port(exclude_port=port)`` to locate the DATA port
+                when the handshake on ``port`` fails.
+            ack_window (int): In-flight window for the command pipeline.
+            binary (bool): Use binary frames when the Pico supports them.
+            handshake_timeout (float): Seconds to wait for PICO_READY.
+        """
+        self.port = port
+        self.find_data_port = find_data_port
+        self.ack_window = ack_window
+        self.binary = binary
+        self.handshake_timeout = handshake_timeout
+        self.ser = None
+        self.caps = set()
+        self.pipeline = None
+        self.console_detected = False
+
+    def is_alive(self):
+        """Checks, without any I/O round trip, that the session is still usable.
+
+        Returns:
+            bool: True if the port is open and the pipeline has not failed.
+        """
+        if self.ser is None or self.pipeline is None or self.pipeline.error:
+            return False
+        try:
+            self.ser.in_waiting  # Raises once the device has gone away
+            return bool(self.ser.is_open)
+        except Exception:
+            return False
+
+    def ensure_connected(self):
+        """Returns immediately if the session is alive, otherwise reconnects.
+
+        Returns:
+            bool: True if a handshaken connection is available.
+        """
+        if self.is_alive():
+            return True
+        if self.ser is not None:
+            logging.warning("Pico session lost; reconnecting...")
+        self.close()
+        return self.connect()
+
+    def connect(self):
+        """Opens the port and performs the PICO_READY/hello handshake.
+
+        If the handshake fails, tries once more on a DATA port found by
+        ``find_data_port``.
+
+        Returns:
+            bool: True if the handshake succeeded.
+        """
+        self.console_detected = False
+        if self._open_and_handshake(self.port):
+            return True
+        if self.find_data_port:
+            auto_port = self.find_data_port(exclude_port=self.port)
+            if auto_port and auto_port != self.port:
+                logging.info(
+                    f"Auto-detected Pico DATA port: {auto_port}. Retrying handshake..."
+                )
+                self.port = auto_port
+                if self._open_and_handshake(self.port):
+                    return True
+        logging.error("Timed out waiting for PICO_READY signal.")
+        return False
+
+    def release_all(self, timeout=0.8):
+        """Releases every key on the Pico and reads back which are still pressed.
+
+        ``release_all`` and a ``state`` query are sent back to back and
+        acknowledged together, so this takes one round trip however many keys
+        were held.
+
+        Args:
+            timeout (float): The maximum time to wait for the reply in seconds.
+
+        Returns:
+            set or None: Names of keys the Pico still reports pressed (normally
+                none), or None if the firmware lacks the commands or the reply
+                did not arrive.
+        """
+        pipeline = self.pipeline
+        if pipeline is None or "rel" not in self.caps:
+            return None
+        if pipeline.error:
+            pipeline.reset()
+        if not (
+            pipeline.send("release_all", "-")
+            and pipeline.send("state", "-")
+            and pipeline.drain(timeout=timeout)
+        ):
+            return None
+        state = None
+        for line in [m for m in pipeline.messages if m.startswith("STATE ")]:
+            pipeline.messages.remove(line)
+            state = line[len("STATE ") :]
+        try:
+            return None if state is None else decode_key_state(state)
+        except ValueError:
+            logging.warning(f"Malformed key state from Pico: '{state}'")
+            return None
+
+    def close(self):
+        """Closes the serial port, if open."""
+        try:
+            if self.ser:
+                self.ser.close()
+        except Exception:
+            pass
+        self.ser = None
+        self.pipeline = None
+
+    def _open_and_handshake(self, port):
+        """Opens ``port`` and waits for PICO_READY.
+
+        Args:
+            port (str): The COM port to open.
+
+        Returns:
+            bool: True if the Pico answered and the pipeline is ready.
+        """
+        self.close()
+        try:
+            self.ser = serial.Serial(port, 115200, timeout=5)
+            try:
+                self.ser.dtr = False
+                time.sleep(0.05)
+                self.ser.dtr = True
+                self.ser.rts = False
+            except Exception:
+                pass
+            time.sleep(0.1)
+
+            logging.info("Waiting for PICO_READY signal...")
+            start_time = time.time()
+            hello_sent = False
+            try:
+                self.ser.timeout = 0.2
+            except Exception:
+                pass
+            while time.time() - start_time < self.handshake_timeout:
+                line = self.ser.readline().decode("utf-8", errors="ignore").strip()
+                if line == "PICO_READY":
+                    logging.info("PICO_READY signal received.")
+                    self.caps = self._finalize_handshake(self.ser)
+                    self.pipeline = CommandPipeline(
+                        self.ser,
+                        window=self.ack_window,
+                        sequenced="seq" in self.caps,
+                        binary=self.binary and "bin1" in self.caps,
+                        batch="batch" in self.caps,
+                    )
+                    return True
+                elif line:
+                    print(f"Pico startup message: {line}")
+                    lower = line.lower()
+                    if (
+                        ("circuitpython" in lower)
+                        or ("repl" in lower)
+                        or lower.startswith(">>>")
+                    ):
+                        print(
+                            "Detected the console CDC port. Please select the other Pico COM port (Data)."
+                        )
+                        self.console_detected = True
+                        break
+
+                # After 1 second with no PICO_READY, try explicit HELLO on DATA port
+                if (not hello_sent) and (time.time() - start_time >= 1.0):
+                    try:
+                        self.ser.write(b"hello|handshake\n")
+                        self.ser.flush()
+                        hello_sent = True
+                    except Exception:
+                        pass
+        except Exception as e:
+            logging.error(f"Could not open {port}: {e}")
+        self.close()
+        return False
+
+    def _finalize_handshake(self, ser):
+        """Finalizes the handshake with the Pico device after receiving PICO_READY.
+
+        After seeing PICO_READY, explicitly sends HELLO so the Pico stops periodic READY.
+        Then waits briefly for its PICO_READY response and clears any leftover input.
+
+        Args:
+            ser (serial.Serial): The serial connection to the Pico device.
+
+        Returns:
+            set: Capability tokens advertised by the Pico (empty for legacy firmware).
+        """
+        try:
+            ser.write(b"hello|handshake\n")
+            ser.flush()
+        except Exception:
+            pass
+        end = time.time() + 0.8
+        while time.time() < end:
+            try:
+                line = ser.readline().decode("utf-8", errors="ignore").strip()
+            except Exception:
+                break
+            if not line:
+                continue
+            if line == "PICO_READY":
+                break
+        try:
+            ser.reset_input_buffer()
+        except Exception:
+            pass
+        return self._query_caps(ser)
+
+    def _query_caps(self, ser, timeout=0.5):
+        """Asks the Pico which protocol features its firmware supports.
+
+        Older firmware treats the query as an unknown key and answers with a
+        plain ACK, which is taken to mean "no optional capabilities".
+
+        Args:
+            ser (serial.Serial): The serial connection to the Pico device.
+            timeout (float): The maximum time to wait for a reply in seconds.
+
+        Returns:
+            set: Capability tokens, e.g. {"seq"}.
+        """
+        try:
+            ser.write(b"caps|query\n")
+            ser.flush()
+        except Exception:
+            return set()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                line = ser.readline().decode("utf-8", errors="ignore").strip()
+            except Exception:
+                break
+            if line.startswith("CAPS"):
+                caps = set(line.split()[1:])
+                logging.info(f"Pico capabilities: {sorted(caps) or 'none'}")
+                return caps
+            if line == "ACK":
+                break
+        logging.info("Pico firmware does not report capabilities; using stop-and-wait.")
+        return set()
+
+
+class AutorepeatFilter:
+    """Drops the repeated ``down`` events the OS emits while a key is held.
+
+    A key is held from its first down until its up. Further downs in between
+    change nothing on the Pico, where the key is already pressed, and the
+    target's own autorepeat takes care of the repetition. ``removed`` counts
+    the events dropped.
+    """
+
+    def __init__(self):
+        self.held = set()
+        self.removed = 0
+
+    def accept(self, event_type, key):
+        """Returns False if the event is a redundant repeated down.
+
+        Args:
+            event_type (str): "down" or "up".
+            key (str): The key name as recorded by the keyboard library.
+        """
+        key = key.lower()
+        if event_type == "down":
+            if key in self.held:
+                self.removed += 1
+                return False
+            self.held.add(key)
+        else:
+            self.held.discard(key)
+        return True
+
+
+def collapse_autorepeat(events):
+    """Removes autorepeat downs from parsed macro events.
+
+    Args:
+        events (list): Events as returned by MacroController.parse_macro_file.
+
+    Returns:
+        tuple: (the remaining events, number of events removed).
+    """
+    repeat_filter = AutorepeatFilter()
+    kept = [
+        e
+        for e in events
+        if e["type"] is None or repeat_filter.accept(e["type"], e["key"])
+    ]
+    return kept, repeat_filter.removed
+
+
+def parse_macro_lines(lines):
+    """Parses the lines of a macro file, ``<time> <down|up> <key name>`` each.
+
+    The key name is the rest of the line, so names such as ``page down`` or
+    ``right shift`` stay whole. A line that cannot be parsed becomes an event
+    with ``type`` None and the line's text as ``key``, which compile_macro
+    reports as an error.
+
+    Args:
+        lines (iterable): The file's lines.
+
+    Returns:
+        list: Event dicts with "time", "type", "key" and the 1-based "line".
+    """
+    events = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        parts = line.split(None, 2)
+        try:
+            if len(parts) < 3:
+                raise ValueError(line)
+            event = {
+                "time": float(parts[0]),
+                "type": parts[1],
+                "key": " ".join(parts[2].split()),
+            }
+        except ValueError:
+            event = {"time": None, "type": None, "key": line}
+        event["line"] = number
+        events.append(event)
+    return events
+
+
+def format_macro_line(t, event_type, key):
+    """Formats one event as a macro file line that parse_macro_lines reads back.
+
+    Args:
+        t (float): The event time in seconds.
+        event_type (str): "down" or "up".
+        key (str): The key name; may contain spaces, e.g. "page down".
+
+    Returns:
+        str: The line, including its newline.
+    """
+    return f"{t:.6f} {event_type} {' '.join(key.split())}\n"
+
+
+# A compiler finding. ``severity`` is "error" (the macro is rejected),
+# "warning" or "info"; ``line`` is the 1-based line of the event in the macro
+# file, or 0 for the macro as a whole. Line numbers stay meaningful after
+# autorepeat collapsing and chord batching have changed the event count.
+Diagnostic = collections.namedtuple("Diagnostic", ["severity", "line", "message"])
+
+
+class CompiledMacro:
+    """A macro file parsed once into compact, array-backed event storage.
+
+    Events are stored column-wise instead of as one dict per event:
+
+    * ``delays``: ``array('d')`` of seconds to wait before each event.
+    * ``key_ids``: ``array('h')`` of ids in the shared key table (-1 if unknown).
+    * ``name_idx``: ``array('H')`` index of each event's key into ``names``.
+    * ``down``: ``bytearray`` with 1 for key down and 0 for key up.
+    * ``group_start``: ``bytearray`` with 1 where a new chord group begins.
+
+    Wire commands are pre-encoded on first use for each wire format and shared
+    between events with the same key and direction. Where the Pico supports
+    batches, each chord group is sent as one ``batch`` command.
+    """
+
+    def __init__(self, path, mtime_ns, size):
+        """Initializes an empty compiled macro for a file.
+
+        Args:
+            path (str): The macro file path.
+            mtime_ns (int): The file's modification time when compiled.
+            size (int): The file's size in bytes when compiled.
+        """
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.delays = array("d")
+        self.key_ids = array("h")
+        self.name_idx = array("H")
+        self.down = bytearray()
+        self.group_start = bytearray()
+        self.names = ()
+        self.unknown_keys = ()  # Validation: keys missing from the key table
+        self.diagnostics = ()
+        self.chord_tolerance = 0.0
+        self._commands = {}
+
+    def __len__(self):
+        return len(self.delays)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_commands"] = {}  # Rebuilt per wire format after loading
+        return state
+
+    @property
+    def duration(self):
+        """float: Seconds from the first to the last event."""
+        return sum(self.delays)
+
+    @property
+    def errors(self):
+        """tuple: Diagnostics that make the macro unplayable."""
+        return tuple(d for d in self.diagnostics if d.severity == "error")
+
+    def key(self, i):
+        """Returns the key name of event ``i``."""
+        return self.names[self.name_idx[i]]
+
+    def event_type(self, i):
+        """Returns "down" or "up" for event ``i``."""
+        return "down" if self.down[i] else "up"
+
+    def commands(self, pipeline):
+        """Returns the pre-encoded command for every event in a pipeline's format.
+
+        The first event of a chord group gets the group's batch command, and
+        the other events of the group get None.
+
+        Args:
+            pipeline (CommandPipeline): The pipeline the commands will be sent on.
+
+        Returns:
+            list: One PreparedCommand, or None, per event.
+        """
+        fmt = (pipeline.binary, pipeline.batch)
+        if fmt not in self._commands:
+            shared = {}
+            commands = []
+            for i in range(len(self)):
+                k = (self.down[i], self.name_idx[i])
+                if k not in shared:
+                    shared[k] = pipeline.prepare(self.event_type(i), self.key(i))
+                commands.append(shared[k])
+            if pipeline.batch:
+                self._batch_commands(pipeline, commands)
+            self._commands[fmt] = commands
+        return self._commands[fmt]
+
+    def _batch_commands(self, pipeline, commands):
+        """Replaces the commands of each chord group with one batch."""
+        n = len(self)
+        i = 0
+        while i < n:
+            j = i + 1
+            while j < n and not self.group_start[j]:
+                j += 1
+            if j - i > 1:
+                batch = pipeline.prepare_batch(
+                    [(self.down[e], self.key(e)) for e in range(i, j)]
+                )
+                if batch is not None:
+                    commands[i] = batch
+                    for e in range(i + 1, j):
+                        commands[e] = None
+            i = j
+
+
+def compile_macro(path, events, mtime_ns=0, size=0, chord_tolerance=0.0):
+    """Compiles parsed macro events into a validated, optimized CompiledMacro.
+
+    Every key is resolved against the shared key table and downs and ups are
+    checked for balance. Events within ``chord_tolerance`` of the first event
+    of a chord, each touching a different key, are moved to that instant and
+    grouped so they can go out as one batch. Problems are reported in
+    ``diagnostics``; a macro with errors must not be played.
+
+    Args:
+        path (str): The macro file path.
+        events (list): Events as returned by MacroController.parse_macro_file.
+        mtime_ns (int): The file's modification time.
+        size (int): The file's size in bytes.
+        chord_tolerance (float): Seconds within which key changes form a chord.
+
+    Returns:
+        CompiledMacro: The compiled macro.
+    """
+    macro = CompiledMacro(path, mtime_ns, size)
+    macro.chord_tolerance = chord_tolerance
+    key_ids = load_key_ids()
+    name_index = {}
+    unknown = {}
+    diagnostics = []
+    held = {}  # Lower-cased key -> (line, name) of the down that pressed it
+    chord_time = None
+    chord_keys = set()
+    merged = 0
+    prev_time = next((e["time"] for e in events if e["time"] is not None), 0.0)
+    for index, event in enumerate(events):
+        name = event["key"]
+        lower = name.lower()
+        line = event.get("line", index + 1)
+        if event["type"] is None:
+            diagnostics.append(
+                Diagnostic("error", line, f"Not '<time> <down|up> <key>': '{name}'.")
+            )
+            continue
+        if event["type"] not in ("down", "up"):
+            diagnostics.append(
+                Diagnostic("error", line, f"Unknown event type '{event['type']}'.")
+            )
+            continue
+        is_down = event["type"] == "down"
+        if is_down:
+            held[lower] = (line, name)
+        elif lower in held:
+            del held[lower]
+        else:
+            diagnostics.append(
+                Diagnostic(
+                    "warning",
+                    line,
+                    f"'{name}' released without being pressed; dropped.",
+                )
+            )
+            continue
+        key_id = key_ids.get(lower, -1)
+        if key_id < 0:
+            unknown.setdefault(name, line)
+
+        t = event["time"]
+        if t < prev_time:
+            diagnostics.append(
+                Diagnostic(
+                    "warning", index, "Timestamp goes backwards; played at once."
+                )
+            )
+            t = prev_time
+        if (
+            chord_time is not None
+            and t - chord_time <= chord_tolerance
+            and lower not in chord_keys
+        ):
+            merged += t > chord_time
+            t = chord_time
+            macro.group_start.append(0)
+        else:
+            chord_time = t
+            chord_keys.clear()
+            macro.group_start.append(1)
+        chord_keys.add(lower)
+
+        if name not in name_index:
+            name_index[name] = len(name_index)
+        macro.delays.append(t - prev_time)
+        macro.key_ids.append(key_id)
+        macro.name_idx.append(name_index[name])
+        macro.down.append(1 if is_down else 0)
+        prev_time = t
+
+    for name, line in unknown.items():
+        diagnostics.append(
+            Diagnostic("error", line, f"Key '{name}' is not in the Pico key table.")
+        )
+    for line, name in held.values():
+        diagnostics.append(
+            Diagnostic("error", line, f"'{name}' is pressed but never released.")
+        )
+    if merged:
+        diagnostics.append(
+            Diagnostic(
+                "info",
+                0,
+                f"Coalesced {merged} event(s) within {chord_tolerance * 1000:g} ms into "
+                f"chords: {len(macro)} events in {sum(macro.group_start)} groups.",
+            )
+        )
+    diagnostics.sort(key=lambda d: d.line)
+    macro.names = tuple(sys.intern(name) for name in name_index)
+    macro.unknown_keys = tuple(sorted(unknown))
+    macro.diagnostics = tuple(diagnostics)
+    return macro
+
+
+def log_diagnostics(path, macro):
+    """Logs a compiled macro's diagnostics, one line each.
+
+    Args:
+        path (str): The macro file path.
+        macro (CompiledMacro): The compiled macro.
+    """
+    name = os.path.basename(path)
+    levels = {"error": logging.ERROR, "warning": logging.WARNING}
+    for d in macro.diagnostics:
+        where = f" (line {d.line})" if d.line else ""
+        logging.log(levels.get(d.severity, logging.INFO), f"{name}{where}: {d.message}")
+
+
+class MacroCache:
+    """Caches compiled macros in memory and on disk, keyed by path, mtime and size.
+
+    Both tiers evict least-recently-used entries. A file is recompiled only when
+    its mtime or size changes, so long sessions stop re-reading and re-parsing
+    the same macros on every playlist cycle.
+    """
+
+    def __init__(
+        self,
+        parse,
+        cache_dir=MACRO_CACHE_DIR,
+        max_entries=64,
+        max_disk_entries=1024,
+        chord_tolerance=DEFAULT_CHORD_TOLERANCE,
+    ):
+        """Initializes the cache.
+
+        Args:
+            parse (callable): Parses a macro file into an event list, or None on error.
+            cache_dir (str, optional): Directory for on-disk entries; None disables it.
+            max_entries (int): Maximum compiled macros kept in memory.
+            max_disk_entries (int): Maximum compiled macros kept on disk.
+            chord_tolerance (float): Passed to compile_macro; entries compiled
+                with a different tolerance are recompiled.
+        """
+        self.parse = parse
+        self.chord_tolerance = chord_tolerance
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_count = None  # Entries on disk, once the directory was listed
+
+    def get(self, path):
+        """Returns the compiled macro for ``path``, compiling it if needed.
+
+        Args:
+            path (str): The macro file path.
+
+        Returns:
+            CompiledMacro or None: The compiled macro, or None if it cannot be read.
+        """
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            print(f"Warning: Could not parse macro file '{path}'.\nError: {e}")
+            return None
+        key = os.path.abspath(path)
+        with self._lock:
+            macro = self._entries.get(key)
+            if macro is not None and (
+                macro.mtime_ns,
+                macro.size,
+                macro.chord_tolerance,
+            ) == (st.st_mtime_ns, st.st_size, self.chord_tolerance):
+                self._entries.move_to_end(key)
+                return macro
+
+        macro = self._load_from_disk(key, st)
+        if macro is None:
+            events = self.parse(path)
+            if events is None:
+                return None
+            macro = compile_macro(
+                key, events, st.st_mtime_ns, st.st_size, self.chord_tolerance
+            )
+            log_diagnostics(path, macro)
+            self._save_to_disk(key, macro)
+
+        with self._lock:
+            self._entries[key] = macro
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return macro
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.pkl")
+
+    def _load_from_disk(self, key, st):
+        """Loads a still-valid compiled macro from disk, or returns None."""
+        if not self.cache_dir:
+            return None
+        disk_path = self._disk_path(key)
+        try:
+            with open(disk_path, "rb") as f:
+                header, macro = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable macro cache entry {disk_path}: {e}")
+            return None
+        if header != (
+            compiler_signature(),
+            key,
+            st.st_mtime_ns,
+            st.st_size,
+            self.chord_tolerance,
+        ):
+            return None
+        try:
+            os.utime(disk_path)  # Mark as recently used
+        except OSError:
+            pass
+        return macro
+
+    def _save_to_disk(self, key, macro):
+        """Writes a compiled macro to disk and evicts the oldest entries."""
+        if not self.cache_dir:
+            return
+        header = (
+            compiler_signature(),
+            key,
+            macro.mtime_ns,
+            macro.size,
+            macro.chord_tolerance,
+        )
+        disk_path = self._disk_path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            existed = os.path.exists(disk_path)
+            tmp_path = f"{disk_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump((header, macro), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, disk_path)
+            # The directory is only listed again once it is over the limit, so
+            # saving many new macros does not rescan it every time
+            with self._lock:
+                if self._disk_count is None:
+                    self._disk_count = len(self._disk_entries())
+                elif not existed:
+                    self._disk_count += 1
+                if self._disk_count > self.max_disk_entries:
+                    self._evict_from_disk()
+        except Exception as e:
+            logging.warning(f"Could not write macro cache entry: {e}")
+
+    def _disk_entries(self):
+        return [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(".pkl")
+        ]
+
+    def _evict_from_disk(self):
+        """Removes the least recently used disk entries, down to 3/4 of the limit."""
+        entries = self._disk_entries()
+        entries.sort(key=os.path.getmtime)
+        excess = len(entries) - self.max_disk_entries * 3 // 4
+        for old in entries[: max(0, excess)]:
+            os.remove(old)
+        self._disk_count = len(entries) - max(0, excess)
+
+
+class MacroCatalog:
+    """Persistent SQLite index of macro folders, so playlists build without re-listing.
+
+    ``scan`` brings a folder's rows up to date from ``os.scandir`` stat data
+    alone: new files are added, changed ones reset and deleted ones dropped.
+    The content hash, event count, duration and validity of a file are filled
+    in by ``update`` once the macro has been loaded anyway, e.g. by the
+    prefetcher. Validity is recorded with the compiler_signature() it was
+    checked under, so invalid files are retried once the key table or the
+    compiler changes. Scanning again between playlists picks up files added,
+    edited or removed while a run is active.
+    """
+
+    def __init__(self, db_path=CATALOG_FILE):
+        """Opens (or creates) the catalog database.
+
+        Args:
+            db_path (str): The SQLite file.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._db:
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version != CATALOG_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS macros")
+                self._db.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS macros (
+                    path TEXT PRIMARY KEY,
+                    folder TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    is_start INTEGER NOT NULL,
+                    hash TEXT,
+                    events INTEGER,
+                    duration REAL,
+                    valid INTEGER,
+                    checked TEXT
+                )"""
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS macros_folder ON macros (folder)"
+            )
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._db.close()
+
+    def scan(self, folder):
+        """Updates the rows of ``folder`` from the files' current stat data.
+
+        Args:
+            folder (str): The macro folder.
+
+        Returns:
+            tuple: Numbers of (added, changed, removed) macro files.
+        """
+        folder = os.path.abspath(folder)
+        found = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(".txt") and entry.is_file():
+                    st = entry.stat()
+                    found[entry.name] = (st.st_size, st.st_mtime_ns)
+        with self._lock, self._db:
+            known = {
+                name: (size, mtime_ns)
+                for name, size, mtime_ns in self._db.execute(
+                    "SELECT name, size, mtime_ns FROM macros WHERE folder = ?",
+                    (folder,),
+                )
+            }
+            added = [n for n in found if n not in known]
+            changed = [n for n in found if n in known and found[n] != known[n]]
+            removed = [n for n in known if n not in found]
+            self._db.executemany(
+                "INSERT OR REPLACE INTO macros (path, folder, name, size, mtime_ns, "
+                "is_start) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        os.path.join(folder, n),
+                        folder,
+                        n,
+                        *found[n],
+                        n.startswith("START_"),
+                    )
+                    for n in added + changed
+                ],
+            )
+            self._db.executemany(
+                "DELETE FROM macros WHERE path = ?",
+                [(os.path.join(folder, n),) for n in removed],
+            )
+        if added or changed or removed:
+            logging.info(
+                f"Catalog: {len(added)} added, {len(changed)} changed, "
+                f"{len(removed)} removed in {folder}."
+            )
+        return len(added), len(changed), len(removed)
+
+    def playlist_files(self, folder):
+        """Returns the folder's playable macro file names, split by START_ prefix.
+
+        Files known to be invalid under the current compiler_signature() are
+        left out; ones not yet loaded are included.
+
+        Args:
+            folder (str): The macro folder.
+
+        Returns:
+            tuple: (START_ file names, other file names).
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, is_start FROM macros WHERE folder = ? "
+                "AND (valid IS NULL OR valid = 1 OR checked IS NOT ?) ORDER BY name",
+                (os.path.abspath(folder), compiler_signature()),
+            ).fetchall()
+        return (
+            [name for name, is_start in rows if is_start],
+            [name for name, is_start in rows if not is_start],
+        )
+
+    def update(self, path, macro):
+        """Stores what loading a macro revealed: hash, size of the plan, validity.
+
+        A row already filled in for the same file contents and signature is
+        left alone, so replaying a cached macro does not re-read the file.
+
+        Args:
+            path (str): The macro file path.
+            macro (CompiledMacro or None): The loaded macro, None if unreadable.
+        """
+        path = os.path.abspath(path)
+        signature = compiler_signature()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, hash, checked FROM macros WHERE path = ?",
+                (path,),
+            ).fetchone()
+        if row is None:
+            return
+        size, mtime_ns, digest, checked = row
+        if macro is None:
+            # Unreadable files are retried, so no signature is recorded
+            values = (None, None, None, 0, None)
+        else:
+            # Ignore results for a file that changed since it was loaded
+            if (size, mtime_ns) != (macro.size, macro.mtime_ns):
+                return
+            if digest is not None and checked == signature:
+                return
+            if digest is None:
+                try:
+                    with open(path, "rb") as f:
+                        digest = hashlib.sha1(f.read()).hexdigest()
+                except OSError:
+                    return
+            values = (digest, len(macro), macro.duration, not macro.errors, signature)
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE macros SET hash = ?, events = ?, duration = ?, valid = ?, "
+                "checked = ? WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (*values, path, size, mtime_ns),
+            )
+
+    def entries(self, folder):
+        """Returns every catalog row of ``folder`` as a dict, sorted by name."""
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT * FROM macros WHERE folder = ? ORDER BY name",
+                (os.path.abspath(folder),),
+            )
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class MacroPrefetcher:
+    """Loads upcoming playlist macros on a worker thread while one is playing.
+
+    The worker reads, parses and validates each entry through a MacroCache and
+    hands it over through a bounded buffer, so at most ``depth`` macros wait
+    ahead of playback and slow storage never stalls the gap between macros.
+    Both sides block on a condition variable; ``wake`` (e.g. from
+    ``PlaybackState.on_stop``) makes them re-check the cancel event at once.
+    """
+
+    _DONE = object()
+
+    def __init__(
+        self, cache, depth=DEFAULT_PREFETCH_DEPTH, cancel_event=None, on_loaded=None
+    ):
+        """Initializes the prefetcher without starting it.
+
+        Args:
+            cache (MacroCache): Loads and compiles macro files.
+            depth (int): Maximum macros loaded ahead.
+            cancel_event (threading.Event, optional): Set to stop early, e.g.
+                the playback stop event.
+            on_loaded (callable, optional): Called as ``on_loaded(path, macro)``
+                on the worker thread after each load.
+        """
+        self.cache = cache
+        self.on_loaded = on_loaded
+        self.depth = max(1, depth)
+        self.cancel_event = cancel_event or threading.Event()
+        self._ready = collections.deque()
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, paths):
+        """Starts loading ``paths`` in order.
+
+        Args:
+            paths (list): Macro file paths in playlist order.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(list(paths),), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops the worker and discards anything loaded but not played."""
+        self._stop.set()
+        self.wake()
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+        self._ready.clear()
+
+    def wake(self):
+        """Wakes both sides so they notice a stop or cancel. Safe from any thread."""
+        with self._changed:
+            self._changed.notify_all()
+
+    def __iter__(self):
+        """Yields (path, CompiledMacro or None) in playlist order until done or cancelled."""
+        while True:
+            with self._changed:
+                while not self._ready and not self._stopping():
+                    self._changed.wait()
+                if self._stopping():
+                    return
+                item = self._ready.popleft()
+                self._changed.notify_all()
+            if item is self._DONE:
+                return
+            yield item
+
+    def _run(self, paths):
+        for path in paths:
+            if self._stopping():
+                return
+            macro = self.cache.get(path)
+            if self.on_loaded:
+                try:
+                    self.on_loaded(path, macro)
+                except Exception as e:
+                    logging.warning(f"Could not record {path} in the catalog: {e}")
+            self._put((path, macro))
+        self._put(self._DONE)
+
+    def _stopping(self):
+        return self._stop.is_set() or self.cancel_event.is_set()
+
+    def _put(self, item):
+        """Blocks while the buffer is full, giving up once stopped."""
+        with self._changed:
+            while len(self._ready) >= self.depth and not self._stopping():
+                self._changed.wait()
+            if not self._stopping():
+                self._ready.append(item)
+                self._changed.notify_all()
+
+
+class DeadlineScheduler:
+    """Paces playback against absolute deadlines measured from the macro start.
+
+    Each event's deadline is its offset from the first event, so ACK latency,
+    focus checks and wake-up jitter never accumulate over a long macro. Waits
+    block on ``stop_event`` while the deadline is more than a coarse timer tick
+    away, then sleep in ``ACK_POLL_INTERVAL`` slices and spin on
+    ``time.perf_counter()`` for the final stretch. Setting the event cancels
+    any wait within one slice. How late events actually went out is recorded
+    by PlaybackTelemetry.
+    """
+
+    def __init__(self, stop_event, spin_threshold=DEFAULT_SPIN_THRESHOLD):
+        """Initializes the scheduler.
+
+        Args:
+            stop_event (threading.Event): Set to cancel playback.
+            spin_threshold (float): Seconds before a deadline to switch from
+                sleeping to spinning.
+        """
+        self.stop_event = stop_event
+        self.spin_threshold = max(0.0, spin_threshold)
+        self.t0 = 0.0
+
+    def start(self):
+        """Starts the clock for a macro; offset 0 is now."""
+        self.t0 = time.perf_counter()
+
+    def wait_until(self, offset, poll=None):
+        """Waits until ``offset`` seconds after the start.
+
+        Args:
+            offset (float): The event's offset from the macro start in seconds.
+            poll (callable, optional): Called every ACK_POLL_INTERVAL while the
+                deadline is far enough away, until it returns False; used to read
+                ACKs as they arrive rather than at the next send.
+
+        Returns:
+            bool: True when the deadline is reached, False if cancelled.
+        """
+        deadline = self.t0 + offset
+        if poll is not None:
+            margin = self.spin_threshold + ACK_POLL_INTERVAL
+            while deadline - time.perf_counter() > margin and poll():
+                # time.sleep is high-resolution where Event.wait may not be
+                time.sleep(ACK_POLL_INTERVAL)
+                if self.stop_event.is_set():
+                    return False
+        spin_from = deadline - self.spin_threshold
+        remaining = spin_from - COARSE_WAIT_SLACK - time.perf_counter()
+        if remaining > 0 and self.stop_event.wait(remaining):
+            return False
+        while True:
+            remaining = spin_from - time.perf_counter()
+            if remaining <= 0:
+                break
+            time.sleep(min(ACK_POLL_INTERVAL, remaining))
+            if self.stop_event.is_set():
+                return False
+        while time.perf_counter() < deadline:
+            if self.stop_event.is_set():
+                return False
+            time.sleep(0)
+        return not self.stop_event.is_set()
+
+
+class PlaybackTelemetry:
+    """Per-event timing record of one macro run, for judging playback fidelity.
+
+    For each event it keeps, in seconds from the macro start, when the event was
+    scheduled, when its write began and when its ACK was read (NaN until then),
+    plus the duration of the focus watchdog's latest check and the number of
+    the command that carried it (events of one batch share a command). The
+    columns are preallocated arrays reused across runs, so recording is a few
+    array stores.
+    """
+
+    FIELDS = ("scheduled", "written", "acked", "focus_cost")
+
+    def __init__(self, capacity=1024):
+        """Initializes empty buffers.
+
+        Args:
+            capacity (int): Events to preallocate room for; grows as needed.
+        """
+        self.name = ""
+        self.count = 0
+        self.expected = 0
+        self.t0 = 0.0
+        self.capacity = 0
+        self._acked = 0  # Events stamped with their ACK time so far
+        self._ack_total = 0  # Commands acknowledged, per the latest ACK
+        self._ack_at = 0.0
+        self._reserve(capacity)
+
+    def _reserve(self, capacity):
+        """Grows the columns to hold at least ``capacity`` events."""
+        if capacity <= self.capacity:
+            return
+        for field in self.FIELDS:
+            setattr(self, field, array("d", bytes(8 * capacity)))
+        self.command = array("q", bytes(8 * capacity))
+        self.capacity = capacity
+
+    def start(self, name, event_count, t0, acked_commands):
+        """Resets the buffers for a new macro run.
+
+        Args:
+            name (str): The macro being played.
+            event_count (int): Number of events in the macro.
+            t0 (float): ``time.perf_counter()`` value of the macro start.
+            acked_commands (int): The pipeline's ``acked`` count at the start.
+        """
+        self._reserve(event_count)
+        self.name = name
+        self.count = 0
+        self.expected = event_count
+        self.t0 = t0
+        self._acked = 0
+        self._ack_total = acked_commands
+        self.acked[:event_count] = array("d", [math.nan]) * event_count
+
+    def record(self, scheduled, written, focus_cost, command):
+        """Records one event after its command was written.
+
+        Args:
+            scheduled (float): The event's offset from the macro start in seconds.
+            written (float): ``time.perf_counter()`` when the write began.
+            focus_cost (float): Seconds taken by the latest focus check.
+            command (int): The pipeline's number for the command carrying the
+                event, i.e. its ``sent`` count before the write.
+        """
+        i = self.count
+        if i < self.expected:
+            self.scheduled[i] = scheduled
+            self.written[i] = written - self.t0
+            self.focus_cost[i] = focus_cost
+            self.command[i] = command
+            self.count = i + 1
+            if command < self._ack_total and self._acked == i:
+                # Acknowledged while it was still being written
+                self.acked[i] = self._ack_at
+                self._acked = i + 1
+
+    def on_ack(self, total_acked, now):
+        """Stamps the ACK time of every event covered by a cumulative ACK.
+
+        Suitable as ``CommandPipeline.on_ack``.
+        """
+        self._ack_total = total_acked
+        self._ack_at = now - self.t0
+        i = self._acked
+        while i < self.count and self.command[i] < total_acked:
+            self.acked[i] = self._ack_at
+            i += 1
+        self._acked = i
+
+    def rows(self):
+        """Yields one dict per recorded event, with derived lateness and RTT."""
+        for i in range(self.count):
+            acked = self.acked[i]
+            yield {
+                "index": i,
+                "scheduled_s": self.scheduled[i],
+                "written_s": self.written[i],
+                "acked_s": None if math.isnan(acked) else acked,
+                "lateness_ms": (self.written[i] - self.scheduled[i]) * 1000,
+                "ack_rtt_ms": None
+                if math.isnan(acked)
+                else (acked - self.written[i]) * 1000,
+                "focus_cost_us": self.focus_cost[i] * 1e6,
+            }
+
+    def summary(self):
+        """Summarizes the run.
+
+        Returns:
+            dict: Event count; mean/max/p50/p95/p99 lateness, jitter (standard
+                deviation of lateness) and drift (lateness of the last event);
+                mean/p95/max ACK round trip; mean focus-check cost. Times are
+                in milliseconds.
+        """
+        n = self.count
+        late = [self.written[i] - self.scheduled[i] for i in range(n)]
+        rtt = [
+            self.acked[i] - self.written[i]
+            for i in range(n)
+            if not math.isnan(self.acked[i])
+        ]
+        mean = sum(late) / n if n else 0.0
+        jitter = math.sqrt(sum((x - mean) ** 2 for x in late) / n) if n else 0.0
+        return {
+            "macro": self.name,
+            "events": n,
+            "acked": len(rtt),
+            "lateness_mean_ms": mean * 1000,
+            "lateness_max_ms": max(late, default=0.0) * 1000,
+            "lateness_p50_ms": percentile(late, 50) * 1000,
+            "lateness_p95_ms": percentile(late, 95) * 1000,
+            "lateness_p99_ms": percentile(late, 99) * 1000,
+            "drift_ms": late[-1] * 1000 if late else 0.0,
+            "jitter_ms": jitter * 1000,
+            "ack_rtt_mean_ms": sum(rtt) / len(rtt) * 1000 if rtt else 0.0,
+            "ack_rtt_p95_ms": percentile(rtt, 95) * 1000,
+            "ack_rtt_max_ms": max(rtt, default=0.0) * 1000,
+            "focus_cost_mean_ms": sum(self.focus_cost[:n]) / n * 1000 if n else 0.0,
+        }
+
+    def export(self, path):
+        """Writes the recorded events to ``path`` as CSV, or JSON with a summary.
+
+        The format follows the file extension: ``.csv`` for CSV, otherwise JSON.
+
+        Args:
+            path (str): Destination file.
+        """
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = None
+                for row in self.rows():
+                    if writer is None:
+                        writer = csv.DictWriter(f, fieldnames=list(row))
+                        writer.writeheader()
+                    writer.writerow(row)
+        else:
+            with open(path, "w") as f:
+                json.dump(
+                    {"summary": self.summary(), "events": list(self.rows())},
+                    f,
+                    indent=2,
+                )
+
+
+def format_timing_summary(summary):
+    """Formats a PlaybackTelemetry summary as one status-bar line."""
+    return (
+        f"Timing: {summary['events']} events, late {summary['lateness_mean_ms']:.2f}"
+        f"/{summary['lateness_max_ms']:.2f} ms (mean/max), "
+        f"jitter {summary['jitter_ms']:.2f} ms, drift {summary['drift_ms']:.2f} ms, "
+        f"ACK {summary['ack_rtt_mean_ms']:.2f}/{summary['ack_rtt_p95_ms']:.2f} ms (mean/p95)"
+    )
+
+
+class FocusWatchdog:
+    """Watches the target window's focus as a task on the playback engine's loop.
+
+    The window is tracked by its native handle rather than its title, so a
+    retitled target keeps playing and another window with the same title does
+    not count as focused. Playback only reads the ``focus_ok`` flag; on focus
+    loss the watchdog calls ``on_lost``, which stops playback within one poll
+    interval.
+    """
+
+    def __init__(self, window, window_title, on_lost, interval=DEFAULT_FOCUS_INTERVAL):
+        """Initializes the watchdog without starting it.
+
+        Args:
+            window (pygetwindow.Window): The target window.
+            window_title (str): The title used to select the target window.
+            on_lost (callable): Called once, from the engine loop, on focus loss.
+            interval (float): Seconds between focus checks.
+        """
+        self.window_title = window_title
+        self.on_lost = on_lost
+        self.interval = interval
+        self.handle = getattr(window, "_hWnd", None)
+        self.focus_ok = True
+        self.check_cost = 0.0  # Seconds taken by the latest focus check
+        try:
+            self._get_foreground = ctypes.windll.user32.GetForegroundWindow
+        except AttributeError:
+            self._get_foreground = None  # Not on Windows
 
-import pygetwindow as gw
-import requests
-import serial
-import serial.tools.list_ports
+    def start(self):
+        """Checks focus once, calling ``on_lost`` if the target is not focused.
 
-# --- Configuration File ---
-CONFIG_FILE = "config.json"
+        Returns:
+            bool: True if the target window is focused.
+        """
+        self.focus_ok = self._check()
+        if not self.focus_ok:
+            self.on_lost()
+        return self.focus_ok
+
+    async def watch(self):
+        """Keeps checking focus until it is lost or the task is cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            started = time.perf_counter()
+            ok = self._check()
+            self.check_cost = time.perf_counter() - started
+            if not ok:
+                self.focus_ok = False
+                self.on_lost()
+                return
+
+    def _check(self):
+        """Returns True if the target window is in the foreground."""
+        try:
+            if self.handle is not None and self._get_foreground is not None:
+                active = self._get_foreground()
+                if active == self.handle:
+                    return True
+                print(
+                    f"\nWindow focus lost. Expected '{self.window_title}' (handle {self.handle}), "
+                    f"got handle {active}. Stopping macro."
+                )
+                return False
+            active_window_title = gw.getActiveWindowTitle()
+            if active_window_title == self.window_title:
+                return True
+            print(
+                f"\nWindow focus lost. Expected '{self.window_title}', got '{active_window_title}'. Stopping macro."
+            )
+        except Exception as e:
+            print(f"Could not get active window: {e}. Stopping macro.")
+        return False
 
 
-class TelegramHandler:
-    """Handles sending messages via Telegram API."""
+class PortDiscovery:
+    """Finds the Pico DATA port by probing COM ports in parallel.
 
-    def __init__(self, bot_token, chat_id):
-        """Initializes the Telegram handler with bot token and chat ID.
+    Candidates are probed concurrently on a bounded thread pool and the
+    remaining probes are cancelled as soon as one port answers PICO_READY, so a
+    scan takes about one probe's time rather than one per port. Concurrent
+    ``discover`` calls are merged into a single scan. The last confirmed port
+    is remembered by USB VID/PID/serial number and interface and tried first.
+    """
+
+    def __init__(self, max_workers=4, cache_file=PORT_CACHE_FILE):
+        """Initializes the discovery service.
 
         Args:
-            bot_token (str): The Telegram bot token for authentication.
-            chat_id (str): The chat ID where messages will be sent.
+            max_workers (int): Maximum ports probed at the same time.
+            cache_file (str, optional): JSON file remembering the last good port's
+                USB identity; None keeps it in memory only.
         """
-        self.bot_token = bot_token
-        self.chat_id = chat_id
+        self.max_workers = max(1, max_workers)
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._pending = {}  # exclude_port -> Future of the scan in progress
+        self._known_identity = None
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r") as f:
+                    self._known_identity = json.load(f).get("identity")
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable port cache: {e}")
 
-    def send_message(self, text):
-        """Sends a message to the configured Telegram chat.
+    def discover(self, exclude_port=None):
+        """Returns the Pico DATA port, joining a scan already in progress.
 
         Args:
-            text (str): The message text to send.
+            exclude_port (str, optional): A port to exclude from scanning.
+
+        Returns:
+            str or None: The port string if found, else None.
         """
-        url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
-        params = {"chat_id": self.chat_id, "text": text}
+        with self._lock:
+            future = self._pending.get(exclude_port)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._pending[exclude_port] = future
+        if not owner:
+            return future.result()
         try:
-            response = requests.post(url, params=params)
-            if response.status_code == 200:
-                logging.info("Telegram message sent successfully.")
-            else:
-                logging.error(f"Failed to send message: {response.text}")
+            future.set_result(self._scan(exclude_port))
+        except Exception as e:
+            logging.error(f"Port discovery failed: {e}")
+            future.set_result(None)
+        finally:
+            with self._lock:
+                del self._pending[exclude_port]
+        return future.result()
+
+    def discover_all(self, exclude=()):
+        """Returns every port that answers as a Pico DATA port, probing in parallel.
+
+        Args:
+            exclude (iterable): Ports not to probe, e.g. ones already in use.
+
+        Returns:
+            list: The DATA ports found, sorted.
+        """
+        exclude = set(exclude)
+        candidates = [
+            i.device for i in list_ports.comports() if i.device not in exclude
+        ]
+        if not candidates:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(candidates)),
+            thread_name_prefix="pico-probe",
+        ) as pool:
+            answers = list(pool.map(self.probe, candidates))
+        return sorted(p for p, ok in zip(candidates, answers) if ok)
+
+    @staticmethod
+    def identity(info):
+        """Returns a stable USB identity string for a port, or None if not USB.
+
+        The console and DATA ports of one Pico share VID/PID/serial number, so
+        the interface number (last part of the location) is included.
+
+        Args:
+            info (serial.tools.list_ports_common.ListPortInfo): The port info.
+        """
+        if getattr(info, "vid", None) is None:
+            return None
+        interface = (getattr(info, "location", "") or "").rsplit(".", 1)[-1]
+        return f"{info.vid:04X}:{info.pid:04X}:{info.serial_number or ''}:{interface}"
+
+    def _scan(self, exclude_port):
+        """Probes candidate ports, the remembered one first, and returns the first hit."""
+        infos = [i for i in list_ports.comports() if i.device != exclude_port]
+        known = [
+            i
+            for i in infos
+            if self._known_identity and self.identity(i) == self._known_identity
+        ]
+        if known and self.probe(known[0].device):
+            return known[0].device
+
+        candidates = [i for i in infos if not known or i.device != known[0].device]
+        if not candidates:
+            return None
+        cancel = threading.Event()
+        found = None
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(candidates)),
+            thread_name_prefix="pico-probe",
+        )
+        try:
+            futures = {pool.submit(self.probe, i.device, cancel): i for i in candidates}
+            for future in concurrent.futures.as_completed(futures):
+                if future.result():
+                    found = futures[future]
+                    break
+        finally:
+            cancel.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+        if found is not None:
+            self._remember(found)
+            return found.device
+        return None
+
+    def _remember(self, info):
+        """Caches the USB identity of a confirmed DATA port."""
+        identity = self.identity(info)
+        if not identity or identity == self._known_identity:
+            return
+        self._known_identity = identity
+        if self.cache_file:
+            try:
+                with open(self.cache_file, "w") as f:
+                    json.dump(
+                        {"identity": identity, "device": info.device}, f, indent=4
+                    )
+            except Exception as e:
+                logging.warning(f"Could not save port cache: {e}")
+
+    def probe(self, p, cancel=None):
+        """Checks whether ``p`` is the Pico DATA port by eliciting PICO_READY.
+
+        Args:
+            p (str): The port to probe.
+            cancel (threading.Event, optional): Set to abandon the probe early.
+
+        Returns:
+            bool: True if the port answered PICO_READY and is not the console.
+        """
+        cancel = cancel or threading.Event()
+        try:
+            ser = serial.Serial(p, 115200, timeout=0.1, write_timeout=0.5)
+            try:
+                try:
+                    ser.dtr = False
+                    time.sleep(0.05)
+                    ser.dtr = True
+                    ser.rts = False
+                except Exception:
+                    pass
+                time.sleep(0.1)
+
+                got_ready = False
+                found_console = False
+
+                # Read a couple of lines, see if console banner appears or we already have PICO_READY
+                t0 = time.time()
+                while time.time() - t0 < 1.0 and not cancel.is_set():
+                    line = ser.readline().decode("utf-8", errors="ignore").strip()
+                    if not line:
+                        continue
+                    lower = line.lower()
+                    if (
+                        ("circuitpython" in lower)
+                        or ("repl" in lower)
+                        or lower.startswith(">>>")
+                    ):
+                        found_console = True
+                        break
+                    if line == "PICO_READY":
+                        got_ready = True
+                        break
+
+                if not got_ready and not found_console and not cancel.is_set():
+                    try:
+                        ser.write(b"hello|handshake\n")
+                        ser.flush()
+                    except Exception:
+                        pass
+                    t1 = time.time()
+                    while time.time() - t1 < 1.5 and not cancel.is_set():
+                        line = ser.readline().decode("utf-8", errors="ignore").strip()
+                        if line == "PICO_READY":
+                            got_ready = True
+                            break
+                        if line:
+                            lower = line.lower()
+                            if (
+                                ("circuitpython" in lower)
+                                or ("repl" in lower)
+                                or lower.startswith(">>>")
+                            ):
+                                found_console = True
+                                break
+            finally:
+                ser.close()
+            return got_ready and not found_console
+        except Exception:
+            return False
+
+
+class PlaybackEngine:
+    """Runs playback as asyncio tasks on one event-loop thread.
+
+    Session setup and teardown, focus checks and the waits between them are
+    tasks on a single loop, so stopping cancels them at once instead of at the
+    next poll. The per-event timing loop is the exception: it runs on one
+    dedicated player thread via ``run_blocking``, because it blocks in pyserial
+    writes and spins on ``perf_counter`` for sub-millisecond deadlines, which
+    asyncio timers (about 15 ms resolution on Windows) cannot match. It wakes
+    on the shared stop event, so it stops within milliseconds too.
+    """
+
+    def __init__(self, players=1):
+        """Initializes the engine; the loop thread starts on first use.
+
+        Args:
+            players (int): Player threads, one per device playing at once.
+        """
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._player = concurrent.futures.ThreadPoolExecutor(
+            max_workers=players, thread_name_prefix="picobot-player"
+        )
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self.loop.run_forever, name="picobot-engine", daemon=True
+                )
+                self._thread.start()
+            return self.loop
+
+    def submit(self, coro):
+        """Schedules a coroutine on the engine loop from any thread.
+
+        Args:
+            coro (coroutine): The coroutine to run.
+
+        Returns:
+            concurrent.futures.Future: Its result; cancelling it cancels the task.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run_blocking(self, func, *args):
+        """Runs ``func(*args)`` on the player thread, from a task on the engine loop.
+
+        Returns:
+            asyncio.Future: Awaitable result of the call.
+        """
+        return asyncio.get_running_loop().run_in_executor(self._player, func, *args)
+
+    def call_later(self, delay, callback, *args, interval=None):
+        """Runs ``callback(*args)`` on the engine loop after ``delay`` seconds.
+
+        All timers share the loop's timer heap, so any number of them costs no
+        extra thread. Safe to call from any thread; callbacks must not block.
+
+        Args:
+            delay (float): Seconds until the first call.
+            callback (callable): The function to call.
+            interval (float, optional): Repeat every ``interval`` seconds,
+                measured from the first deadline so that ticks do not drift.
+
+        Returns:
+            EngineTimer: Handle whose ``cancel()`` is safe from any thread.
+        """
+        loop = self._ensure_loop()
+        timer = EngineTimer(loop, callback, args, interval)
+        loop.call_soon_threadsafe(self._arm, timer, loop.time() + delay)
+        return timer
+
+    def call_every(self, interval, callback, *args):
+        """Runs ``callback(*args)`` every ``interval`` seconds; see ``call_later``."""
+        return self.call_later(interval, callback, *args, interval=interval)
+
+    def _arm(self, timer, due):
+        if not timer.cancelled:
+            timer.due = due
+            timer.handle = self.loop.call_at(due, self._fire, timer)
+
+    def _fire(self, timer):
+        if timer.cancelled:
+            return
+        try:
+            timer.callback(*timer.args)
         except Exception as e:
-            logging.error(f"Error sending Telegram message: {e}")
+            logging.error(f"Timer callback failed: {e}")
+        if timer.interval is not None:
+            self._arm(timer, timer.due + timer.interval)
+
+    def close(self, wait=False):
+        """Stops the loop and the player thread.
+
+        Args:
+            wait (bool): Also wait for a call running on the player thread,
+                e.g. one releasing held keys, to return.
+        """
+        with self._lock:
+            loop, self.loop = self.loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout=1.0)
+        self._player.shutdown(wait=wait)
+
+
+class EngineTimer:
+    """Handle of a timer scheduled with ``PlaybackEngine.call_later``."""
+
+    __slots__ = ("loop", "callback", "args", "interval", "cancelled", "due", "handle")
+
+    def __init__(self, loop, callback, args, interval):
+        self.loop = loop
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+        self.due = 0.0
+        self.handle = None
+
+    def cancel(self):
+        """Cancels the timer; it does not fire again once this returns."""
+        self.cancelled = True
+        handle = self.handle
+        if handle is not None and not self.loop.is_closed():
+            # Drops the heap entry too, on the loop thread where that is safe
+            self.loop.call_soon_threadsafe(handle.cancel)
+
+
+class _Unwatched:
+    """Stands in for FocusWatchdog when no target window is given, e.g. when the
+    Pico types into another machine."""
+
+    focus_ok = True
+    check_cost = 0.0
+
+
+class TkBridge:
+    """Hands callbacks from engine threads to the Tk main loop through a queue.
+
+    Callbacks are queued in order and run in batches on the Tk thread; other
+    threads only schedule a wake-up when no drain is already pending.
+    """
+
+    def __init__(self, root):
+        """Initializes the bridge.
+
+        Args:
+            root (tk.Tk): The main Tkinter window.
+        """
+        self.root = root
+        self.closed = False
+        self._queue = queue.SimpleQueue()
+        self._pending = threading.Event()
+
+    def post(self, callback, *args):
+        """Queues ``callback(*args)`` to run on the Tk thread. Safe from any thread.
+
+        Once the bridge is closed (the window is gone), callbacks are dropped.
+        """
+        if self.closed:
+            return
+        self._queue.put((callback, args))
+        if not self._pending.is_set():
+            self._pending.set()
+            try:
+                self.root.after(0, self._drain)
+            except Exception:
+                pass  # Window destroyed while posting
+
+    def close(self):
+        """Drops callbacks posted from now on, e.g. after the window closed."""
+        self.closed = True
+
+    def _drain(self):
+        # Cleared first, so anything posted from here on schedules another drain
+        self._pending.clear()
+        while True:
+            try:
+                callback, args = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.error(f"UI callback failed: {e}")
+
+
+class VirtualClock:
+    """Time source that only moves when told to, for running without sleeping."""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        """Advances the clock instead of waiting."""
+        self.now += max(0.0, seconds)
+
+    def advance_to(self, t):
+        """Moves the clock forward to ``t``; it never goes back."""
+        self.now = max(self.now, t)
+
+
+class LoopbackSerial:
+    """In-process stand-in for a serial port with a simulated Pico on the far end.
+
+    Written bytes are handed to the device when the host reads, so commands
+    written back to back arrive as one burst and get one cumulative ACK, as
+    over USB. Implements the part of ``serial.Serial`` that CommandPipeline
+    uses.
+    """
+
+    def __init__(self, protocol):
+        """Initializes the link.
+
+        Args:
+            protocol: The simulated device, e.g. a pico_sim.PicoProtocol; its
+                ``receive(data)`` returns the device's reply.
+        """
+        self.protocol = protocol
+        self.timeout = 0
+        self._tx = bytearray()
+        self._rx = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def write(self, data):
+        self._tx += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self, size=1):
+        if self._tx:
+            self._rx += self.protocol.receive(bytes(self._tx))
+            self._tx.clear()
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def close(self):
+        pass
 
 
 class MacroController:
     """Controls macro playback and Pico communication."""
 
-    def __init__(self, app):
+    def __init__(self, app, engine=None, share_with=None, claimed_ports=None):
         """Initializes the MacroController with a reference to the main application.
 
         Args:
             app (MacroControllerApp): The main application instance.
+            engine (PlaybackEngine, optional): Engine to run on; by default
+                that of ``share_with``, or a new one.
+            share_with (MacroController, optional): Controller whose compiled
+                macro cache, catalog and port discovery are reused.
+            claimed_ports (callable, optional): Returns ports in use by other
+                controllers, which reconnect discovery must not probe.
         """
         self.app = app
+        if share_with is None:
+            self.macro_cache = MacroCache(self.parse_macro_file)
+            self.discovery = PortDiscovery()
+            self._catalog = None
+        else:
+            self.macro_cache = share_with.macro_cache
+            self.discovery = share_with.discovery
+            self._catalog = share_with.catalog
+        self.engine = engine or (share_with.engine if share_with else PlaybackEngine())
+        self.claimed_ports = claimed_ports
+        self.telemetry = PlaybackTelemetry()
+        self.macros_played = 0
+        self.events_played = 0
+        self.last_error = ""
+        self._run = None
+
+    @property
+    def catalog(self):
+        """MacroCatalog: The macro folder index, opened on first use."""
+        if self._catalog is None:
+            self._catalog = MacroCatalog()
+        return self._catalog
 
     def refresh_ports(self):
         """Refreshes the list of available COM ports in the UI."""
-        ports = [port.device for port in serial.tools.list_ports.comports()]
+        ports = [port.device for port in list_ports.comports()]
         self.app.port_menu["values"] = ports
         try:
             self.app.port_menu.set("")
@@ -96,9 +2683,7 @@ class MacroController:
             if not port:
                 port = self.find_data_port()
             if port:
-                self.app.root.after(
-                    0, lambda p=port: self._set_selected_port_if_appropriate(p, force)
-                )
+                self.app.post_ui(self._set_selected_port_if_appropriate, port, force)
             else:
                 logging.warning(
                     "No Pico DATA port detected. Connect and click Refresh."
@@ -113,7 +2698,7 @@ class MacroController:
             str or None: The device name of the Pico DATA port if found, else None.
         """
         try:
-            for info in serial.tools.list_ports.comports():
+            for info in list_ports.comports():
                 loc = getattr(info, "location", "") or ""
                 if loc.endswith("x.2"):
                     return info.device
@@ -141,201 +2726,394 @@ class MacroController:
             self.app.selected_port.set(port)
             logging.info(f"Auto-selected Pico DATA port {port}")
 
-    def find_data_port(self, exclude_port=None):
-        """Scan COM ports to find the Pico DATA CDC port by eliciting PICO_READY.
-
-        Args:
-            exclude_port (str, optional): A port to exclude from scanning.
-
-        Returns:
-            str or None: The port string if found, else None.
-        """
-        candidates = list(serial.tools.list_ports.comports())
-        for info in candidates:
-            p = info.device
-            if exclude_port and p == exclude_port:
-                continue
-            try:
-                ser = serial.Serial(p, 115200, timeout=0.5, write_timeout=0.5)
-                try:
-                    ser.dtr = False
-                    time.sleep(0.05)
-                    ser.dtr = True
-                    ser.rts = False
-                except Exception:
-                    pass
-                time.sleep(0.1)
-
-                got_ready = False
-                found_console = False
-
-                t0 = time.time()
-                while time.time() - t0 < 1.0:
-                    line = ser.readline().decode("utf-8", errors="ignore").strip()
-                    if not line:
-                        continue
-                    lower = line.lower()
-                    if (
-                        ("circuitpython" in lower)
-                        or ("repl" in lower)
-                        or lower.startswith(">>>")
-                    ):
-                        found_console = True
-                        break
-                    if line == "PICO_READY":
-                        got_ready = True
-                        break
-
-                if not got_ready and not found_console:
-                    try:
-                        ser.write(b"hello|handshake\n")
-                        ser.flush()
-                    except Exception:
-                        pass
-                    t1 = time.time()
-                    while time.time() - t1 < 1.5:
-                        line = ser.readline().decode("utf-8", errors="ignore").strip()
-                        if line == "PICO_READY":
-                            got_ready = True
-                            break
-                        if line:
-                            lower = line.lower()
-                            if (
-                                ("circuitpython" in lower)
-                                or ("repl" in lower)
-                                or lower.startswith(">>>")
-                            ):
-                                found_console = True
-                                break
-
-                ser.close()
-                if got_ready and not found_console:
-                    return p
-            except Exception:
-                continue
-        return None
-
-    def _finalize_handshake(self, ser):
-        """Finalizes the handshake with the Pico device after receiving PICO_READY.
+    def find_data_port(self, exclude_port=None):
+        """Find the Pico DATA CDC port by eliciting PICO_READY.
 
-        After seeing PICO_READY, explicitly sends HELLO so the Pico stops periodic READY.
-        Then waits briefly for its PICO_READY response and clears any leftover input.
+        Probes run concurrently and concurrent callers share one scan; see
+        PortDiscovery.
 
         Args:
-            ser (serial.Serial): The serial connection to the Pico device.
+            exclude_port (str, optional): A port to exclude from scanning.
+
+        Returns:
+            str or None: The port string if found, else None.
         """
-        try:
-            ser.write(b"hello|handshake\n")
-            ser.flush()
-        except Exception:
-            pass
-        end = time.time() + 0.8
-        while time.time() < end:
-            try:
-                line = ser.readline().decode("utf-8", errors="ignore").strip()
-            except Exception:
-                break
-            if not line:
-                continue
-            if line == "PICO_READY":
-                break
-        try:
-            ser.reset_input_buffer()
-        except Exception:
-            pass
+        if self.claimed_ports is not None:
+            # Several Picos: take the first one no other controller is using
+            claimed = set(self.claimed_ports())
+            claimed.add(exclude_port)
+            found = self.discovery.discover_all(exclude=claimed)
+            return found[0] if found else None
+        return self.discovery.discover(exclude_port=exclude_port)
 
-    def _wait_for_ack(self, ser, timeout=1.5):
-        """Waits for an ACK response from the Pico device.
+    def parse_macro_file(self, filename):
+        try:
+            with open(filename, "r") as f:
+                events = parse_macro_lines(f)
+        except Exception as e:
+            print(f"Warning: Could not parse macro file '{filename}'.\nError: {e}")
+            return None
+        events, removed = collapse_autorepeat(events)
+        if removed:
+            logging.info(
+                f"Removed {removed} autorepeat event(s) from '{os.path.basename(filename)}'."
+            )
+        return events
 
-        Waits for an ACK line, ignoring blank lines and stray PICO_READY messages.
+    def _timeline_capacity(self, caps):
+        """Returns how many events the Pico's timeline can hold (0 if unsupported).
 
         Args:
-            ser (serial.Serial): The serial connection to the Pico device.
-            timeout (float): The maximum time to wait for an ACK in seconds.
+            caps (set): Capability tokens reported by the Pico.
 
         Returns:
-            bool: True if ACK received, False otherwise.
+            int: Maximum number of timeline events.
         """
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            try:
-                line = ser.readline().decode("utf-8", errors="ignore").strip()
-            except Exception:
-                return False
-            if not line:
-                continue
-            if line == "ACK":
-                return True
-            if line == "PICO_READY":
-                # Ignore and keep waiting for the ACK corresponding to our command
-                continue
-        return False
+        if "tl" not in caps or "seq" not in caps:
+            return 0
+        for cap in caps:
+            if cap.startswith("tlmax="):
+                try:
+                    return int(cap[len("tlmax=") :])
+                except ValueError:
+                    return 0
+        return 0
 
-    def interruptible_sleep(self, duration):
-        """Sleeps for a specified duration but can be interrupted if macro stops playing.
+    def _play_streamed(self, pipeline, macro, watchdog):
+        """Plays events by sleeping on the host and streaming each one to the Pico.
 
         Args:
-            duration (float): The duration to sleep in seconds.
+            pipeline (CommandPipeline): The command pipeline for the session.
+            macro (CompiledMacro): The compiled macro to play.
+            watchdog (FocusWatchdog): The running focus watchdog.
 
         Returns:
-            bool: True if sleep completed, False if interrupted.
+            dict: The PlaybackTelemetry summary for this macro.
         """
-        end_time = time.time() + duration
-        while time.time() < end_time:
-            if not self.app.is_playing:
-                return False
-            time.sleep(0.01)
-        return True
+        commands = macro.commands(pipeline)
+        delays = macro.delays
+        keys_down = self.app.keys_currently_down
+        scheduler = DeadlineScheduler(self.app.stop_event, self.app.spin_threshold)
+        scheduler.start()
+        telemetry = self.telemetry
+        telemetry.start(macro.path, len(macro), scheduler.t0, pipeline.acked)
+        pipeline.on_ack = telemetry.on_ack
+        offset = 0.0
+        written = 0.0
+        for i in range(len(macro)):
+            offset += delays[i]
+            command = commands[i]
+            if command is not None:
+                if not self.app.is_playing:
+                    break
 
-    def parse_macro_file(self, filename):
-        events = []
+                # Focus is watched in the background; this is only a flag read
+                if not watchdog.focus_ok:
+                    break
+
+                # Absolute deadline from the macro start, so delays never accumulate
+                if not scheduler.wait_until(offset, pipeline.poll):
+                    break
+
+                # Stream without waiting for this command's ACK; the
+                # pipeline only blocks once the in-flight window is full.
+                written = time.perf_counter()
+                if not pipeline.send_prepared(command):
+                    print(f"Warning: {pipeline.error} Stopping to prevent de-sync.")
+                    self.app.is_playing = False
+                    self._notify("ack_timeout", f"{pipeline.error} Playback stopped.")
+                    break
+            # else: part of the batch already sent for an earlier event
+            telemetry.record(offset, written, watchdog.check_cost, pipeline.sent - 1)
+
+            if macro.down[i]:
+                keys_down.add(macro.key(i))
+            else:
+                keys_down.discard(macro.key(i))
+
+        if pipeline.in_flight and not pipeline.error:
+            if not pipeline.drain():
+                print(f"Warning: {pipeline.error} Stopping to prevent de-sync.")
+                self.app.is_playing = False
+                self._notify("ack_timeout", f"{pipeline.error} Playback stopped.")
+
+        pipeline.on_ack = None
+        return self._report_telemetry()
+
+    def _report_telemetry(self):
+        """Shows the last run's timing summary and exports it if configured.
+
+        Returns:
+            dict: The summary.
+        """
+        summary = self.telemetry.summary()
+        self.app.post_ui(self.app.timing_status_var.set, format_timing_summary(summary))
+        if not self.app.telemetry_dir:
+            return summary
         try:
-            with open(filename, "r") as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) == 3:
-                        timestamp, event_type, key = parts
-                        events.append(
-                            {"time": float(timestamp), "type": event_type, "key": key}
-                        )
+            os.makedirs(self.app.telemetry_dir, exist_ok=True)
+            name = os.path.splitext(os.path.basename(summary["macro"]))[0]
+            path = os.path.join(
+                self.app.telemetry_dir,
+                f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.{self.app.telemetry_format}",
+            )
+            self.telemetry.export(path)
         except Exception as e:
-            print(f"Warning: Could not parse macro file '{filename}'.\nError: {e}")
-            return None
-        return events
+            logging.warning(f"Could not export timing telemetry: {e}")
+        return summary
+
+    def _play_timeline(self, pipeline, macro, watchdog):
+        """Uploads the macro to the Pico and supervises device-timed playback.
+
+        Every event is sent with its offset from the first event in microseconds.
+        After ``tl_start`` the Pico fires the events against its own clock, so
+        host scheduling jitter and serial latency do not affect timing. The host
+        only watches focus, forwards stops as ``tl_abort`` and follows the
+        Pico's TL_PROG/TL_DONE reports.
+
+        Args:
+            pipeline (CommandPipeline): The command pipeline for the session.
+            macro (CompiledMacro): The compiled macro to play.
+            watchdog (FocusWatchdog): The running focus watchdog.
+
+        Returns:
+            int: Number of events the Pico reported fired.
+        """
+        # Uploading into a timeline that was not cleared would mix two macros
+        if not (pipeline.send("tl_clear", "-") and pipeline.drain()):
+            print(
+                f"Warning: {pipeline.error} Could not clear the timeline. Stopping macro."
+            )
+            self.app.is_playing = False
+            return 0
+        offset = 0.0
+        for i in range(len(macro)):
+            offset += macro.delays[i]
+            offset_us = int(round(offset * 1_000_000))
+            if not pipeline.send(f"tl_{macro.event_type(i)}", macro.key(i), offset_us):
+                break
+        pipeline.messages.clear()
+        if not pipeline.drain() or not pipeline.send("tl_start", "-"):
+            print(f"Warning: {pipeline.error} Timeline upload failed. Stopping macro.")
+            self.app.is_playing = False
+            return 0
+        logging.info(f"Timeline of {len(macro)} events started on the Pico.")
+
+        fired = 0
+        finished = False
+        last_report = time.monotonic()
+        # Sleeps in the serial read until the Pico reports (every 0.25 s) or a
+        # stop cancels the read
+        self.app.on_stop.append(pipeline.cancel_wait)
+        try:
+            while self.app.is_playing and watchdog.focus_ok:
+                pipeline.wait_for_message(
+                    last_report + TIMELINE_HEARTBEAT_TIMEOUT - time.monotonic(),
+                    self.app.stop_event,
+                )
+                while pipeline.messages:
+                    parts = pipeline.messages.popleft().split()
+                    if parts[0] in ("TL_PROG", "TL_DONE") and len(parts) > 1:
+                        fired = int(parts[1])
+                        last_report = time.monotonic()
+                        finished = parts[0] == "TL_DONE"
+                if finished or not self.app.is_playing:
+                    break
+                if (
+                    pipeline.error
+                    or time.monotonic() - last_report >= TIMELINE_HEARTBEAT_TIMEOUT
+                ):
+                    print(
+                        f"Warning: Lost contact with timeline playback ({pipeline.error or 'no progress report'})."
+                    )
+                    self.app.is_playing = False
+                    self._notify(
+                        "ack_timeout", "Lost contact with the Pico; playback stopped."
+                    )
+                    break
+        finally:
+            self.app.on_stop.remove(pipeline.cancel_wait)
+
+        if finished:
+            # Keys the macro leaves held are released by the usual cleanup
+            for i in range(len(macro)):
+                if macro.down[i]:
+                    self.app.keys_currently_down.add(macro.key(i))
+                else:
+                    self.app.keys_currently_down.discard(macro.key(i))
+            logging.info(f"Timeline playback finished ({fired} events).")
+            return fired
+
+        # Stopped early: a Pico in sync releases everything it pressed on abort.
+        # After an error it ignores tl_abort until release_all, which the
+        # cleanup in _release_stuck_keys sends at once and which also reports
+        # the keys really left pressed.
+        if (
+            not pipeline.error
+            and pipeline.send("tl_abort", "-")
+            and pipeline.drain(timeout=0.8)
+        ):
+            self.app.keys_currently_down.clear()
+        logging.info(f"Timeline playback aborted after {fired}/{len(macro)} events.")
+        return fired
+
+    def start_playback(self, port, window_title, macro_folder):
+        """Starts the playlist loop on the playback engine.
+
+        Args:
+            port (str): The Pico DATA port.
+            window_title (str): Title of the target window.
+            macro_folder (str): The folder path containing macro files to play.
+
+        Returns:
+            concurrent.futures.Future: Completes when playback has stopped.
+        """
+        self.app.is_playing = True
+        self._run = self.engine.submit(
+            self.play_macro(port, window_title, macro_folder)
+        )
+        return self._run
+
+    def stop_playback(self):
+        """Stops playback from any thread; waits in progress end immediately."""
+        self.app.is_playing = False
+        run = self._run
+        if run is not None:
+            run.cancel()
 
     def play_macro_thread(self, port, window_title, macro_folder):
+        """Plays the macro folder on the engine and blocks until playback stops."""
+        try:
+            self.start_playback(port, window_title, macro_folder).result()
+        except concurrent.futures.CancelledError:
+            pass
+
+    async def play_macro(self, port, window_title, macro_folder):
+        """Engine task: focuses the target, then plays playlists until stopped.
+
+        Args:
+            port (str): The Pico DATA port.
+            window_title (str): Title of the target window; empty to play
+                without activating or watching a window.
+            macro_folder (str): The folder path containing macro files to play.
+        """
         self.app.is_playing = True
-        self.app.status_text.set("Status: Playing...")
+        self.app.post_ui(self.app.status_text.set, "Status: Playing...")
         self.app.keys_currently_down.clear()
-
+        self.macro_cache.chord_tolerance = self.app.chord_tolerance
+        watch_task = None
+        timers = [
+            self.engine.call_every(
+                self.app.status_interval, self._show_progress, time.monotonic()
+            )
+        ]
+        if self.app.session_limit > 0:
+            timers.append(
+                self.engine.call_later(self.app.session_limit, self._on_session_limit)
+            )
         try:
-            target_windows = gw.getWindowsWithTitle(window_title)
-            if not target_windows:
-                print(f"Error: Target window '{window_title}' not found.")
+            watchdog = _Unwatched()
+            if window_title:
+                try:
+                    target_windows = gw.getWindowsWithTitle(window_title)
+                    if not target_windows:
+                        print(f"Error: Target window '{window_title}' not found.")
+                        return
+                    target_windows[0].activate()
+                except Exception as e:
+                    print(f"Error activating window: {e}")
+                    return
+
+                await asyncio.sleep(1)
+
+                watchdog = FocusWatchdog(
+                    target_windows[0],
+                    window_title,
+                    on_lost=self._on_focus_lost,
+                    interval=self.app.focus_interval,
+                )
+                if watchdog.start():
+                    watch_task = asyncio.create_task(watchdog.watch())
+            player = self.engine.run_blocking(
+                self._play_session, port, watchdog, macro_folder
+            )
+            try:
+                await asyncio.shield(player)
+            except asyncio.CancelledError:
                 self.app.is_playing = False
-                self.app.root.after(0, self.app.on_macro_thread_exit)
-                return
-            target_windows[0].activate()
-        except Exception as e:
-            print(f"Error activating window: {e}")
+                await player  # Wakes on the stop event and releases held keys
+                raise
+        finally:
+            for timer in timers:
+                timer.cancel()
+            if watch_task is not None:
+                watch_task.cancel()
             self.app.is_playing = False
-            self.app.root.after(0, self.app.on_macro_thread_exit)
-            return
+            logging.info("Macro thread is finishing.")
+            self._notify("stopped", "Playback stopped.")
+            self.app.post_ui(self.app.on_macro_thread_exit)
+
+    def _play_session(self, port, watchdog, macro_folder):
+        """Player thread: opens the Pico session and plays playlists over it.
+
+        Args:
+            port (str): The Pico DATA port.
+            watchdog (FocusWatchdog): The running focus watchdog.
+            macro_folder (str): The folder path containing macro files to play.
+        """
+        session = PicoSession(
+            port,
+            find_data_port=self.find_data_port,
+            ack_window=self.app.ack_window,
+            binary=self.app.binary_protocol,
+        )
+        try:
+            self._play_playlists(session, watchdog, macro_folder)
+        finally:
+            session.close()
+
+    def _show_progress(self, started):
+        """Engine timer: shows how long the current run has been playing."""
+        elapsed = time.strftime("%H:%M:%S", time.gmtime(time.monotonic() - started))
+        self.app.post_ui(self.app.status_text.set, f"Status: Playing... ({elapsed})")
+
+    def _on_session_limit(self):
+        """Engine timer: stops playback once the session time limit is reached."""
+        print("Session time limit reached. Stopping macro.")
+        self.stop_playback()
+
+    def _on_focus_lost(self):
+        """Stops playback when the focus watchdog reports the target lost focus."""
+        self.app.is_playing = False
+        self._notify("focus_lost", "Target window lost focus; playback stopped.")
 
-        time.sleep(1)
+    def _notify(self, event, text):
+        """Queues a Telegram notification if ``event`` is enabled in notify_events.
 
+        Args:
+            event (str): One of NOTIFY_EVENTS.
+            text (str): The message text.
+        """
+        if event in self.app.notify_events:
+            self.app.telegram.send_message(f"PicoBot: {text}")
+
+    def _play_playlists(self, session, watchdog, macro_folder):
+        """Plays randomized playlists from the macro folder over one session.
+
+        Args:
+            session (PicoSession): The Pico session shared by every macro.
+            watchdog (FocusWatchdog): The running focus watchdog.
+            macro_folder (str): The folder path containing macro files to play.
+        """
         while self.app.is_playing:
             try:
-                all_macro_files = [
-                    f for f in os.listdir(macro_folder) if f.endswith(".txt")
-                ]
-                if not all_macro_files:
+                # Incremental: only files added, changed or removed are touched
+                self.catalog.scan(macro_folder)
+                start_files, other_files = self.catalog.playlist_files(macro_folder)
+                if not start_files and not other_files:
                     print("Error: No '.txt' files found in folder. Stopping loop.")
                     break
 
-                start_files = [f for f in all_macro_files if f.startswith("START_")]
-                other_files = [f for f in all_macro_files if not f.startswith("START_")]
-
                 random.shuffle(start_files)
                 random.shuffle(other_files)
 
@@ -346,199 +3124,309 @@ class MacroController:
                 logging.error(f"Error creating playlist: {e}. Stopping loop.")
                 break
 
-            for chosen_macro_name in current_playlist:
-                if not self.app.is_playing:
-                    break
+            # Upcoming entries are loaded in the background while one plays
+            prefetcher = MacroPrefetcher(
+                self.macro_cache,
+                self.app.prefetch_depth,
+                self.app.stop_event,
+                on_loaded=self.catalog.update,
+            )
+            prefetcher.start(
+                [os.path.join(macro_folder, name) for name in current_playlist]
+            )
+            self.app.on_stop.append(prefetcher.wake)
+            try:
+                for macro_file_path, macro in prefetcher:
+                    self._play_entry(session, watchdog, macro_file_path, macro)
+            finally:
+                self.app.on_stop.remove(prefetcher.wake)
+                prefetcher.stop()
 
-                logging.info(f"Playing from sequence: {chosen_macro_name}")
-                macro_file_path = os.path.join(macro_folder, chosen_macro_name)
+    def _play_entry(self, session, watchdog, macro_file_path, macro):
+        """Plays one prefetched playlist entry.
 
-                events = self.parse_macro_file(macro_file_path)
-                if events is None:
-                    continue
+        Args:
+            session (PicoSession): The Pico session shared by every macro.
+            watchdog (FocusWatchdog): The running focus watchdog.
+            macro_file_path (str): The macro file path.
+            macro (CompiledMacro or None): The compiled macro, None if unreadable.
+        """
+        chosen_macro_name = os.path.basename(macro_file_path)
+        logging.info(f"Playing from sequence: {chosen_macro_name}")
+        if macro is None:
+            return
+        if macro.errors:
+            print(
+                f"Warning: Skipping '{chosen_macro_name}': "
+                f"{len(macro.errors)} error(s), e.g. {macro.errors[0].message}"
+            )
+            return
 
-                ser = None
-                try:
-                    ser = serial.Serial(port, 115200, timeout=5)
-                    try:
-                        ser.dtr = False
-                        time.sleep(0.05)
-                        ser.dtr = True
-                        ser.rts = False
-                    except Exception:
-                        pass
-                    time.sleep(0.1)
+        # Cheap liveness check; only reconnects if the session failed
+        if not session.ensure_connected():
+            self.last_error = "Could not connect to the Pico."
+            self.app.is_playing = False
+            return
 
-                    logging.info("Waiting for PICO_READY signal...")
-                    ready_signal_received = False
-                    start_time = time.time()
-                    hello_sent = False
-                    try:
-                        ser.timeout = 0.2
-                    except Exception:
-                        pass
-                    while time.time() - start_time < 12:
-                        line = ser.readline().decode("utf-8").strip()
-                        if line == "PICO_READY":
-                            logging.info("PICO_READY signal received. Starting macro.")
-                            self._finalize_handshake(ser)
-                            ready_signal_received = True
-                            break
-                        elif line:
-                            print(f"Pico startup message: {line}")
-                            lower = line.lower()
-                            if (
-                                ("circuitpython" in lower)
-                                or ("repl" in lower)
-                                or lower.startswith(">>>")
-                            ):
-                                print(
-                                    "Detected the console CDC port. Please select the other Pico COM port (Data)."
-                                )
-                                self.app.is_playing = False
-                                break
+        try:
+            capacity = self._timeline_capacity(session.caps)
+            if (
+                self.app.device_timing
+                and 0 < len(macro) <= capacity
+                and macro.duration < TIMELINE_MAX_OFFSET
+            ):
+                played = self._play_timeline(session.pipeline, macro, watchdog)
+            else:
+                if self.app.device_timing:
+                    logging.info(
+                        "Device-side timing unavailable for this macro; streaming from host."
+                    )
+                played = self._play_streamed(session.pipeline, macro, watchdog)[
+                    "events"
+                ]
+            self.macros_played += 1
+            self.events_played += played
+            if session.pipeline.error:
+                self.last_error = session.pipeline.error
+
+        except serial.SerialException as e:
+            logging.error(f"Serial Error: {e}. Stopping macro.")
+            self.last_error = f"Serial Error: {e}"
+            self.app.is_playing = False
+        finally:
+            self._release_stuck_keys(session)
 
-                        if (not hello_sent) and (time.time() - start_time >= 1.0):
-                            try:
-                                ser.write(b"hello|handshake\n")
-                                ser.flush()
-                                hello_sent = True
-                            except Exception:
-                                pass
-
-                    if not ready_signal_received:
-                        auto_port = self.find_data_port(exclude_port=port)
-                        if auto_port and auto_port != port:
-                            logging.info(
-                                f"Auto-detected Pico DATA port: {auto_port}. Retrying handshake..."
-                            )
-                            try:
-                                ser.close()
-                            except Exception:
-                                pass
-                            port = auto_port
-                            try:
-                                ser = serial.Serial(port, 115200, timeout=5)
-                                try:
-                                    ser.dtr = False
-                                    time.sleep(0.05)
-                                    ser.dtr = True
-                                    ser.rts = False
-                                except Exception:
-                                    pass
-                                time.sleep(0.1)
-                                logging.info("Waiting for PICO_READY signal...")
-                                ready_signal_received = False
-                                start_time = time.time()
-                                hello_sent = False
-                                try:
-                                    ser.timeout = 0.2
-                                except Exception:
-                                    pass
-                                while time.time() - start_time < 12:
-                                    line = (
-                                        ser.readline()
-                                        .decode("utf-8", errors="ignore")
-                                        .strip()
-                                    )
-                                    if line == "PICO_READY":
-                                        logging.info(
-                                            "PICO_READY signal received. Starting macro."
-                                        )
-                                        self._finalize_handshake(ser)
-                                        ready_signal_received = True
-                                        break
-                                    elif line:
-                                        print(f"Pico startup message: {line}")
-                                    if (not hello_sent) and (
-                                        time.time() - start_time >= 1.0
-                                    ):
-                                        try:
-                                            ser.write(b"hello|handshake\n")
-                                            ser.flush()
-                                            hello_sent = True
-                                        except Exception:
-                                            pass
-                            except Exception as _:
-                                ready_signal_received = False
-
-                        if not ready_signal_received:
-                            logging.error("Timed out waiting for PICO_READY signal.")
-                            self.app.is_playing = False
-                            try:
-                                ser.close()
-                            except Exception:
-                                pass
-                            continue
-                    for i, event in enumerate(events):
-                        if not self.app.is_playing:
-                            break
+    def _release_stuck_keys(self, session):
+        """Releases keys still held at the end of a macro over the session.
 
-                        try:
-                            active_window_title = gw.getActiveWindowTitle()
-                            if active_window_title != window_title:
-                                print(
-                                    f"\nWindow focus lost. Expected '{window_title}', got '{active_window_title}'. Stopping macro."
-                                )
-                                self.app.is_playing = False
-                                break
-                        except Exception as e:
-                            print(
-                                f"Could not get active window title: {e}. Stopping macro."
-                            )
-                            self.app.is_playing = False
-                            break
+        Args:
+            session (PicoSession): The Pico session used for playback.
+        """
+        try:
+            pipeline = session.pipeline
+            held = self.app.keys_currently_down
+            # After a stop or an error the host's view of held keys may be
+            # wrong, so firmware that can reports the real state is asked too
+            if (
+                pipeline
+                and "rel" in session.caps
+                and (held or pipeline.error or not self.app.is_playing)
+            ):
+                started = time.perf_counter()
+                pressed = session.release_all()
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                held.clear()
+                if pressed is None:
+                    print(f"Warning: No reply to release-all ({pipeline.error}).")
+                elif pressed:
+                    print(f"Warning: Pico still reports {sorted(pressed)} pressed.")
+                    held.update(pressed)
+                else:
+                    logging.info(f"All keys released in {elapsed_ms:.1f} ms.")
+                return
+            if pipeline and self.app.keys_currently_down:
+                print("Releasing stuck keys...")
+                if pipeline.error:
+                    pipeline.reset()
+                released = list(self.app.keys_currently_down)
+                for key in released:
+                    if not pipeline.send("up", key):
+                        break
+                if pipeline.drain(timeout=0.8):
+                    print(f"Released {released} and received ACK.")
+                else:
+                    print(f"Warning: Timeout on final release ACK ({pipeline.error}).")
+            self.app.keys_currently_down.clear()
+        except Exception as e:
+            logging.error(f"Cleanup error: {e}")
+
+    def dry_run(self, macro_folder):
+        """Plays every macro in a folder against an in-process simulated Pico.
+
+        Files come from the catalog as for real playback (START_ files first,
+        then by name, including ones playlists skip as invalid), and each
+        macro is compiled through the macro cache and streamed through a real
+        CommandPipeline. The device is pico_sim's PicoProtocol, the model the
+        simulator runs, behind a LoopbackSerial, and time is virtual: each
+        command is sent the moment its deadline is reached, without sleeping.
+        For every file this checks that each line parsed, key names and
+        press/release balance (compile diagnostics), that every command was
+        acknowledged in sequence, that the device applied every event and
+        ended with no key held, and the total duration.
 
-                        if i > 0:
-                            delay = event["time"] - events[i - 1]["time"]
-                            if not self.interruptible_sleep(delay):
-                                break
+        Args:
+            macro_folder (str): The folder path containing macro files to check.
 
-                        command = f"{event['type']}|{event['key']}\n"
-                        ser.write(command.encode("utf-8"))
-                        if not self._wait_for_ack(ser, timeout=1.5):
-                            print(
-                                "Warning: Expected ACK but got none/other. Stopping to prevent de-sync."
-                            )
-                            self.app.is_playing = False
-                            break
+        Returns:
+            list: One dict per file with its status, event count, duration
+                and problems.
+        """
+        import pico_sim
+
+        self.macro_cache.chord_tolerance = self.app.chord_tolerance
+        self.catalog.scan(macro_folder)
+        # Every file, including ones playlists skip as known to be invalid
+        entries = sorted(
+            self.catalog.entries(macro_folder),
+            key=lambda e: (not e["is_start"], e["name"]),
+        )
+        report = []
+        for name in (e["name"] for e in entries):
+            path = os.path.join(macro_folder, name)
+            macro = self.macro_cache.get(path)
+            self.catalog.update(path, macro)
+            row = {"file": name, "status": "ok", "events": 0, "duration_s": 0.0}
+            if macro is None:
+                row["status"] = "error"
+                problems = ["error: could not read the file."]
+            else:
+                row["events"] = len(macro)
+                row["duration_s"] = round(macro.duration, 6)
+                problems = [
+                    f"{d.severity}: line {d.line}: {d.message}"
+                    if d.line
+                    else f"{d.severity}: {d.message}"
+                    for d in macro.diagnostics
+                    if d.severity != "info"
+                ]
+                # Rejected macros are skipped by playback, so are not played here
+                failures = [] if macro.errors else self._dry_run_macro(pico_sim, macro)
+                problems.extend(failures)
+                if macro.errors or failures:
+                    row["status"] = "error"
+                elif problems:
+                    row["status"] = "warning"
+            row["problems"] = problems
+            report.append(row)
+        return report
+
+    def _dry_run_macro(self, pico_sim, macro):
+        """Streams one compiled macro to a simulated Pico on virtual time.
 
-                        if event["type"] == "down":
-                            self.app.keys_currently_down.add(event["key"])
-                        elif event["key"] in self.app.keys_currently_down:
-                            self.app.keys_currently_down.discard(event["key"])
+        Returns:
+            list: Descriptions of anything that went wrong; empty if clean.
+        """
+        clock = VirtualClock()
+        device = pico_sim.PicoProtocol(clock=clock, sleep=clock.sleep)
+        pipeline = CommandPipeline(
+            LoopbackSerial(device),
+            window=self.app.ack_window,
+            binary=self.app.binary_protocol,
+            batch=True,
+        )
+        commands = macro.commands(pipeline)
+        offset = 0.0
+        for i in range(len(macro)):
+            offset += macro.delays[i]
+            clock.advance_to(offset)
+            if commands[i] is not None and not pipeline.send_prepared(commands[i]):
+                break
+        if not pipeline.error:
+            pipeline.drain()
+
+        problems = []
+        if pipeline.error:
+            problems.append(f"error: {pipeline.error}")
+        elif pipeline.acked != pipeline.sent:
+            problems.append(
+                f"error: {pipeline.acked} of {pipeline.sent} commands acknowledged."
+            )
+        applied = len(device.key_log.events)
+        if applied != len(macro):
+            problems.append(f"error: device applied {applied} of {len(macro)} events.")
+        if device.pressed:
+            problems.append(
+                f"error: keys still held at the end: {sorted(device.pressed, key=str)}"
+            )
+        if abs(clock() - macro.duration) > 1e-6:
+            problems.append(
+                f"error: played for {clock():.3f} s, expected {macro.duration:.3f} s."
+            )
+        return problems
 
-                except serial.SerialException as e:
-                    logging.error(f"Serial Error: {e}. Stopping macro.")
-                    self.app.is_playing = False
-                finally:
-                    try:
-                        if ser and self.app.keys_currently_down:
-                            print("Releasing stuck keys...")
-                            for key in list(self.app.keys_currently_down):
-                                command = f"up|{key}\n"
-                                ser.write(command.encode("utf-8"))
-                                if self._wait_for_ack(ser, timeout=0.8):
-                                    print(f"Sent release for {key} and received ACK.")
-                                else:
-                                    print(
-                                        f"Warning: Timeout on final release ACK for key '{key}'."
-                                    )
-                            self.app.keys_currently_down.clear()
-                    except Exception as e:
-                        logging.error(f"Cleanup error: {e}")
-                    finally:
-                        try:
-                            if ser:
-                                ser.close()
-                        except Exception:
-                            pass
-
-        logging.info("Macro thread is finishing.")
-        self.app.root.after(0, self.app.on_macro_thread_exit)
-
-
-class MacroControllerApp:
+
+class PlaybackState:
+    """Playback state and engine settings shared by the GUI and headless front ends.
+
+    MacroController only needs these attributes from its ``app``, plus
+    ``status_text``, ``timing_status_var``, ``post_ui`` and
+    ``on_macro_thread_exit``.
+    """
+
+    def init_playback_state(self):
+        """Sets up the stop event, held-key tracking and default settings."""
+        self.stop_event = threading.Event()
+        # Called on the stopping thread, to wake waits that cannot block on
+        # stop_event itself (serial reads, the prefetch buffer)
+        self.on_stop = []
+        self.is_playing = False
+        self.keys_currently_down = set()
+        self.ack_window = DEFAULT_ACK_WINDOW
+        self.device_timing = False
+        self.binary_protocol = True
+        self.spin_threshold = DEFAULT_SPIN_THRESHOLD
+        self.focus_interval = DEFAULT_FOCUS_INTERVAL
+        self.telemetry_dir = ""
+        self.telemetry_format = "json"
+        self.chord_tolerance = DEFAULT_CHORD_TOLERANCE
+        self.prefetch_depth = DEFAULT_PREFETCH_DEPTH
+        self.telegram = TelegramHandler("", "")
+        self.notify_events = set()
+        self.session_limit = 0.0
+        self.status_interval = STATUS_UPDATE_INTERVAL
+
+    def apply_playback_settings(self, config):
+        """Applies the playback engine settings from a loaded config.json dict.
+
+        Args:
+            config (dict): The parsed configuration.
+        """
+        # Pipelining depth and framing for the Pico command protocol
+        self.ack_window = int(config.get("ack_window", DEFAULT_ACK_WINDOW))
+        self.binary_protocol = bool(config.get("binary_protocol", True))
+        self.device_timing = bool(config.get("device_timing", False))
+        # Timing knobs are stored in milliseconds
+        spin_ms = config.get("spin_threshold_ms", DEFAULT_SPIN_THRESHOLD * 1000)
+        self.spin_threshold = float(spin_ms) / 1000
+        focus_ms = config.get("focus_poll_ms", DEFAULT_FOCUS_INTERVAL * 1000)
+        self.focus_interval = float(focus_ms) / 1000
+        # Per-event timing export after each macro; empty directory disables it
+        self.telemetry_dir = config.get("telemetry_dir", "")
+        self.telemetry_format = (
+            "csv" if config.get("telemetry_format") == "csv" else "json"
+        )
+        chord_ms = config.get("chord_tolerance_ms", DEFAULT_CHORD_TOLERANCE * 1000)
+        self.chord_tolerance = max(0.0, float(chord_ms) / 1000)
+        self.prefetch_depth = int(config.get("prefetch_depth", DEFAULT_PREFETCH_DEPTH))
+        # Telegram notifications for playback events (opt-in per event)
+        self.telegram.bot_token = config.get("bot_token", "")
+        self.telegram.chat_id = config.get("chat_id", "")
+        self.notify_events = set(config.get("notify_events", ())) & set(NOTIFY_EVENTS)
+        # Stop the run after this long; 0 plays until stopped
+        self.session_limit = max(
+            0.0, float(config.get("session_limit_minutes", 0)) * 60
+        )
+
+    @property
+    def is_playing(self):
+        """bool: Whether playback is running.
+
+        Backed by ``stop_event`` so that clearing the flag from any thread wakes
+        playback waits immediately instead of at the next poll.
+        """
+        return not self.stop_event.is_set()
+
+    @is_playing.setter
+    def is_playing(self, value):
+        if value:
+            self.stop_event.clear()
+        else:
+            self.stop_event.set()
+            for wake in list(self.on_stop):
+                wake()
+
+
+class MacroControllerApp(PlaybackState):
     """Main application class for the PicoBot macro controller GUI."""
 
     def __init__(self, root):
@@ -557,18 +3445,18 @@ class MacroControllerApp:
         )
 
         # --- State Variables ---
-        self.is_playing = False
-        self.macro_thread = None
-        self.keys_currently_down = set()
+        self.init_playback_state()
+        self.ui_bridge = TkBridge(root)
+        self.playback_run = None
 
         # --- Telegram Settings ---
         self.bot_token_var = tk.StringVar(value="")
         self.chat_id_var = tk.StringVar(value="")
         self.countdown_seconds_var = tk.StringVar(value="60")
         self.countdown_running = False
-        self.countdown_thread = None
+        self.countdown_deadline = 0.0
+        self.countdown_timers = []
         self.countdown_status_var = tk.StringVar(value="Countdown: Idle")
-        self.telegram = TelegramHandler("", "")
 
         # --- Macro Controller ---
         self.macro_controller = MacroController(self)
@@ -590,6 +3478,7 @@ class MacroControllerApp:
 
         # --- Options ---
         self.pin_var = tk.BooleanVar(value=True)
+        self.device_timing_var = tk.BooleanVar(value=False)
         self.create_options_ui()
 
         # --- Controls ---
@@ -599,11 +3488,12 @@ class MacroControllerApp:
         self.status_text = tk.StringVar(
             value="Status: Idle. Click START to begin. Switch windows to stop."
         )
+        self.timing_status_var = tk.StringVar(value="Timing: -")
         self.create_status_bars()
 
         # --- Initial Setup ---
         self.load_config()
-        self.refresh_windows()  # Refresh windows after loading config
+        self.macro_controller.refresh_windows()  # Re-select the saved window
 
         # Make window height dynamic based on content
         self.root.update_idletasks()
@@ -629,7 +3519,7 @@ class MacroControllerApp:
         self.macro_controller.auto_select_pico_port_async(force=True)
 
     def start_countdown_internal(self):
-        """Starts the countdown timer in a separate thread."""
+        """Starts the countdown timer on the playback engine's timers."""
         try:
             seconds = int(self.countdown_seconds_var.get())
             bot_token = self.bot_token_var.get()
@@ -644,72 +3534,54 @@ class MacroControllerApp:
             self.telegram.bot_token = self.bot_token_var.get()
             self.telegram.chat_id = self.chat_id_var.get()
 
-            def countdown_thread():
-                completed = True
-                for i in range(seconds, 0, -1):
-                    if not self.countdown_running:
-                        completed = False
-                        break
-                    if not self.is_playing:
-                        completed = False
-                        break
-                    time.sleep(1)
-                    self.root.after(
-                        0,
-                        lambda i=i: self.countdown_status_var.set(
-                            f"Countdown: {i} seconds remaining"
-                        ),
-                    )
-                if self.countdown_running and completed:
-                    # Always update the status bar to indicate completion
-                    self.root.after(
-                        0,
-                        lambda: self.countdown_status_var.set("Countdown: Completed!"),
-                    )
+            # One tick per second for the display and one timer for completion,
+            # both on the shared engine thread
+            engine = self.macro_controller.engine
+            self.cancel_countdown_timers()
+            self.countdown_deadline = time.monotonic() + seconds
+            self.countdown_timers = [
+                engine.call_every(1.0, self._countdown_tick),
+                engine.call_later(seconds, self._countdown_finished),
+            ]
+        except ValueError:
+            messagebox.showerror("Error", "Invalid countdown seconds.")
 
-                    # Send Telegram notification if configured
-                    if self.bot_token_var.get() and self.chat_id_var.get():
-                        self.root.after(
-                            0,
-                            lambda: self.countdown_status_var.set(
-                                "Countdown: Sending notification..."
-                            ),
-                        )
-                        self.telegram.send_message("Countdown timer finished!")
-                        self.root.after(
-                            0,
-                            lambda: self.countdown_status_var.set(
-                                "Countdown: Notification sent"
-                            ),
-                        )
-                    else:
-                        self.root.after(
-                            0,
-                            lambda: self.countdown_status_var.set(
-                                "Countdown: Completed!"
-                            ),
-                        )
+    def cancel_countdown_timers(self):
+        """Cancels the countdown's pending timers."""
+        for timer in self.countdown_timers:
+            timer.cancel()
+        self.countdown_timers = []
 
-                    # Reset to idle after a short delay to show the completion message
-                    self.root.after(
-                        2000, lambda: self.countdown_status_var.set("Countdown: Idle")
-                    )
-                    if not self.is_playing:
-                        self.root.after(
-                            0,
-                            lambda: self.start_button.config(
-                                text="START", state=tk.NORMAL
-                            ),
-                        )
-                self.countdown_running = False
+    def _countdown_tick(self):
+        """Engine timer: shows the seconds left, or abandons a stopped countdown."""
+        if not self.countdown_running or not self.is_playing:
+            self.countdown_running = False
+            self.cancel_countdown_timers()
+            return
+        remaining = max(0, math.ceil(self.countdown_deadline - time.monotonic()))
+        self.post_ui(
+            self.countdown_status_var.set, f"Countdown: {remaining} seconds remaining"
+        )
 
-            self.countdown_thread = threading.Thread(
-                target=countdown_thread, daemon=True
-            )
-            self.countdown_thread.start()
-        except ValueError:
-            messagebox.showerror("Error", "Invalid countdown seconds.")
+    def _countdown_finished(self):
+        """Engine timer: completes the countdown and sends its notification."""
+        self.cancel_countdown_timers()
+        if not self.countdown_running or not self.is_playing:
             self.countdown_running = False
+            return
+        self.countdown_running = False
+        if self.telegram.configured:
+            self.telegram.send_message("Countdown timer finished!")
+            self.post_ui(
+                self.countdown_status_var.set, "Countdown: Notification queued"
+            )
+        else:
+            self.post_ui(self.countdown_status_var.set, "Countdown: Completed!")
+
+        # Reset to idle after a short delay to show the completion message
+        self.macro_controller.engine.call_later(
+            2.0, self.post_ui, self.countdown_status_var.set, "Countdown: Idle"
+        )
 
     def create_window_selection_ui(self):
         """Creates the UI elements for window selection."""
@@ -804,6 +3676,13 @@ class MacroControllerApp:
             command=self.toggle_always_on_top,
         )
         self.pin_check.pack(padx=10, anchor="w")
+        self.device_timing_check = tk.Checkbutton(
+            self.root,
+            text="Device-side timing (upload macro, Pico keeps time)",
+            variable=self.device_timing_var,
+            command=self.save_config,
+        )
+        self.device_timing_check.pack(padx=10, anchor="w")
         # Default to always-on-top on first launch; load_config may override
         try:
             self.root.attributes("-topmost", True)
@@ -847,6 +3726,16 @@ class MacroControllerApp:
         )
         self.countdown_status_label.pack(side=tk.BOTTOM, fill="x")
 
+        # Playback timing fidelity of the last macro
+        self.timing_status_label = tk.Label(
+            self.root,
+            textvariable=self.timing_status_var,
+            relief=tk.SUNKEN,
+            anchor="w",
+            padx=5,
+        )
+        self.timing_status_label.pack(side=tk.BOTTOM, fill="x")
+
     def load_config(self):
         """Load configuration from config.json and apply to UI variables."""
         try:
@@ -870,6 +3759,9 @@ class MacroControllerApp:
                     self.countdown_seconds_var.set(
                         str(config.get("countdown_seconds", 60))
                     )
+                    # Playback engine settings (ACK window, framing, timing)
+                    self.apply_playback_settings(config)
+                    self.device_timing_var.set(self.device_timing)
                     logging.info("Configuration loaded.")
         except json.JSONDecodeError as e:
             logging.error(f"Error loading config: Invalid JSON - {e}")
@@ -891,6 +3783,17 @@ class MacroControllerApp:
             "countdown_seconds": int(self.countdown_seconds_var.get())
             if self.countdown_seconds_var.get().isdigit()
             else 60,
+            "device_timing": bool(self.device_timing_var.get()),
+            "ack_window": self.ack_window,
+            "binary_protocol": self.binary_protocol,
+            "spin_threshold_ms": self.spin_threshold * 1000,
+            "focus_poll_ms": self.focus_interval * 1000,
+            "telemetry_dir": self.telemetry_dir,
+            "telemetry_format": self.telemetry_format,
+            "chord_tolerance_ms": self.chord_tolerance * 1000,
+            "prefetch_depth": self.prefetch_depth,
+            "notify_events": sorted(self.notify_events),
+            "session_limit_minutes": self.session_limit / 60,
         }
         try:
             with open(CONFIG_FILE, "w") as f:
@@ -899,6 +3802,23 @@ class MacroControllerApp:
         except Exception as e:
             logging.error(f"Could not save config file: {e}")
 
+    def shutdown(self, timeout=5.0):
+        """Stops playback and the engine after the window has closed.
+
+        The player thread outlives the Tk main loop, so without this it would
+        keep typing with no window left to stop it.
+
+        Args:
+            timeout (float): Seconds to wait for playback to wind down.
+        """
+        self.ui_bridge.close()
+        self.cancel_countdown_timers()
+        self.macro_controller.stop_playback()
+        if self.playback_run is not None:
+            concurrent.futures.wait([self.playback_run], timeout)
+        self.macro_controller.engine.close(wait=True)
+        self.telegram.close()
+
     def toggle_always_on_top(self):
         """Toggles the always-on-top window attribute and saves the preference."""
         try:
@@ -931,6 +3851,7 @@ class MacroControllerApp:
         # Stop countdown if running
         if self.countdown_running:
             self.countdown_running = False
+            self.cancel_countdown_timers()
             self.countdown_status_var.set("Countdown: Idle")
             if not self.is_playing:
                 self.start_button.config(text="START", state=tk.NORMAL)
@@ -960,7 +3881,9 @@ class MacroControllerApp:
                 return
 
             try:
-                if not [f for f in os.listdir(macro_folder) if f.endswith(".txt")]:
+                catalog = self.macro_controller.catalog
+                catalog.scan(macro_folder)
+                if not any(catalog.playlist_files(macro_folder)):
                     messagebox.showerror(
                         "Error", "No '.txt' macro files found in the folder."
                     )
@@ -972,545 +3895,503 @@ class MacroControllerApp:
                 return
 
             print("Starting macro loop...")
+            # Snapshot for the playback thread, which must not touch Tk variables
+            self.device_timing = bool(self.device_timing_var.get())
             self.start_button.config(state=tk.DISABLED)
-            self.macro_thread = threading.Thread(
-                target=self.macro_controller.play_macro_thread,
-                args=(port, window_title, macro_folder),
+            self.playback_run = self.macro_controller.start_playback(
+                port, window_title, macro_folder
             )
-            self.macro_thread.daemon = True
-            self.macro_thread.start()
 
             # Start countdown timer if enabled
             if countdown_enabled:
                 self.start_countdown_internal()
 
-    def interruptible_sleep(self, duration):
-        """Sleeps for a specified duration but can be interrupted if macro stops playing.
-
-        Args:
-            duration (float): The duration to sleep in seconds.
-
-        Returns:
-            bool: True if sleep completed, False if interrupted.
-        """
-        end_time = time.time() + duration
-        while time.time() < end_time:
-            if not self.is_playing:
-                return False
-            time.sleep(0.01)
-        return True
-
-    def _finalize_handshake(self, ser):
-        """Finalizes the handshake with the Pico device after receiving PICO_READY.
-
-        After seeing PICO_READY, explicitly sends HELLO so the Pico stops periodic READY.
-        Then waits briefly for its PICO_READY response and clears any leftover input.
+    def post_ui(self, callback, *args):
+        """Runs ``callback(*args)`` on the Tk thread; safe to call from any thread."""
+        self.ui_bridge.post(callback, *args)
 
-        Args:
-            ser (serial.Serial): The serial connection to the Pico device.
-        """
-        try:
-            ser.write(b"hello|handshake\n")
-            ser.flush()
-        except Exception:
-            pass
-        end = time.time() + 0.8
-        while time.time() < end:
-            try:
-                line = ser.readline().decode("utf-8", errors="ignore").strip()
-            except Exception:
-                break
-            if not line:
-                continue
-            if line == "PICO_READY":
-                break
-        # Clear any stray bytes (e.g., a periodic PICO_READY that raced in)
-        try:
-            ser.reset_input_buffer()
-        except Exception:
-            pass
+    def on_macro_thread_exit(self):
+        """Safely updates GUI elements from the main thread after the macro thread has finished."""
+        self.is_playing = False  # Ensure state is final
+        self.status_text.set("Status: Stopped. Ready to start.")
+        self.start_button.config(state=tk.NORMAL)
+        print("GUI updated. Macro has fully stopped.")
 
-    def _wait_for_ack(self, ser, timeout=1.5):
-        """Waits for an ACK response from the Pico device.
+    def select_macro_folder(self):
+        """Opens a dialog for the user to select a macro folder and saves the selection."""
+        folderpath = filedialog.askdirectory(title="Select Folder Containing Macros")
+        if folderpath:
+            self.macro_folder_path.set(folderpath)
+            self.save_config()
 
-        Waits for an ACK line, ignoring blank lines and stray PICO_READY messages.
 
-        Args:
-            ser (serial.Serial): The serial connection to the Pico device.
-            timeout (float): The maximum time to wait for an ACK in seconds.
+class _StatusLog:
+    """Minimal stand-in for a Tk StringVar that logs status updates."""
 
-        Returns:
-            bool: True if ACK received, False otherwise.
-        """
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            try:
-                line = ser.readline().decode("utf-8", errors="ignore").strip()
-            except Exception:
-                return False
-            if not line:
-                continue
-            if line == "ACK":
-                return True
-            if line == "PICO_READY":
-                # Ignore and keep waiting for the ACK corresponding to our command
-                continue
-            # Unexpected noise; ignore and continue until timeout
-        return False
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.value = ""
 
-    def find_data_port(self, exclude_port=None):
-        """Scan COM ports to find the Pico DATA CDC port by eliciting PICO_READY.
-        Returns the port string if found, else None.
-        """
-        candidates = list(serial.tools.list_ports.comports())
-        for info in candidates:
-            p = info.device
-            if exclude_port and p == exclude_port:
-                continue
-            try:
-                ser = serial.Serial(p, 115200, timeout=0.5, write_timeout=0.5)
-                try:
-                    ser.dtr = False
-                    time.sleep(0.05)
-                    ser.dtr = True
-                    ser.rts = False
-                except Exception:
-                    pass
-                time.sleep(0.1)
+    def set(self, value):
+        self.value = value
+        logging.info(f"{self.prefix}{value}")
 
-                got_ready = False
-                found_console = False
+    def get(self):
+        return self.value
 
-                # Read a couple of lines, see if console banner appears or we already have PICO_READY
-                t0 = time.time()
-                while time.time() - t0 < 1.0:
-                    line = ser.readline().decode("utf-8", errors="ignore").strip()
-                    if not line:
-                        continue
-                    lower = line.lower()
-                    if (
-                        ("circuitpython" in lower)
-                        or ("repl" in lower)
-                        or lower.startswith(">>>")
-                    ):
-                        found_console = True
-                        break
-                    if line == "PICO_READY":
-                        got_ready = True
-                        break
 
-                if not got_ready and not found_console:
-                    try:
-                        ser.write(b"hello|handshake\n")
-                        ser.flush()
-                    except Exception:
-                        pass
-                    t1 = time.time()
-                    while time.time() - t1 < 1.5:
-                        line = ser.readline().decode("utf-8", errors="ignore").strip()
-                        if line == "PICO_READY":
-                            got_ready = True
-                            break
-                        if line:
-                            lower = line.lower()
-                            if (
-                                ("circuitpython" in lower)
-                                or ("repl" in lower)
-                                or lower.startswith(">>>")
-                            ):
-                                found_console = True
-                                break
+class HeadlessApp(PlaybackState):
+    """Front end for running the playlist loop without Tkinter.
 
-                ser.close()
-                if got_ready and not found_console:
-                    return p
-            except Exception:
-                continue
-        return None
+    Provides the small part of MacroControllerApp that MacroController uses.
+    Callbacks that the GUI would hand to the Tk thread run inline on the
+    calling thread.
+    """
 
-    def play_macro_thread(self, port, window_title, macro_folder):
-        """Plays macro files in a continuous loop, sending commands to the Pico device.
+    def __init__(self, config=None):
+        """Initializes the headless front end.
 
         Args:
-            port (str): The COM port to communicate with the Pico device.
-            window_title (str): The title of the target window for macro playback.
-            macro_folder (str): The folder path containing macro files to play.
+            config (dict, optional): Parsed config.json to take settings from.
         """
-        self.is_playing = True
-        self.status_text.set("Status: Playing...")
-        self.keys_currently_down.clear()
-
-        try:
-            target_windows = gw.getWindowsWithTitle(window_title)
-            if not target_windows:
-                print(f"Error: Target window '{window_title}' not found.")
-                self.is_playing = False
-                # Ensure GUI resets cleanly
-                self.root.after(0, self.on_macro_thread_exit)
-                return
-            target_windows[0].activate()
-        except Exception as e:
-            print(f"Error activating window: {e}")
-            self.is_playing = False
-            self.root.after(0, self.on_macro_thread_exit)
-            return
+        self.init_playback_state()
+        if config:
+            self.apply_playback_settings(config)
+        self.status_text = _StatusLog()
+        self.timing_status_var = _StatusLog()
+        self.finished = threading.Event()
+        # Progress goes to the log, so report it less often than the GUI
+        self.status_interval = 60.0
+
+    def post_ui(self, callback, *args):
+        """Runs ``callback`` immediately; there is no UI thread to hand it to."""
+        callback(*args)
 
-        time.sleep(1)
-
-        while self.is_playing:
-            # 1. Get all macro files and create a new randomized playlist
-            try:
-                all_macro_files = [
-                    f for f in os.listdir(macro_folder) if f.endswith(".txt")
-                ]
-                if not all_macro_files:
-                    print("Error: No '.txt' files found in folder. Stopping loop.")
-                    break
-
-                # Separate START_ files from the rest
-                start_files = [f for f in all_macro_files if f.startswith("START_")]
-                other_files = [f for f in all_macro_files if not f.startswith("START_")]
+    def on_macro_thread_exit(self):
+        """Marks the run as finished."""
+        self.is_playing = False
+        self.finished.set()
 
-                # Shuffle both lists independently
-                random.shuffle(start_files)
-                random.shuffle(other_files)
 
-                # Combine them, with START_ files first
-                current_playlist = start_files + other_files
-                print(f"\n--- New randomized playlist created: {current_playlist} ---")
+class FleetDevice:
+    """One Pico of a DeviceFleet: its own session settings, playlist and stats."""
 
-            except Exception as e:
-                print(f"Error creating playlist: {e}. Stopping loop.")
-                break
+    def __init__(self, name, port, folder, window, app, controller):
+        self.name = name
+        self.port = port
+        self.folder = folder
+        self.window = window
+        self.app = app
+        self.controller = controller
+        self.started = None
+        self._last_sample = (0, 0.0)  # (events, time) at the previous snapshot
 
-            # 2. Play through the current playlist
-            for chosen_macro_name in current_playlist:
-                if not self.is_playing:
-                    break
 
-                print(f"--- Playing from sequence: {chosen_macro_name} ---")
-                macro_file_path = os.path.join(macro_folder, chosen_macro_name)
+class DeviceFleet:
+    """Plays on several Picos at once from one process.
 
-                events = self.parse_macro_file(macro_file_path)
-                if events is None:
-                    continue
+    Every device has its own PicoSession, playlist, target window, stop event
+    and statistics, through a MacroController of its own. They share one
+    PlaybackEngine (one event loop plus a player thread per device), the
+    compiled macro cache, the macro catalog and port discovery, so a macro
+    is compiled once however many devices play it.
+    """
 
-                ser = None
-                try:
-                    ser = serial.Serial(
-                        port, 115200, timeout=5
-                    )  # Generous timeout for handshake
-                    # Ensure DTR toggled so usb_cdc.data.connected goes True on the Pico
-                    try:
-                        ser.dtr = False
-                        time.sleep(0.05)
-                        ser.dtr = True
-                        ser.rts = False
-                    except Exception:
-                        pass
-                    time.sleep(0.1)
+    def __init__(self, config=None):
+        """Initializes an empty fleet.
 
-                    # --- Handshake on DATA port --- #
-                    print("Waiting for PICO_READY signal...")
-                    ready_signal_received = False
-                    start_time = time.time()
-                    hello_sent = False
-                    try:
-                        ser.timeout = 0.2
-                    except Exception:
-                        pass
-                    while (
-                        time.time() - start_time < 12
-                    ):  # up to 12s total for handshake
-                        line = ser.readline().decode("utf-8").strip()
-                        if line == "PICO_READY":
-                            print("PICO_READY signal received. Starting macro.")
-                            # Explicit HELLO to stop Pico's periodic READY and drain buffer
-                            self._finalize_handshake(ser)
-                            ready_signal_received = True
-                            break
-                        elif line:
-                            print(f"Pico startup message: {line}")  # Log other messages
-                            lower = line.lower()
-                            if (
-                                ("circuitpython" in lower)
-                                or ("repl" in lower)
-                                or lower.startswith(">>>")
-                            ):
-                                print(
-                                    "Detected the console CDC port. Please select the other Pico COM port (Data)."
-                                )
-                                self.is_playing = False
-                                break
+        Args:
+            config (dict, optional): Parsed config.json applied to every device.
+        """
+        self.config = config or {}
+        self.devices = []
+        self.engine = None
+        self._shared = None
 
-                        # After 1 second with no PICO_READY, try explicit HELLO on DATA port
-                        if (not hello_sent) and (time.time() - start_time >= 1.0):
-                            try:
-                                ser.write(b"hello|handshake\n")
-                                ser.flush()
-                                hello_sent = True
-                            except Exception:
-                                pass
-
-                    if not ready_signal_received:
-                        # Try auto-detect other COM ports for DATA port
-                        auto_port = self.find_data_port(exclude_port=port)
-                        if auto_port and auto_port != port:
-                            print(
-                                f"Auto-detected Pico DATA port: {auto_port}. Retrying handshake..."
-                            )
-                            try:
-                                ser.close()
-                            except Exception:
-                                pass
-                            port = auto_port
-                            # Retry once on detected port
-                            try:
-                                ser = serial.Serial(port, 115200, timeout=5)
-                                try:
-                                    ser.dtr = False
-                                    time.sleep(0.05)
-                                    ser.dtr = True
-                                    ser.rts = False
-                                except Exception:
-                                    pass
-                                time.sleep(0.1)
-                                print("Waiting for PICO_READY signal...")
-                                ready_signal_received = False
-                                start_time = time.time()
-                                hello_sent = False
-                                try:
-                                    ser.timeout = 0.2
-                                except Exception:
-                                    pass
-                                while time.time() - start_time < 12:
-                                    line = (
-                                        ser.readline()
-                                        .decode("utf-8", errors="ignore")
-                                        .strip()
-                                    )
-                                    if line == "PICO_READY":
-                                        print(
-                                            "PICO_READY signal received. Starting macro."
-                                        )
-                                        # Explicit HELLO to stop Pico's periodic READY and drain buffer
-                                        self._finalize_handshake(ser)
-                                        ready_signal_received = True
-                                        break
-                                    elif line:
-                                        print(f"Pico startup message: {line}")
-                                    if (not hello_sent) and (
-                                        time.time() - start_time >= 1.0
-                                    ):
-                                        try:
-                                            ser.write(b"hello|handshake\n")
-                                            ser.flush()
-                                            hello_sent = True
-                                        except Exception:
-                                            pass
-                            except Exception as _:
-                                ready_signal_received = False
-
-                        if not ready_signal_received:
-                            print("Error: Timed out waiting for PICO_READY signal.")
-                            self.is_playing = False
-                            try:
-                                ser.close()
-                            except Exception:
-                                pass
-                            continue  # Skip to the next macro file
-                    for i, event in enumerate(events):
-                        # --- Pre-command checks ---
-                        # 1. Check for manual stop
-                        if not self.is_playing:
-                            break
+    def add(self, name, port, folder, window=""):
+        """Adds a device; call before ``start``.
 
-                        # 2. Check if the active window has changed
-                        try:
-                            active_window_title = gw.getActiveWindowTitle()
-                            if active_window_title != window_title:
-                                print(
-                                    f"\nWindow focus lost. Expected '{window_title}', got '{active_window_title}'. Stopping macro."
-                                )
-                                self.is_playing = (
-                                    False  # This will trigger a clean stop
-                                )
-                                break
-                        except Exception as e:
-                            print(
-                                f"Could not get active window title: {e}. Stopping macro."
-                            )
-                            self.is_playing = False
-                            break
+        Args:
+            name (str): Label for the device in logs and the control view.
+            port (str): Its DATA port, or "auto" to take the next free Pico.
+            folder (str): Its macro folder.
+            window (str): Target window title; empty to skip focus checks.
+        """
+        app = HeadlessApp(self.config)
+        app.status_text = _StatusLog(f"[{name}] ")
+        app.timing_status_var = _StatusLog(f"[{name}] ")
+        self.devices.append(FleetDevice(name, port, folder, window, app, None))
 
-                        # --- Execute command ---
-                        # Apply delay before this event
-                        if i > 0:
-                            delay = event["time"] - events[i - 1]["time"]
-                            if not self.interruptible_sleep(delay):
-                                break  # Stop signal received during sleep
-
-                        # Send command and wait for ACK
-                        command = f"{event['type']}|{event['key']}\n"
-                        ser.write(command.encode("utf-8"))
-                        if not self._wait_for_ack(ser, timeout=1.5):
-                            print(
-                                "Warning: Expected ACK but got none/other. Stopping to prevent de-sync."
-                            )
-                            self.is_playing = False
-                            break
+    def claimed_ports(self, device=None):
+        """Returns the ports of every device other than ``device``."""
+        return {d.port for d in self.devices if d is not device and d.port != "auto"}
 
-                        # Update key state
-                        if event["type"] == "down":
-                            self.keys_currently_down.add(event["key"])
-                        elif event["key"] in self.keys_currently_down:
-                            self.keys_currently_down.discard(event["key"])
-
-                except serial.SerialException as e:
-                    print(f"Serial Error: {e}. Stopping macro.")
-                    self.is_playing = False
-                finally:
-                    # Cleanup per-macro file: release stuck keys and close port
-                    try:
-                        if ser and self.keys_currently_down:
-                            print("Releasing stuck keys...")
-                            for key in list(self.keys_currently_down):
-                                command = f"up|{key}\n"
-                                ser.write(command.encode("utf-8"))
-                                if self._wait_for_ack(ser, timeout=0.8):
-                                    print(f"Sent release for {key} and received ACK.")
-                                else:
-                                    print(
-                                        f"Warning: Timeout on final release ACK for key '{key}'."
-                                    )
-                            self.keys_currently_down.clear()
-                    except Exception as e:
-                        print(f"Cleanup error: {e}")
-                    finally:
-                        try:
-                            if ser:
-                                ser.close()
-                        except Exception:
-                            pass
-
-        print("Macro thread is finishing.")
-        # Schedule the final GUI update on the main thread
-        self.root.after(0, self.on_macro_thread_exit)
+    def start(self):
+        """Assigns auto ports and starts every device.
 
-    def on_macro_thread_exit(self):
-        """Safely updates GUI elements from the main thread after the macro thread has finished."""
-        self.is_playing = False  # Ensure state is final
-        self.status_text.set("Status: Stopped. Ready to start.")
-        self.start_button.config(state=tk.NORMAL)
-        print("GUI updated. Macro has fully stopped.")
+        Returns:
+            bool: False if some device could not be given a port.
+        """
+        self.engine = PlaybackEngine(players=max(1, len(self.devices)))
+        for device in self.devices:
+            device.controller = MacroController(
+                device.app,
+                engine=self.engine,
+                share_with=self._shared,
+                claimed_ports=lambda d=device: self.claimed_ports(d),
+            )
+            self._shared = self._shared or device.controller
+        auto = [d for d in self.devices if d.port == "auto"]
+        if auto:
+            found = self._shared.discovery.discover_all(exclude=self.claimed_ports())
+            if len(found) < len(auto):
+                logging.error(
+                    f"{len(auto)} auto device(s) but only {len(found)} free Pico(s) found."
+                )
+                return False
+            for device, port in zip(auto, found):
+                device.port = port
+        for device in self.devices:
+            logging.info(f"[{device.name}] Playing {device.folder} on {device.port}.")
+            device.started = time.monotonic()
+            device.controller.start_playback(device.port, device.window, device.folder)
+        return True
 
-    def parse_macro_file(self, filename):
-        events = []
-        try:
-            with open(filename, "r") as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) == 3:
-                        timestamp, event_type, key = parts
-                        events.append(
-                            {"time": float(timestamp), "type": event_type, "key": key}
-                        )
-        except Exception as e:
-            print(f"Warning: Could not parse macro file '{filename}'.\nError: {e}")
-            return None
-        return events
+    @property
+    def running(self):
+        """bool: Whether any device is still playing."""
+        return any(not d.app.finished.is_set() for d in self.devices)
+
+    def stop(self, timeout=5.0):
+        """Stops every device and waits for them to release their keys."""
+        for device in self.devices:
+            if device.controller:
+                device.controller.stop_playback()
+        deadline = time.monotonic() + timeout
+        for device in self.devices:
+            device.app.finished.wait(max(0.0, deadline - time.monotonic()))
+        if self.engine:
+            self.engine.close()
+
+    def snapshot(self):
+        """Returns per-device statistics for the control view.
 
-    def auto_select_pico_port_async(self, force=False):
-        """Background auto-detect of the Pico DATA port. If found, select it in the combobox.
-        force=True will always set the detected port; otherwise only when selection is empty/invalid.
+        Returns:
+            list: One dict per device with its state, macros and events played,
+                average events/s since start and events/s since the last
+                snapshot.
         """
+        now = time.monotonic()
+        rows = []
+        for device in self.devices:
+            controller = device.controller
+            events = controller.events_played if controller else 0
+            last_events, last_time = device._last_sample
+            device._last_sample = (events, now)
+            elapsed = now - device.started if device.started else 0.0
+            rows.append(
+                {
+                    "device": device.name,
+                    "port": device.port,
+                    "state": "stopped" if device.app.finished.is_set() else "playing",
+                    "macros": controller.macros_played if controller else 0,
+                    "events": events,
+                    "avg_eps": events / elapsed if elapsed > 0 else 0.0,
+                    "eps": (events - last_events) / (now - last_time)
+                    if last_time
+                    else 0.0,
+                    "error": controller.last_error if controller else "",
+                }
+            )
+        return rows
+
+
+def format_fleet_table(rows):
+    """Formats DeviceFleet.snapshot() rows as a fixed-width table."""
+    lines = [
+        f"{'device':<12} {'port':<14} {'state':<8} {'macros':>6} "
+        f"{'events':>8} {'ev/s':>8} {'avg ev/s':>8}  error"
+    ]
+    total = 0.0
+    for r in rows:
+        total += r["eps"]
+        lines.append(
+            f"{r['device']:<12} {r['port']:<14} {r['state']:<8} {r['macros']:>6} "
+            f"{r['events']:>8} {r['eps']:>8.1f} {r['avg_eps']:>8.1f}  {r['error']}"
+        )
+    lines.append(f"{'total':<12} {'':<14} {'':<8} {'':>6} {'':>8} {total:>8.1f}")
+    return "\n".join(lines)
 
-        def worker():
-            # 1) Quick heuristic: interface index 2 usually maps to DATA CDC (location endswith 'x.2')
-            port = self.quick_guess_pico_data_port()
-            # 2) Fallback to active handshake probing across ports
-            if not port:
-                port = self.find_data_port()
-            if port:
-                self.root.after(
-                    0, lambda p=port: self._set_selected_port_if_appropriate(p, force)
-                )
-            else:
-                # Leave selection empty and inform user
-                self.root.after(
-                    0,
-                    lambda: self.status_text.set(
-                        "Status: No Pico DATA port detected. Connect and click Refresh."
-                    ),
-                )
-
-        threading.Thread(target=worker, daemon=True).start()
 
-    def quick_guess_pico_data_port(self):
-        """Return device name of Pico DATA port using USB interface location hint (x.2), else None."""
-        try:
-            for info in serial.tools.list_ports.comports():
-                loc = getattr(info, "location", "") or ""
-                # On Windows, CircuitPython typically enumerates CDC console as x.0 and DATA as x.2
-                if loc.endswith("x.2"):
-                    return info.device
-        except Exception:
-            pass
-        return None
+def _load_run_config(args):
+    """Loads config.json for ``run``/``fleet`` and applies command-line overrides.
 
-    def _set_selected_port_if_appropriate(self, port, force):
+    Returns:
+        dict or None: The config, or None if the file could not be read.
+    """
+    config = {}
+    if os.path.exists(args.config):
         try:
-            values = list(self.port_menu["values"])
-        except Exception:
-            values = []
-        if port not in values:
-            values.append(port)
-            self.port_menu["values"] = values
-        current = self.selected_port.get()
-        if force or (not current) or ("No COM" in current) or (current not in values):
-            self.selected_port.set(port)
-            try:
-                self.status_text.set(f"Status: Auto-selected Pico DATA port {port}.")
-            except Exception:
-                pass
-
-    def refresh_ports(self):
-        """Refreshes the list of available COM ports and triggers auto-detection."""
-        ports = [port.device for port in serial.tools.list_ports.comports()]
-        # Populate list but do not auto-select any port
-        self.port_menu["values"] = ports
+            with open(args.config, "r") as f:
+                config = json.load(f)
+        except Exception as e:
+            logging.error(f"Could not load config file: {e}")
+            return None
+    if args.ack_window is not None:
+        config["ack_window"] = args.ack_window
+    if args.device_timing:
+        config["device_timing"] = True
+    if args.text_protocol:
+        config["binary_protocol"] = False
+    if args.telemetry_dir:
+        config["telemetry_dir"] = args.telemetry_dir
+    if args.limit_minutes is not None:
+        config["session_limit_minutes"] = args.limit_minutes
+    return config
+
+
+def run_fleet(args):
+    """Plays on several Picos at once and prints a per-device throughput table.
+
+    Args:
+        args (argparse.Namespace): Parsed ``fleet`` arguments.
+
+    Returns:
+        int: 0 if every device played without error, 1 if any stopped with
+            an error (e.g. an ACK timeout or a NAK), 2 on bad usage.
+    """
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    config = _load_run_config(args)
+    if config is None:
+        return 2
+    fleet = DeviceFleet(config)
+    for i, spec in enumerate(args.device):
+        if len(spec) not in (2, 3):
+            logging.error(f"--device takes PORT FOLDER [WINDOW], got {spec}.")
+            return 2
+        port, folder = spec[0], spec[1]
+        if not os.path.isdir(folder):
+            logging.error(f"Macro folder not found: {folder}")
+            return 2
+        fleet.add(f"pico{i + 1}", port, folder, spec[2] if len(spec) == 3 else "")
+
+    if not fleet.start():
+        fleet.stop()
+        return 2
+    try:
+        while fleet.running:
+            time.sleep(args.interval)
+            print(format_fleet_table(fleet.snapshot()), flush=True)
+    except KeyboardInterrupt:
+        logging.warning("Interrupted; stopping every device...")
+    fleet.stop()
+    rows = fleet.snapshot()
+    print(format_fleet_table(rows))
+    failed = [r["device"] for r in rows if r["error"]]
+    if failed:
+        logging.error(f"Device(s) with errors: {', '.join(failed)}")
+    return 1 if failed else 0
+
+
+def run_check(args):
+    """Dry-runs every macro in a folder and prints a per-file report.
+
+    Args:
+        args (argparse.Namespace): Parsed ``check`` arguments.
+
+    Returns:
+        int: 0 if every file is playable, 1 if any has errors, 2 on bad usage.
+    """
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s - %(message)s")
+    config = {}
+    if os.path.exists(args.config):
         try:
-            self.port_menu.set("")  # clear any previous selection in the widget
-        except Exception:
-            pass
-        self.selected_port.set("")  # ensure state variable is empty
-        # After listing, kick off background auto-detection to pick the DATA port if present
-        self.auto_select_pico_port_async(force=False)
-
-    def refresh_windows(self):
-        """Refreshes the list of available windows and tries to re-select the saved window."""
-        window_list = [title for title in gw.getAllTitles() if title]
-        self.window_menu["values"] = (
-            window_list if window_list else ["No windows found"]
+            with open(args.config, "r") as f:
+                config = json.load(f)
+        except Exception as e:
+            logging.error(f"Could not load config file: {e}")
+            return 2
+    if not os.path.isdir(args.folder):
+        logging.error(f"Macro folder not found: {args.folder}")
+        return 2
+
+    # The report lists the compiler's diagnostics itself
+    logging.getLogger().setLevel(logging.CRITICAL)
+    controller = MacroController(HeadlessApp(config))
+    started = time.perf_counter()
+    report = controller.dry_run(args.folder)
+    elapsed = time.perf_counter() - started
+
+    for row in report:
+        if row["status"] == "ok" and not args.verbose:
+            continue
+        print(
+            f"{row['status'].upper():<7} {row['file']} "
+            f"({row['events']} events, {row['duration_s']:.3f} s)"
         )
-        # Try to re-select the saved window if it's in the list
-        saved_window = self.selected_window.get()
-        if saved_window and saved_window in window_list:
-            self.window_menu.set(saved_window)
-        elif window_list:
-            self.window_menu.set(window_list[0])
+        for problem in row["problems"]:
+            print(f"        {problem}")
+    failed = sum(row["status"] == "error" for row in report)
+    warned = sum(row["status"] == "warning" for row in report)
+    total = sum(row["duration_s"] for row in report)
+    print(
+        f"Checked {len(report)} macro(s) ({total:.1f} s of playback) in "
+        f"{elapsed:.2f} s: {len(report) - failed - warned} ok, {warned} with "
+        f"warnings, {failed} with errors."
+    )
+
+    if args.report:
+        if args.report.lower().endswith(".csv"):
+            with open(args.report, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(report[0]) if report else [])
+                writer.writeheader()
+                for row in report:
+                    writer.writerow(dict(row, problems="; ".join(row["problems"])))
         else:
-            self.window_menu.set("No windows found")
-
-    def select_macro_folder(self):
-        """Opens a dialog for the user to select a macro folder and saves the selection."""
-        folderpath = filedialog.askdirectory(title="Select Folder Containing Macros")
-        if folderpath:
-            self.macro_folder_path.set(folderpath)
-            self.save_config()
-
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+    return 1 if failed else 0
+
+
+def run_headless(args):
+    """Plays a macro folder from the command line until stopped.
+
+    Args:
+        args (argparse.Namespace): Parsed ``run`` arguments.
+
+    Returns:
+        int: Process exit code.
+    """
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    config = _load_run_config(args)
+    if config is None:
+        return 2
+
+    if not os.path.isdir(args.folder):
+        logging.error(f"Macro folder not found: {args.folder}")
+        return 2
+
+    app = HeadlessApp(config)
+    controller = MacroController(app)
+    # Port discovery waits on USB probes, so it is timed on its own rather
+    # than counted against the cold-start target
+    ready = time.perf_counter()
+    port = args.port or controller.quick_guess_pico_data_port()
+    port = port or controller.find_data_port()
+    discovery_ms = (time.perf_counter() - ready) * 1000
+    if not port:
+        logging.error("No Pico DATA port detected. Pass --port explicitly.")
+        return 2
+
+    startup_ms = (ready - _MODULE_LOAD_START) * 1000
+    logging.info(
+        f"Headless runner ready in {startup_ms:.0f} ms (target {COLD_START_TARGET_MS} ms), "
+        f"port {port} found in {discovery_ms:.0f} ms."
+    )
+    if startup_ms > COLD_START_TARGET_MS:
+        logging.warning("Cold start exceeded its target.")
+
+    controller.start_playback(port, args.window, args.folder)
+    try:
+        while not app.finished.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        logging.info("Interrupted; stopping playback...")
+        stopped = time.perf_counter()
+        controller.stop_playback()
+        app.finished.wait(5.0)
+        logging.info(f"Stopped in {(time.perf_counter() - stopped) * 1000:.1f} ms.")
+    controller.engine.close()
+    if not app.telegram.close(timeout=10.0):
+        logging.warning("Some Telegram notifications were not sent.")
+    return 0
+
+
+def main(argv=None):
+    """Command-line entry point: the GUI by default, or ``run`` for headless playback.
+
+    Args:
+        argv (list, optional): Arguments without the program name.
+
+    Returns:
+        int: Process exit code.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="picobot", description="Pico HID keyboard macro controller."
+    )
+    commands = parser.add_subparsers(dest="command")
+    # Playback settings shared by the headless commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", default=CONFIG_FILE, help="Settings file to read.")
+    common.add_argument("--ack-window", type=int, help="Commands allowed in flight.")
+    common.add_argument(
+        "--device-timing", action="store_true", help="Let the Pico keep time."
+    )
+    common.add_argument(
+        "--text-protocol", action="store_true", help="Disable binary framing."
+    )
+    common.add_argument(
+        "--telemetry-dir", help="Export per-event timing of each macro here."
+    )
+    common.add_argument(
+        "--limit-minutes", type=float, help="Stop after this many minutes."
+    )
+    run = commands.add_parser(
+        "run", parents=[common], help="Play a macro folder without the GUI."
+    )
+    run.add_argument("--port", help="Pico DATA COM port (auto-detected if omitted).")
+    run.add_argument(
+        "--folder", required=True, help="Folder containing macro .txt files."
+    )
+    run.add_argument("--window", required=True, help="Title of the target window.")
+    fleet = commands.add_parser(
+        "fleet", parents=[common], help="Play on several Picos at once."
+    )
+    fleet.add_argument(
+        "--device",
+        action="append",
+        nargs="+",
+        required=True,
+        metavar="ARG",
+        help="PORT FOLDER [WINDOW] of one device; PORT may be 'auto'. Repeat per device.",
+    )
+    fleet.add_argument(
+        "--interval", type=float, default=5.0, help="Seconds between table updates."
+    )
+    fleet.add_argument("--quiet", action="store_true", help="Only log warnings.")
+    check = commands.add_parser(
+        "check", help="Dry-run every macro in a folder without a Pico."
+    )
+    check.add_argument(
+        "--folder", required=True, help="Folder containing macro .txt files."
+    )
+    check.add_argument("--config", default=CONFIG_FILE, help="Settings file to read.")
+    check.add_argument("--report", help="Write the per-file report (.json or .csv).")
+    check.add_argument(
+        "--verbose", action="store_true", help="List files without problems too."
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        return run_headless(args)
+    if args.command == "fleet":
+        return run_fleet(args)
+    if args.command == "check":
+        return run_check(args)
 
-if __name__ == "__main__":
     root = tk.Tk()
     app = MacroControllerApp(root)
     root.mainloop()
+    app.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Protocol tests against pico_sim's PicoProtocol over an in-process link.
+
+Time is virtual and nothing touches a real port, so these run on any machine.
+"""
+
+import pytest
+
+import pico_sim
+import picobot
+
+
+class DroppingSerial(picobot.LoopbackSerial):
+    """LoopbackSerial that loses chosen writes, as a glitch on the wire would."""
+
+    def __init__(self, protocol, drop=()):
+        super().__init__(protocol)
+        self.drop = set(drop)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes - 1 in self.drop:
+            return len(data)
+        return super().write(data)
+
+
+def connect(binary=False, batch=False, drop=(), window=8):
+    """Returns (device, serial link, pipeline) after the hello handshake."""
+    clock = picobot.VirtualClock()
+    device = pico_sim.PicoProtocol(clock=clock, sleep=clock.sleep)
+    ser = DroppingSerial(device)
+    ser.write(b"hello|handshake\n")
+    assert ser.read(64) == b"PICO_READY\n"
+    ser.writes = 0
+    ser.drop = set(drop)
+    pipeline = picobot.CommandPipeline(
+        ser, window=window, ack_timeout=0.05, binary=binary, batch=batch
+    )
+    return device, ser, pipeline
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_cumulative_ack_retires_a_burst(binary):
+    device, ser, pipeline = connect(binary=binary)
+    for key in ("a", "b", "c"):
+        assert pipeline.send("down", key)
+    for key in ("a", "b", "c"):
+        assert pipeline.send("up", key)
+    assert pipeline.drain()
+    assert (pipeline.sent, pipeline.acked, pipeline.error) == (6, 6, None)
+    assert [e[1:] for e in device.key_log.events] == [
+        ("down", "a"),
+        ("down", "b"),
+        ("down", "c"),
+        ("up", "a"),
+        ("up", "b"),
+        ("up", "c"),
+    ]
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_lost_first_command_is_naked(binary):
+    device, ser, pipeline = connect(binary=binary, drop={0})
+    assert pipeline.send("down", "a")
+    assert pipeline.send("down", "b")
+    assert not pipeline.drain()
+    assert pipeline.error.startswith("Pico lost command 0")
+    assert pipeline.acked == 0
+    assert device.pressed == set()
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_gap_is_naked_and_later_commands_dropped(binary):
+    device, ser, pipeline = connect(binary=binary, drop={1})
+    for key in ("a", "b", "c"):
+        pipeline.send("down", key)
+    assert not pipeline.drain()
+    assert pipeline.error.startswith("Pico lost command 1")
+    # Command 0 was acknowledged before the NAK; the Pico let go of it
+    assert pipeline.acked == 1
+    assert device.pressed == set()
+    assert device.seq_lost
+    assert device.stats["naks"] == 1
+
+
+def test_corrupt_frame_is_naked():
+    device, ser, pipeline = connect(binary=True)
+    frame = bytearray(pipeline.encode(pipeline.prepare("down", "a")))
+    frame[-1] ^= 0xFF  # Break the checksum
+    ser.write(bytes(frame))
+    pipeline.sent += 1
+    assert not pipeline.drain()
+    assert pipeline.error.startswith("Pico lost command 0")
+    assert device.stats["bad_frames"] == 1
+
+
+def test_ack_for_unsent_command_is_an_error():
+    device, ser, pipeline = connect()
+    ser._rx += b"ACK 3\n"
+    pipeline.poll()
+    assert pipeline.error.startswith("ACK for 4 command(s)")
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_sequence_numbers_wrap(binary):
+    device, ser, pipeline = connect(binary=binary)
+    start = picobot.SEQ_MODULO - 2
+    pipeline.sent = pipeline.acked = start
+    device.expected_seq = start
+    for key in ("a", "b", "c", "d"):
+        assert pipeline.send("down", key)
+    assert pipeline.drain()
+    assert pipeline.acked == start + 4
+    assert device.expected_seq == 2
+    assert device.pressed == {"a", "b", "c", "d"}
+
+
+def test_binary_frame_matches_encode_frame():
+    device, ser, pipeline = connect(binary=True)
+    key_id = pipeline.key_ids["a"]
+    pipeline.sent = 0x1234
+    command = pipeline.prepare("tl_down", "a", 250000)
+    assert pipeline.encode(command) == picobot.encode_frame(
+        picobot.FRAME_OPS["tl_down"],
+        0x1234,
+        bytes((key_id,)) + (250000).to_bytes(4, "little"),
+    )
+
+
+def test_text_command_format():
+    device, ser, pipeline = connect()
+    pipeline.sent = 7
+    assert pipeline.encode(pipeline.prepare("tl_up", "page down", 42)) == (
+        b"tl_up|page down|7|42\n"
+    )
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_batch_is_applied_as_one_report(binary):
+    device, ser, pipeline = connect(binary=binary, batch=True)
+    command = pipeline.prepare_batch([(True, "ctrl"), (True, "c"), (False, "x")])
+    if binary:
+        assert command.op == picobot.FRAME_OPS["batch"]
+    else:
+        assert pipeline.encode(command).startswith(b"batch|")
+    reports = device.stats["reports"]
+    assert pipeline.send_prepared(command)
+    assert pipeline.drain()
+    assert device.stats["reports"] == reports + 1
+    assert device.pressed == {"ctrl", "c"}
+
+
+def test_batch_rejects_a_key_changed_twice():
+    key_ids = picobot.load_key_ids()
+    assert picobot.prepare_batch([(True, "a"), (False, "a")], key_ids, True) is None
+
+
+def test_text_batch_fits_in_one_line():
+    key_ids = picobot.load_key_ids()
+    keys = [k for k, v in key_ids.items() if v < picobot.BATCH_PRESS]
+    fits = (picobot.TEXT_MAX_LINE - len("batch||65535\n")) // 2
+    command = picobot.prepare_batch([(True, k) for k in keys[:fits]], key_ids, False)
+    line = command.head + str(picobot.SEQ_MODULO - 1).encode() + command.tail
+    assert len(line) <= picobot.TEXT_MAX_LINE
+    more = [(True, k) for k in keys[: fits + 1]]
+    assert picobot.prepare_batch(more, key_ids, False) is None
+    assert picobot.prepare_batch(more, key_ids, True) is not None
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_release_all_resyncs_after_nak(binary):
+    device, ser, pipeline = connect(binary=binary, drop={1})
+    for key in ("a", "b", "c"):
+        pipeline.send("down", key)
+    assert not pipeline.drain()
+
+    session = picobot.PicoSession("loopback")
+    session.ser, session.pipeline, session.caps = ser, pipeline, {"rel", "seq"}
+    assert session.release_all() == set()
+    assert pipeline.error is None
+    assert not device.seq_lost
+
+    assert pipeline.send("down", "d")
+    assert pipeline.drain()
+    assert device.pressed == {"d"}
+
+
+MACROS = {
+    "START_ok.txt": "0.000 down a\n0.050 up a\n0.100 down right shift\n0.150 up right shift\n",
+    "repeat.txt": "0.0 down b\n0.03 down b\n0.06 down b\n0.09 up b\n0.1 up q\n",
+    "broken.txt": "0.0 down a\n\nnot a macro line\n0.2 down nosuchkey\n0.3 up nosuchkey\n",
+}
+
+
+def write_macros(folder, names):
+    folder.mkdir()
+    for name in names:
+        (folder / name).write_text(MACROS[name])
+    return folder
+
+
+def test_dry_run_reports_per_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    folder = write_macros(tmp_path / "macros", MACROS)
+    controller = picobot.MacroController(picobot.HeadlessApp({}))
+    report = {row["file"]: row for row in controller.dry_run(str(folder))}
+
+    assert report["START_ok.txt"]["status"] == "ok"
+    assert report["START_ok.txt"]["events"] == 4
+    # Autorepeat downs are collapsed; the stray release is a warning
+    assert report["repeat.txt"]["status"] == "warning"
+    assert report["repeat.txt"]["events"] == 2
+    assert report["repeat.txt"]["problems"] == [
+        "warning: line 5: 'q' released without being pressed; dropped."
+    ]
+    assert report["broken.txt"]["status"] == "error"
+    assert report["broken.txt"]["problems"] == [
+        "error: line 1: 'a' is pressed but never released.",
+        "error: line 3: Not '<time> <down|up> <key>': 'not a macro line'.",
+        "error: line 4: Key 'nosuchkey' is not in the Pico key table.",
+    ]
+
+
+@pytest.mark.parametrize(
+    "names, code", [(["START_ok.txt", "repeat.txt"], 0), (list(MACROS), 1)]
+)
+def test_check_exit_code(tmp_path, monkeypatch, names, code):
+    monkeypatch.chdir(tmp_path)
+    folder = write_macros(tmp_path / "macros", names)
+    report = tmp_path / "report.json"
+    assert (
+        picobot.main(["check", "--folder", str(folder), "--report", str(report)])
+        == code
+    )
+    assert report.exists()
+
+
+def test_check_missing_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert picobot.main(["check", "--folder", str(tmp_path / "missing")]) == 2
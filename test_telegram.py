@@ -0,0 +1,126 @@
+"""TelegramHandler tests against a local HTTP stand-in for the Bot API."""
+
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import picobot
+
+pytest.importorskip("requests")
+
+
+class FakeBotAPI:
+    """Answers sendMessage with scripted (status, body) replies, then 200."""
+
+    def __init__(self, replies=()):
+        self.replies = list(replies)
+        self.requests = []
+        self.connections = set()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, so reuse can be seen
+
+            def do_POST(self):
+                api.requests.append(self.path)
+                api.connections.add(self.client_address)
+                status, body = (
+                    api.replies.pop(0) if api.replies else (200, {"ok": True})
+                )
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def api():
+    server = FakeBotAPI()
+    yield server
+    server.close()
+
+
+def handler(url, **kwargs):
+    kwargs.setdefault("backoff", 0.01)
+    kwargs.setdefault("min_interval", 0.0)
+    return picobot.TelegramHandler("TOKEN", "42", api_url=url, **kwargs)
+
+
+def test_messages_share_one_connection(api):
+    telegram = handler(api.url)
+    for i in range(3):
+        assert telegram.send_message(f"message {i}")
+    assert telegram.close(5)
+    assert telegram.sent == 3
+    assert api.requests[0].startswith("/botTOKEN/sendMessage?chat_id=42&text=message+0")
+    assert len(api.connections) == 1
+
+
+def test_busy_replies_are_retried(api):
+    api.replies = [(429, {"ok": False, "parameters": {"retry_after": 0.05}}), (502, {})]
+    telegram = handler(api.url)
+    telegram.send_message("hello")
+    assert telegram.close(5)
+    assert (telegram.sent, telegram.failed, len(api.requests)) == (1, 0, 3)
+
+
+def test_client_errors_are_not_retried(api):
+    api.replies = [(400, {"ok": False, "description": "Bad Request"})]
+    telegram = handler(api.url)
+    telegram.send_message("hello")
+    assert telegram.close(5)
+    assert (telegram.sent, telegram.failed, len(api.requests)) == (0, 1, 1)
+
+
+def test_messages_are_spaced(api):
+    telegram = handler(api.url, min_interval=0.1)
+    started = time.monotonic()
+    for i in range(3):
+        telegram.send_message(f"message {i}")
+    assert telegram.close(5)
+    assert time.monotonic() - started >= 0.2
+
+
+def test_full_queue_drops_instead_of_blocking():
+    # Accepts connections but never answers, so the sender stays busy
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    try:
+        telegram = handler(
+            f"http://127.0.0.1:{listener.getsockname()[1]}",
+            queue_size=1,
+            timeout=(0.2, 0.2),
+            max_attempts=1,
+        )
+        started = time.monotonic()
+        results = [telegram.send_message(f"message {i}") for i in range(5)]
+        assert time.monotonic() - started < 0.1
+        assert not all(results)
+        assert telegram.dropped == results.count(False)
+        assert telegram.flush(5)
+        assert telegram.failed == results.count(True)
+    finally:
+        listener.close()
+
+
+def test_unconfigured_handler_sends_nothing():
+    telegram = picobot.TelegramHandler("", "")
+    assert not telegram.send_message("hello")
+    assert telegram.close(1)